@@ -0,0 +1,60 @@
+'''Simulates many circuits at once on a process pool.
+
+Each job is a circuit description (see Circuit.describe) and a dict mapping the component ids of
+buttons to their on state:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     b = button(0, 1)
+    ...     l = lamp(1, 2)
+    ...     t2 = terminal(2, voltage=0)
+    >>> d = c.describe()
+    >>> [r.lamps for r in simulate_batch([(d, {2: False}), (d, {2: True})])]
+    [{1: False}, {1: True}]
+'''
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+
+from graph import DirectedGraph
+from electric import Circuit, get_all_paths_from_positive, settle
+from cache import SimulationCache
+
+batch_result = namedtuple('batch_result', 'lamps steps status')
+
+_cache = SimulationCache()          # Per process, for the jobs of simulate_batch
+
+def simulate(description, buttons=None, max_steps=1000, cache=None):
+    '''Builds a circuit from its description, sets its buttons and runs it until it settles.
+    Returns the on state of every lamp by lamp id together with the settle result. If a
+    SimulationCache is given, circuits it has seen are not simulated again.'''
+    c = Circuit.from_description(description)
+    for sid, on in (buttons or {}).items():
+        c.get_component(sid).on = on
+    if next(c.get_sources(), None) is None:     # No positive terminals, so nothing can light up
+        steps, status = settle(DirectedGraph(), max_steps, c)
+    elif cache is None:
+        steps, status = settle(get_all_paths_from_positive(c), max_steps, c)
+    else:
+        steps, status = cache.settle(max_steps, c)
+    return batch_result({k: l.on for k, l in c.lamp_register.items()}, steps, status)
+
+def _simulate_job(max_steps, job):
+    return simulate(*job, max_steps=max_steps, cache=_cache)
+
+def simulate_batch(jobs, max_workers=None, chunksize=None, max_steps=1000):
+    '''Runs simulate on every (description, buttons) job across a process pool and returns the
+    results in order.
+
+    Jobs are sent to the workers in chunks (by default about four per worker) so pickling does
+    not dominate small circuits. A description shared by the jobs in a chunk is only pickled once
+    for that chunk. Every worker process keeps a SimulationCache, so a job it has seen before
+    costs only building the circuit.
+    '''
+    jobs = list(jobs)
+    max_workers = max_workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers) as ex:
+        return list(ex.map(partial(_simulate_job, max_steps), jobs, chunksize=chunksize))
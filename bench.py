@@ -0,0 +1,193 @@
+'''Benchmarks for the simulation hot paths on generated circuits.
+
+Every generator builds a new circuit of a given size and returns it:
+
+    chain           a terminal, n wires in a row, a lamp and the ground
+    ladder          two wire rails joined by n lamps
+    grid            an n by n mesh of lamps between a source corner and a ground corner
+    button_tree     a binary tree of buttons n levels deep, every other one pressed, with a lamp
+                    to ground at each leaf
+    transistors     n transistor stages, each driving the base of the next and a lamp
+    fanout          n rows of a wire, a diode and a lamp between a source and the ground
+
+For each circuit the benchmark times get_all_paths_from_positive, detect_shorts, settle (which
+runs propagate_current_step until the circuit stops changing) and parallel.partition (which
+settle_parallel runs before settling anything), and measures the memory used per component
+while building it. Run it as a script:
+
+    python bench.py -o results.json                # Write the results
+    python bench.py -b baseline.json               # Compare against a baseline
+
+Comparing against a baseline exits with status 1 if any time or memory figure got worse by more
+than the tolerance (20% by default). Metrics the baseline doesn't have are skipped. Times are
+the best of several runs.
+'''
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+from electric import (Circuit, terminal, wire, lamp, button, transistor, diode, detect_shorts,
+                      get_all_paths_from_positive, settle)
+from parallel import partition
+
+bench_result = namedtuple('bench_result', 'components paths shorts settle steps status partition '
+                          'bytes_per_component')
+regression = namedtuple('regression', 'benchmark metric baseline result')
+
+metrics = ('paths', 'shorts', 'settle', 'partition', 'bytes_per_component')
+
+def chain(n):
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        for i in range(n):
+            wire(i, i + 1)
+        lamp(n, n + 1)
+        terminal(n + 1, voltage=0)
+    return c
+
+def ladder(n):
+    with Circuit() as c:
+        terminal(('top', 0), voltage=1)
+        for i in range(n):
+            wire(('top', i), ('top', i + 1))
+            wire(('bottom', i), ('bottom', i + 1))
+            lamp(('top', i + 1), ('bottom', i))
+        terminal(('bottom', n), voltage=0)
+    return c
+
+def grid(n):
+    with Circuit() as c:
+        terminal((0, 0), voltage=1)
+        for x in range(n):
+            for y in range(n):
+                if x + 1 < n: lamp((x, y), (x + 1, y))
+                if y + 1 < n: lamp((x, y), (x, y + 1))
+        terminal((n - 1, n - 1), voltage=0)
+    return c
+
+def button_tree(n):
+    with Circuit() as c:
+        terminal(1, voltage=1)
+        for node in range(1, 1 << n):
+            for child in (2 * node, 2 * node + 1):
+                b = button(node, child)
+                b.on = child % 2 == 0
+        for leaf in range(1 << n, 1 << (n + 1)):
+            lamp(leaf, 'ground')
+        terminal('ground', voltage=0)
+    return c
+
+def transistors(n):
+    with Circuit() as c:
+        terminal('power', voltage=1)
+        button('power', ('base', 0)).on = True
+        for i in range(n):
+            transistor('power', ('base', i), ('emitter', i))
+            lamp(('emitter', i), 'ground')
+            wire(('emitter', i), ('base', i + 1))
+        terminal('ground', voltage=0)
+    return c
+
+def fanout(n):
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        for i in range(n):
+            wire(0, (i, 1))
+            diode((i, 1), (i, 2))
+            lamp((i, 2), 'ground')
+        terminal('ground', voltage=0)
+    return c
+
+generators = {f.__name__: f for f in (chain, ladder, grid, button_tree, transistors, fanout)}
+sizes = {'chain': 2000, 'ladder': 500, 'grid': 20, 'button_tree': 8, 'transistors': 300,
+         'fanout': 2000}
+
+def _best(f, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best, result
+
+def measure(generator, n, repeat=3, max_steps=1000):
+    '''Runs the benchmarks on generator(n) and returns a bench_result. Times are in seconds.'''
+    tracemalloc.start()
+    try:
+        c = generator(n)
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    paths_time, paths = _best(lambda: get_all_paths_from_positive(c), repeat)
+    shorts_time, shorts = _best(lambda: detect_shorts(paths, circuit=c), repeat)
+    def run():
+        c.pct.clear()
+        for l in c.lamp_register.values():
+            l.on = False
+        return settle(paths, max_steps, c)
+    settle_time, (steps, status) = _best(run, repeat)
+    partition_time, _ = _best(lambda: partition(paths, c), repeat)
+    return bench_result(len(c.register), paths_time, shorts_time, settle_time, steps,
+                        status.value, partition_time, memory / len(c.register))
+
+def run(scale=1.0, repeat=3, names=None):
+    '''Runs every benchmark (or those in names) with the default sizes times scale and returns
+    the results by benchmark name.'''
+    results = {}
+    for name in names or generators:
+        if name == 'button_tree':        # Size is the depth, so the tree doubles per level
+            n = max(1, sizes[name] + round(math.log2(scale)))
+        else:
+            n = max(1, round(sizes[name] * scale))
+        results[f'{name}/{n}'] = measure(generators[name], n, repeat)._asdict()
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    '''Returns a regression for every metric of a benchmark in both results and baseline that
+    got worse by more than tolerance (as a fraction of the baseline).'''
+    found = []
+    for name, r in results.items():
+        if name not in baseline: continue
+        for m in metrics:
+            if m in baseline[name] and r[m] > baseline[name][m] * (1 + tolerance):
+                found.append(regression(name, m, baseline[name][m], r[m]))
+    return found
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the simulation hot paths.')
+    parser.add_argument('-o', '--output', help='file to write the results to, as JSON')
+    parser.add_argument('-b', '--baseline', help='results file to compare against')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='allowed slowdown as a fraction of the baseline (default 0.2)')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='multiplies the circuit sizes')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per timing (default 3)')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run, out of {", ".join(generators)}')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in generators:
+            parser.error(f'unknown benchmark {name!r}')
+
+    results = run(args.scale, args.repeat, args.names)
+    for name, r in results.items():
+        print(f'{name:20} {r["components"]:8} components  paths {r["paths"]:.4f}s  '
+              f'shorts {r["shorts"]:.4f}s  settle {r["settle"]:.4f}s ({r["steps"]} steps)  '
+              f'partition {r["partition"]:.4f}s  '
+              f'{r["bytes_per_component"]:.0f} B/component')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f'REGRESSION {r.benchmark} {r.metric}: {r.baseline:.4g} -> {r.result:.4g}')
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
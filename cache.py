@@ -0,0 +1,130 @@
+'''Caches the path analysis and settled states of circuits, so a circuit that was seen before
+isn't analysed or stepped again.
+
+Entries are keyed by circuit_key: a hash of every component's type, pins and attrs, in id
+order, plus the state of every button. Two circuits with the same key were built the same way,
+so they have the same pin ids, and a state of one can be copied onto the other. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     l = lamp(0, 1)
+    ...     t2 = terminal(1, voltage=0)
+    >>> cache = SimulationCache()
+    >>> cache.settle(circuit=c)
+    settle_result(steps=2, status=<settle_status.CONVERGED: 'converged'>)
+    >>> l.on = False
+    >>> cache.settle(circuit=c), l.on
+    (settle_result(steps=2, status=<settle_status.CONVERGED: 'converged'>), True)
+    >>> cache.hits, cache.misses
+    (1, 2)
+
+The cache holds at most maxsize entries and drops the least recently used one when full. Path
+analyses, settle results and saved states are separate entries.
+'''
+from array import array
+from collections import OrderedDict
+import hashlib
+
+from electric import _circuit_state, _live_sets, _path_edges, _resolve, block, button, settle
+from graph import DirectedGraph
+
+def circuit_key(circuit=None):
+    '''A hash of the circuit's components and button states, as a hex string. The same in every
+    process.'''
+    h = hashlib.blake2b(digest_size=16)
+    for c in _resolve(circuit).register.values():
+        record = (type(c).__name__, c.ps, sorted(c.attrs.items()), type(c) is button and c.on)
+        h.update(repr(record).encode() + b'\n')
+    return h.hexdigest()
+
+def _state(circuit):
+    # _circuit_state plus whether every block is on and the states of its lamps, which settle
+    # leaves out since they follow from the currents at the block's pins
+    blocks = [(c.on, c.lit) for c in circuit.register.values() if type(c) is block]
+    return _circuit_state(circuit) + (blocks,)
+
+def _restore(circuit, state):
+    # Copies a state from _state back onto the circuit
+    currents, lit, blocks = state
+    circuit.pct.buffer[:] = array('b', currents)
+    circuit.lamp_states[:] = lit
+    for c, (on, lit) in zip((c for c in circuit.register.values() if type(c) is block), blocks):
+        c.on, c.lit = on, lit
+
+class SimulationCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def live(self, circuit=None, make=None, key=None):
+        '''The forward and backward live edge sets of the circuit's path analysis, as new sets.
+        make computes them on a miss (the path analysis of build_path_graph by default).'''
+        circuit = _resolve(circuit)
+        key = ('live', key or circuit_key(circuit))
+        entry = self._get(key)
+        if entry is None:
+            forward, backward = make() if make else _live_sets(circuit)
+            entry = frozenset(forward), frozenset(backward)
+            self._put(key, entry)
+        return set(entry[0]), set(entry[1])
+
+    def paths(self, circuit=None, graph=DirectedGraph, key=None):
+        '''Drop-in for build_path_graph.'''
+        forward, backward = self.live(circuit, key=key)
+        return graph.from_edges(_path_edges(forward, backward, _resolve(circuit)))
+
+    def settle(self, max_steps=1000, circuit=None):
+        '''Clears the circuit's pin currents and lamps and settles it like settle does with the
+        circuit's path graph. Returns the settle_result. Seen circuits get the state they settled
+        into before, without being stepped.'''
+        circuit = _resolve(circuit)
+        key = circuit_key(circuit)
+        circuit.pct.clear()
+        circuit.lamp_states[:] = bytes(len(circuit.lamp_states))
+        entry = self._get(('settled', key))
+        if entry is not None:
+            state, result = entry
+            _restore(circuit, state)
+            return result
+        result = settle(self.paths(circuit, key=key), max_steps, circuit)
+        self._put(('settled', key), (_state(circuit), result))
+        return result
+
+    def save_state(self, circuit=None, key=None):
+        '''Saves the circuit's pin currents and the states of its lamps and blocks, e.g. once a
+        simulation has settled.'''
+        circuit = _resolve(circuit)
+        self._put(('state', key or circuit_key(circuit)), _state(circuit))
+
+    def restore_state(self, circuit=None, key=None):
+        '''Copies a state saved with save_state onto the circuit and returns True if there is one
+        for its key.'''
+        circuit = _resolve(circuit)
+        state = self._get(('state', key or circuit_key(circuit)))
+        if state is None:
+            return False
+        _restore(circuit, state)
+        return True
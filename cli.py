@@ -0,0 +1,102 @@
+'''Simulates a netlist from the command line and prints the result as JSON.
+
+    python cli.py circuit.xnl
+    python cli.py - < circuit.xnl           # Read the netlist from stdin
+    python cli.py circuit.xnb --max-steps 200 --trace run.xdw
+
+Runs the path analysis and the short circuit check, and unless a short is found settles the
+circuit. Prints one JSON object:
+
+    {"components": 4, "lamps": {"1": true}, "steps": 2, "status": "converged", "shorts": [],
+     "timings": {"import": 0.004, "load": 0.0001, "paths": 0.0001, "shorts": 0.00003,
+                 "settle": 0.0001, "total": 0.0003}}
+
+Lamps are keyed by lamp id, which counts the lamps of the netlist in order from 1. A short is an
+object with the source and ground pins and the ids of the components between them. Timings are
+in seconds: import is the time taken to import the simulator, and total the time from then on.
+A circuit without positive terminals has no paths, so its lamps stay off.
+
+Exits with status 0 if the circuit converged, 1 if it has a short circuit and 2 if it didn't
+settle (or the arguments or the netlist are bad). Only the simulation modules are imported, never
+pygame or the editor's drawing code.
+'''
+import time
+_start = time.perf_counter()
+
+import argparse
+import json
+import sys
+
+from electric import Circuit, build_path_graph, component_types, detect_shorts, settle
+from graph import DirectedGraph
+import netlist
+
+_imported = time.perf_counter()
+
+def simulate(f, max_steps=1000, trace=None):
+    '''Simulates the netlist in the binary file object f and returns the result as a dict.'''
+    timings = {}
+    def lap(name, start):
+        now = time.perf_counter()
+        timings[name] = now - start
+        return now
+
+    start = t = time.perf_counter()
+    circuit = Circuit()
+    for name, ps, attrs in netlist.components(netlist.records(f)):
+        component_types[name](*ps, circuit=circuit, **attrs)
+    t = lap('load', t)
+    if next(circuit.get_sources(), None) is not None:
+        paths = build_path_graph(circuit)
+    else:                   # Nothing can light up
+        paths = DirectedGraph()
+    t = lap('paths', t)
+    shorts = detect_shorts(paths, circuit=circuit)
+    t = lap('shorts', t)
+    steps, status = 0, None
+    if not shorts:
+        if trace is not None:
+            import waveform
+            waveform.start_trace(trace, circuit)
+        try:
+            steps, status = settle(paths, max_steps, circuit)
+        finally:
+            if trace is not None: waveform.stop_trace(circuit)
+        t = lap('settle', t)
+    lap('total', start)
+    return {
+        'components': len(circuit.register),
+        'lamps': {sid: l.on for sid, l in circuit.lamp_register.items()},
+        'steps': steps,
+        'status': 'short circuit' if shorts else status.value,
+        'shorts': [s._asdict() for s in shorts],
+        'timings': timings,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulates a netlist and prints the result as JSON.')
+    parser.add_argument('netlist', help='netlist file, text or binary, or - for stdin')
+    parser.add_argument('-m', '--max-steps', type=int, default=1000,
+                        help='steps to take before giving up (default 1000)')
+    parser.add_argument('--trace', help='file to record every step to (see waveform.py)')
+    parser.add_argument('--indent', type=int, help='indents the JSON output')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.netlist == '-':
+            result = simulate(sys.stdin.buffer, args.max_steps, args.trace)
+        else:
+            with open(args.netlist, 'rb') as f:
+                result = simulate(f, args.max_steps, args.trace)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f'{parser.prog}: error: {e!r}', file=sys.stderr)
+        return 2
+    result['timings'] = {'import': _imported - _start, **result['timings']}
+    json.dump(result, sys.stdout, indent=args.indent, default=list)
+    sys.stdout.write('\n')
+    if result['shorts']:
+        return 1
+    return 0 if result['status'] == 'converged' else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+'''Compiles a circuit into a plain Python function from button states to lamp states.
+
+The generated function works out the path graph for the given buttons, loops hanging off the
+circuit included (calling back into electric only for loops that don't fold into chains and
+parallel edges, like a bridge, and then once for each set of their edges), and then runs the
+components as straight-line code, with no method calls or table lookups other than running
+blocks (see electric.block.propagate_bits). The code visits the pins in the order settle's sweep
+does and runs each component where the sweep would, and the whole pass is repeated until it
+changes nothing, so the lamps come out as settle leaves them.
+Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     b = button(0, 1)
+    ...     l = lamp(1, 2)
+    ...     t2 = terminal(2, voltage=0)
+    >>> f = compile_circuit(c)
+    >>> f(False), f(True)
+    ({1: False}, {1: True})
+
+Arguments are the on states of the buttons in id order (f.buttons). Every call starts from a
+fresh circuit with no current anywhere. Compiled functions are cached by the circuit's
+description, so compiling another circuit with the same components and pins is free.
+'''
+from collections import OrderedDict, defaultdict
+
+from graph import DirectedGraph
+from electric import (_can_dangle, _connected_pins, _edge_masks, _HangingMasks, _resolve, button,
+                      diode, lamp, terminal, transistor, wire)
+
+# propagate_bits of each component type as expression templates, {0} being the mask and {1},
+# {2}, ... the pin currents
+_rules = {
+    terminal: ('{0}',),
+    wire: ('{1} | {2}', '{1} | {2}'),
+    button: ('{1} | {2}', '{1} | {2}'),
+    lamp: ('{1} | {2}', '{1} | {2}'),
+    diode: ('{1}', '{1}'),
+    transistor: ('{1}', '{2}', '({2} & {1}) | (~{2} & {3})'),
+}
+
+cache_size = 128
+_cache = OrderedDict()
+
+class CompiledCircuit:
+    def __init__(self, source, buttons, namespace=None):
+        self.source = source
+        self.buttons = buttons
+        namespace = {} if namespace is None else namespace
+        exec(compile(source, '<compiled circuit>', 'exec'), namespace)
+        self.evaluate = namespace['evaluate']
+
+    def __call__(self, *states):
+        return self.evaluate(*map(int, states))
+
+def _emit_live(lines, name, edges, pres, starts):
+    # Emits name{k} for every edge k as the least solution of
+    #   L(a, b) = pres(a, b) & (1 if a is a start pin else OR of L(t, a) for t != b)
+    # which is what electric._live_edges computes. Assignments go in dependency order, and
+    # groups that depend on each other are repeated until they stop changing.
+    into = defaultdict(list)
+    for k, (a, b) in enumerate(edges):
+        into[b].append(k)
+    deps = DirectedGraph()
+    exprs = []
+    for k, (a, b) in enumerate(edges):
+        deps.cd[k]
+        if a in starts:
+            exprs.append(pres[k])
+            continue
+        ins = [j for j in into[a] if edges[j][0] != b]
+        for j in ins: deps.add_conn(j, k)
+        e = ' | '.join(f'{name}{j}' for j in ins) or '0'
+        exprs.append(e if pres[k] == '1' or e == '0' else f'({pres[k]}) & ({e})')
+    for scc in deps.strongly_connected_components():
+        if len(scc) == 1 and scc[0] not in deps.cd[scc[0]]:
+            lines.append(f'    {name}{scc[0]} = {exprs[scc[0]]}')
+            continue
+        vs = ', '.join(f'{name}{k}' for k in scc)
+        lines.append(f'    {vs}, = {", ".join("0" for k in scc)},')
+        lines.append(f'    while True:')
+        lines.append(f'        _old = {vs},')
+        lines.extend(f'        {name}{k} = {exprs[k]}' for k in scc)
+        lines.append(f'        if ({vs},) == _old: break')
+
+def _emit_hanging(lines, namespace, edges, sources, grounds):
+    # Emits the folds of electric._HangingMasks over the edges' e{k}, h{i} being whether folded
+    # edge i is there and hk{i} whether it is on a simple path, and takes the edges of loops
+    # hanging off the circuit out of the e{k}. Only a core that doesn't fold calls back into
+    # electric, once for every set of its edges.
+    pairs = defaultdict(list)
+    for k, (a, b) in enumerate(edges):
+        if a != b: pairs[frozenset((a, b))].append(k)
+    loops = _HangingMasks([tuple(e) for e in pairs], sources, grounds)
+    n = len(loops.ends) - len(loops.folds)
+    lines.extend(f'    h{i} = {" | ".join(f"e{k}" for k in ks)}' for i, ks in enumerate(pairs.values()))
+    lines.extend(f'    h{i} = 1' for i in range(len(pairs), n))
+    lines.extend(f'    h{i} = h{j} {op} h{k}' for i, (j, op, k) in enumerate(loops.folds, n))
+    known = set(loops.core)         # The hk{i} assigned so far
+    if len(loops.core) == 1 and set(loops.ends[loops.core[0]]) == {loops.S, loops.T}:
+        lines.append(f'    hk{loops.core[0]} = h{loops.core[0]}')     # Everything folded
+    elif loops.core:
+        def core(*hs):
+            kept = set(loops.core_kept(tuple(k for k, h in zip(loops.core, hs) if h)))
+            return [int(k in kept) for k in loops.core]
+        namespace['_core'] = core
+        lines.append(f'    {", ".join(f"hk{k}" for k in loops.core)}, = '
+                     f'_core({", ".join(f"h{k}" for k in loops.core)})')
+    for i, (j, op, k) in reversed(list(enumerate(loops.folds, n))):
+        if i in known: lines.append(f'    hk{j}, hk{k} = hk{i} & h{j}, hk{i} & h{k}')
+        else: lines.append(f'    hk{j} = hk{k} = 0')
+        known.update((j, k))
+    lines.extend(f'    hk{i} = 0' for i in range(len(pairs)) if i not in known)
+    kept = {k: i for i, ks in enumerate(pairs.values()) for k in ks}
+    lines.extend(f'    e{k} = e{k} & hk{kept[k]}' if k in kept else f'    e{k} = 0'
+                 for k in range(len(edges)))
+
+def _generate(circuit, max_steps):
+    buttons = [c for c in circuit.register.values() if type(c) is button]
+    full = 1 << len(buttons)
+    masks = {b: 1 << j for j, b in enumerate(buttons)}
+    def condition(bits):
+        if bits & full: return '1'
+        return ' | '.join(f'b{j}' for j in range(len(buttons)) if bits >> j & 1)
+
+    sources = set(circuit.get_sources())
+    grounds = {p for p in circuit.pcd if circuit.get_terminal_voltage(p) == 0}
+    es = _edge_masks(circuit, masks, full, sources, grounds)
+    edges = list(es)
+    pres = [condition(es[e]) for e in edges]
+    args = ', '.join(f'b{j}' for j in range(len(buttons)))
+    lines = [f'def evaluate({args}):']
+    _emit_live(lines, 'f', edges, pres, sources)
+    _emit_live(lines, 'g', [(b, a) for a, b in edges], pres, grounds)
+    edge_var = {e: f'e{k}' for k, e in enumerate(edges)}
+    lines.extend(f'    e{k} = f{k} & g{k}' for k in range(len(edges)))
+    namespace = {}
+    if _can_dangle(edges, sources, grounds):
+        _emit_hanging(lines, namespace, edges, sources, grounds)
+
+    # Every run of a component in the sweep, in order, with the condition on the buttons under
+    # which the sweep makes it (see electric._propagates_at)
+    visits, conds = [], {}
+    for p, cl in circuit.pcd.items():
+        for c in cl:
+            terms = []
+            if type(c) is not terminal:
+                for q, m in _connected_pins(c, p, masks, full):
+                    e = edge_var.get((p, q), '0')
+                    terms.append(e if m & full else f'({e} | b{m.bit_length() - 1} ^ 1)')
+            if '0' in terms: continue
+            cond = ' & '.join(terms) or '1'
+            if cond != '1' and cond not in conds:
+                conds[cond] = f'a{len(conds)}'
+                lines.append(f'    {conds[cond]} = {cond}')
+            visits.append((c, conds.get(cond, cond)))
+
+    x = {p: f'x{i}' for i, p in enumerate(circuit.pcd)}
+    lamps = list(circuit.lamp_register.items())
+    o = {l: f'o{i}' for i, (k, l) in enumerate(lamps)}
+    state = ', '.join([*x.values(), *o.values()])
+    if state:
+        lines.append(f'    {state}, = {", ".join("0" for v in [*x.values(), *o.values()])},')
+    lines.append(f'    for _ in range({max_steps}):')
+    lines.append(f'        _old = {state},')
+    for c, cond in visits:
+        indent = '        '
+        if cond != '1':
+            lines.append(f'        if {cond}:')
+            indent += '    '
+        ins = [x[p] for p in c.ps]
+        outs = ', '.join(ins)
+        if type(c) in _rules:
+            r = [t.format('1', *ins) for t in _rules[type(c)]]
+        else:               # Blocks and unknown component types are called
+            namespace[f'_c{c.sid}'] = c
+            lines.append(f'{indent}_r = _c{c.sid}.propagate_bits(1, {outs})')
+            r = [f'_r[{j}]' for j in range(len(ins))]
+        if c in o:
+            lines.append(f'{indent}{o[c]}, {outs}, = {r[0]}, {", ".join(r)},')
+        else:
+            lines.append(f'{indent}{outs}, = {", ".join(r)},')
+    lines.append(f'        if ({state},) == _old: break')
+    lines.append(f'    return {{{", ".join(f"{k}: bool({o[l]})" for k, l in lamps)}}}')
+    return CompiledCircuit('\n'.join(lines) + '\n', [b.sid for b in buttons], namespace)
+
+def _topology_key(circuit):
+    if any(type(c) not in _rules for c in circuit.register.values()):
+        return None
+    try:
+        key = tuple((name, ps, tuple(sorted(attrs.items()))) for name, ps, attrs in circuit.describe())
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def compile_circuit(circuit=None, max_steps=1000):
+    '''Compiles the circuit into a CompiledCircuit, reusing a cached one if a circuit with the
+    same description was compiled before.'''
+    circuit = _resolve(circuit)
+    key = _topology_key(circuit)
+    if key is not None and (key, max_steps) in _cache:
+        _cache.move_to_end((key, max_steps))
+        return _cache[key, max_steps]
+    compiled = _generate(circuit, max_steps)
+    if key is not None:
+        _cache[key, max_steps] = compiled
+        if len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return compiled
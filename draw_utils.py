@@ -1,3 +1,4 @@
+import functools
 import math    # TODO: add black background in draw_text
 import pygame
 
@@ -19,12 +20,10 @@ def draw_wire(ip, ep, color='yellow', component=None):
     pygame.draw.line(screen, color, ip, ep)
 
 def draw_lamp(ip, ep, component, r=10):
-    if (component.bec is not None) and component.bec.on:
-        print('on', end='\r')
+    if component.on:
         fore = 'black'
         back = 'yellow'
     else:
-        print('off', end='\r')
         fore = 'yellow'
         back = 'black'
     draw_wire(ip, ep)
@@ -56,7 +55,7 @@ def draw_button(ip, ep, component):
     s2 = (pos[0] + 10, pos[1])
     pygame.draw.line(screen, 'yellow', ip, s1)
     pygame.draw.circle(screen, 'yellow', s1, 2)
-    if component.bec is not None and component.bec.on:
+    if component.on:
         pygame.draw.line(screen, 'yellow', (s1[0], s1[1]), (s2[0], s2[1]))
         pygame.draw.line(screen, 'yellow', (pos[0], pos[1]), (pos[0], pos[1] - 10))
     else:
@@ -65,6 +64,18 @@ def draw_button(ip, ep, component):
     pygame.draw.circle(screen, 'yellow', s2, 2)
     pygame.draw.line(screen, 'yellow', s2, ep)
 
+def draw_block(*ps, component, r=8):
+    xs, ys = [p[0] for p in ps], [p[1] for p in ps]
+    pos = (sum(xs) / len(ps), sum(ys) / len(ps))
+    for p in ps:
+        pygame.draw.line(screen, 'yellow', p, pos)
+    box = pygame.Rect(pos[0] - r, pos[1] - r, 2 * r, 2 * r)
+    pygame.draw.rect(screen, 'yellow' if component.on else 'black', box)
+    pygame.draw.rect(screen, 'yellow', box, 1)
+
+def cursor_rect(p):
+    return pygame.Rect(p[0] - 16, p[1] - 16, 33, 33)
+
 def draw_cursor(p, color='yellow'):
     #pygame.draw.circle(screen, 'green', pos, 10)
     pygame.draw.line(screen, color, (p[0] + 4, p[1]), (p[0] - 4, p[1]))
@@ -75,12 +86,19 @@ def draw_cursor(p, color='yellow'):
     pygame.draw.line(screen, color, (p[0], p[1] + 8), (p[0], p[1] + 16))
     pygame.draw.line(screen, color, (p[0], p[1] - 8), (p[0], p[1] - 16))
 
+@functools.lru_cache(maxsize=256)
+def render_text(font, text, color='yellow'):
+    return font.render(text, False, color)
+
 def draw_text(text, p, font):
+    # Returns the rect drawn over
     c = p[1]
+    rect = pygame.Rect(p, (0, 0))
     for l in text.split('\n'):
-        s = font.render(l, False, 'yellow')
-        screen.blit(s, (p[0], c))
+        s = render_text(font, l)
+        rect.union_ip(screen.blit(s, (p[0], c)))
         c += s.get_height()
+    return rect
 
 def draw_help_screen(p, font):
     text = """
@@ -94,17 +112,22 @@ Keybindings:
     h: show/hide this [h]elp message
     c: show/hide the [c]redits
     l: show/hide the [l]icense
+    i: show/hide simulation stats ([i]nfo)
 
     w: [w]ire
     e: [e]mitter/lamp
     s: [s]ource
     g: [g]round
     b: [b]utton
+    k: bloc[k], again for the next one
 
     Esc: cancel current component
     Space: start/stop simulation
+    Ctrl+S/Ctrl+O: save/open circuit.xnl
+    Ctrl+B: make the drawing a block, its
+            terminals marking the ports
     """.strip()
-    draw_text(text, p, font)
+    return draw_text(text, p, font)
 
 def draw_credits_screen(p, font):
     text = """
@@ -114,7 +137,7 @@ Created by:
     Pradhyum Rajasekar <drpradhyum2016@outlook.com>
     Aditya Bansal <adityabansal0805@gmail.com>
 """.strip()
-    draw_text(text, p, font)
+    return draw_text(text, p, font)
 
 def draw_license_screen(p, font):
     text = """
@@ -138,4 +161,4 @@ furnished to do so, subject to the following conditions:
     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
     SOFTWARE.
 """.strip()
-    draw_text(text, p, font)
+    return draw_text(text, p, font)
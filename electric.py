@@ -1,11 +1,287 @@
-from collections import defaultdict, deque
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, deque, namedtuple
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager, nullcontext
+from enum import Enum
+from heapq import heappop, heappush
 import itertools as it
 cfi = it.chain.from_iterable
+import threading
 import time
-from graph import DirectedGraph
-from functools import reduce
+from graph import DirectedGraph, DisjointSet
 
-RUNNING = False
+_local = threading.local()
+
+class PinComponents(Mapping):
+    '''Read-only view of a circuit's pin component dictionary. Maps every pin to the list of
+    components on it, in id order, and unknown pins to an empty list. Stored CSR style: the
+    components of pin id i are comps[offsets[i]:offsets[i + 1]]. The buffers are rebuilt in one
+    pass the first time they are needed after a component was added.
+    '''
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.offsets = None
+        self.comps = []
+
+    def _build(self):
+        circuit = self.circuit
+        counts = [0] * (len(circuit.pins) + 1)
+        for c in circuit.register.values():
+            for i in dict.fromkeys(c.ids): counts[i + 1] += 1
+        offsets = array('l', it.accumulate(counts))
+        fill = offsets[:-1]
+        comps = [None] * offsets[-1]
+        for c in circuit.register.values():
+            for i in dict.fromkeys(c.ids):
+                comps[fill[i]] = c
+                fill[i] += 1
+        self.offsets, self.comps = offsets, comps
+
+    def at(self, i):
+        '''The components on the pin with id i.'''
+        if self.offsets is None: self._build()
+        return self.comps[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, p):
+        i = self.circuit.pin_ids.get(p)
+        return [] if i is None else self.at(i)
+
+    def __contains__(self, p):
+        return p in self.circuit.pin_ids
+
+    def __iter__(self):
+        return iter(self.circuit.pins)
+
+    def __len__(self):
+        return len(self.circuit.pins)
+
+    def items(self):
+        if self.offsets is None: self._build()
+        comps, offsets = self.comps, self.offsets
+        for i, p in enumerate(self.circuit.pins):
+            yield p, comps[offsets[i]:offsets[i + 1]]
+
+class PinCurrents(MutableMapping):
+    '''A circuit's pin current table. Maps pins to currents like a defaultdict(int), with the
+    currents stored in a byte array indexed by pin id. Setting the current of an unknown pin
+    interns it.
+    '''
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.buffer = array('b')
+
+    def __getitem__(self, p):
+        i = self.circuit.pin_ids.get(p)
+        return 0 if i is None else self.buffer[i]
+
+    def __setitem__(self, p, v):
+        self.buffer[self.circuit.intern(p)] = v
+
+    def __delitem__(self, p):
+        self.buffer[self.circuit.pin_ids[p]] = 0
+
+    def __iter__(self):
+        return iter(self.circuit.pins)
+
+    def __len__(self):
+        return len(self.circuit.pins)
+
+    def clear(self):
+        self.buffer[:] = array('b', bytes(len(self.buffer)))
+
+class Circuit:
+    '''Holds everything that belongs to one circuit: the component register, the pin tables and
+    the lamp register. Components are added to the circuit passed as circuit=, otherwise to the
+    circuit of the innermost with block, otherwise to the default circuit. Example:
+
+        >>> with Circuit() as c:
+        ...     w = wire(0, 1)
+        >>> c.get_component(1) is w
+        True
+
+    Circuit.default is what the class attributes of component and the module-level functions
+    use when no circuit is given. component.reset_class replaces it.
+    '''
+    default = None
+
+    def __init__(self):
+        self.sid = 1
+        self.register = {}
+        self.pin_ids = {}                         # Pin -> dense integer id
+        self.pins = []                            # Id -> pin
+        self.pcd = PinComponents(self)            # Pin component dictionary
+        self.pct = PinCurrents(self)              # Pin current table
+        self.lamp_sid = 1
+        self.lamp_register = {}
+        self.lamp_states = bytearray()            # Lamp id - 1 -> on
+        self.running = False
+        self.stats = None                         # SimulationStats, if enabled
+        self.trace = None                         # waveform.TraceWriter, if recording
+
+    def __enter__(self):
+        _local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _local.stack.pop()
+
+    @staticmethod
+    def current():
+        '''Returns the circuit new components go into.'''
+        stack = getattr(_local, 'stack', None)
+        return stack[-1] if stack else Circuit.default
+
+    def intern(self, p):
+        '''Returns the integer id of pin p, giving it the next free one if it is new.'''
+        i = self.pin_ids.get(p)
+        if i is None:
+            i = self.pin_ids[p] = len(self.pins)
+            self.pins.append(p)
+            self.pct.buffer.append(0)
+            self.pcd.offsets = None
+        return i
+
+    def add(self, c):
+        c.sid = sid = self.sid
+        self.sid = sid + 1
+        self.register[sid] = c
+        pin_ids = self.pin_ids
+        c.ids = tuple([pin_ids[p] if p in pin_ids else self.intern(p) for p in c.ps])
+        self.pcd.offsets = None
+
+    def get_component(self, sid):
+        return self.register[sid]
+
+    def get_sources(self):
+        for v in self.register.values():
+            if type(v) is terminal and v.voltage > 0:
+                yield v.p1
+
+    def get_terminal_voltage(self, node):
+        try:
+            return next(filter(lambda c: type(c) is terminal, self.pcd[node])).voltage
+        except StopIteration:
+            return None
+
+    def describe(self):
+        '''Returns a picklable description of the circuit: a list of (type name, pins, attrs)
+        in component id order. Example:
+
+            >>> with Circuit() as c:
+            ...     t = terminal(0, voltage=1)
+            ...     w = wire(0, 1)
+            >>> c.describe()
+            [('terminal', (0,), {'voltage': 1}), ('wire', (0, 1), {})]
+        '''
+        return [c.record() for c in self.register.values()]
+
+    @staticmethod
+    def from_description(description):
+        '''Builds a new circuit from the output of describe.'''
+        with Circuit() as c:
+            for name, ps, attrs in description:
+                component_types[name](*ps, **attrs)
+        return c
+
+def _resolve(circuit):
+    return Circuit.current() if circuit is None else circuit
+
+class SimulationStats:
+    '''Where a circuit's simulation time goes. Collected only while enabled with enable_stats,
+    otherwise the simulation checks a single attribute per step or phase. Example:
+
+        >>> with Circuit() as c:
+        ...     t1 = terminal(0, voltage=1)
+        ...     l = lamp(0, 1)
+        ...     t2 = terminal(1, voltage=0)
+        >>> stats = enable_stats(c)
+        >>> settle(get_all_paths_from_positive(c), circuit=c).steps
+        2
+        >>> stats.steps, stats.propagate_calls, stats.pins_visited, stats.path_edges
+        (2, 6, 4, 1)
+
+    times holds the total wall time in seconds of each phase: paths (building the path graph),
+    shorts (detect_shorts), step (stepping) and update (IncrementalSimulator.update).
+    '''
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.steps = 0
+        self.propagate_calls = 0        # Calls of _propagate_current
+        self.pins_visited = 0           # Pins whose components were checked, over all steps
+        self.last_step_pins = 0
+        self.path_nodes = 0             # Size of the last path graph built
+        self.path_edges = 0
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def record_step(self, pins, calls):
+        self.steps += 1
+        self.pins_visited += pins
+        self.last_step_pins = pins
+        self.propagate_calls += calls
+
+    def record_paths(self, paths):
+        edges = list(paths.edges())
+        self.path_edges = len(edges)
+        self.path_nodes = len({p for e in edges for p in e})
+
+    def summary(self):
+        '''The stats as lines of text.'''
+        lines = [f'{name}: {t * 1000:.1f} ms' for name, t in self.times.items()]
+        lines.append(f'steps: {self.steps}, propagate calls: {self.propagate_calls}')
+        lines.append(f'pins last step: {self.last_step_pins}, '
+                     f'per step: {self.pins_visited / self.steps if self.steps else 0:.1f}')
+        lines.append(f'path graph: {self.path_nodes} pins, {self.path_edges} edges')
+        return lines
+
+def enable_stats(circuit=None):
+    '''Starts collecting SimulationStats for the circuit and returns them.'''
+    circuit = _resolve(circuit)
+    circuit.stats = SimulationStats()
+    return circuit.stats
+
+def disable_stats(circuit=None):
+    _resolve(circuit).stats = None
+
+def _phase(circuit, name):
+    return nullcontext() if circuit.stats is None else circuit.stats.phase(name)
+
+def _pin(i):
+    # Property for p1, p2, ...
+    def get(self):
+        try:
+            return self.ps[i]
+        except IndexError:
+            raise AttributeError(f'p{i + 1}') from None
+    return property(get)
+
+def _current(i):
+    # Property for v1, v2, ...: the current at that pin
+    def get(self):
+        try:
+            return self.circuit.pct.buffer[self.ids[i]]
+        except IndexError:
+            raise AttributeError(f'v{i + 1}') from None
+    return property(get)
+
+class _default:
+    '''A class attribute that a component's attrs can override, e.g. lamp(1, 2, resistance=2).'''
+    def __init__(self, value):
+        self.value = value
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, c, owner=None):
+        if c is None: return self.value
+        return c.attrs.get(self.name, self.value)
 
 class component:
     '''Superclass of all electrical components.
@@ -18,27 +294,47 @@ class component:
        (1, 4, 7)
        >>> c.radius
        2
+
+    Components have no __dict__. p1, p2, ... are the pins, v1, v2, ... the currents at them and
+    attrs are looked up in attrs, all computed on access. ids are the pins' integer ids in the
+    circuit. Subclasses give defaults for resistance and delay (the propagation delay used by
+    timing.TimingSimulator), which attrs override.
     '''
     # Class attrs are set in component.reset_class
-    def __init__(self, *ps, **attrs):
-        self.sid = component.sid      # TODO investigate whether the sid is going up after resets
+    __slots__ = ('ps', 'ids', 'attrs', 'fec', 'on', 'sid', 'circuit')
+    p1, p2, p3 = _pin(0), _pin(1), _pin(2)
+    v1, v2, v3 = _current(0), _current(1), _current(2)
+
+    def __init__(self, *ps, circuit=None, **attrs):
         self.ps = ps
         self.attrs = attrs
         self.fec = None
-        component.sid += 1
-        component.register[self.sid] = self
-        for p in ps: component.pcd[p].add(self)
-        for _i, v in enumerate(ps):
-            i = _i + 1
-            setattr(self, f'p{i}', v)
-            setattr(self, f'v{i}', property(lambda self, name=f'p{i}': components.pct[getattr(self, name)]))
+        self.circuit = _resolve(circuit)
         self.on = False
-        for k, v in attrs.items():
-            setattr(self, k, v)
+        self.circuit.add(self)
+
+    def __getattr__(self, name):
+        # Only reached when normal lookup fails: pins and currents past the third, and attrs
+        kind, n = name[:1], name[1:]
+        if kind in ('p', 'v') and n.isdigit() and 0 < int(n) <= len(self.ps):
+            p = self.ps[int(n) - 1]
+            return p if kind == 'p' else self.circuit.pct[p]
+        if name != 'attrs' and name in self.attrs:
+            return self.attrs[name]
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
 
     def __repr__(self):
         return f'{type(self).__name__}({" ".join(map(str, self.ps))} | {str(self.attrs)})'
 
+    def record(self):
+        '''(type name, pins, attrs), as in Circuit.describe and netlists.'''
+        return type(self).__name__, self.ps, self.attrs
+
+    def __hash__(self):
+        # Hash by id so the order components sit in pcd, and with it the sweep order, is the
+        # same in every process
+        return self.sid
+
     def get_connections(self):
         '''Gets all connected components.
 
@@ -51,7 +347,7 @@ class component:
            >>> assert a is c1 and b is c2
         '''
         for p in self.ps:
-            yield from filter(lambda s: s is not self, component.pcd[p])
+            yield from filter(lambda s: s is not self, self.circuit.pcd[p])
 
     def get_connected_pins(self, p) -> list:
         '''Gets the pins connected to the current pin and are part of this component. Example:
@@ -82,46 +378,60 @@ class component:
         '''
         raise NotImplementedError
 
+    def propagate_bits(self, mask, *Is) -> list:
+        '''Bit-parallel version of propagate_current. Bit i of each current is the current in
+        input vector i, and mask has the bits of the vectors this component runs in (bits outside
+        mask are ignored). Example:
+
+            >>> t = transistor(1, 2, 3)
+            >>> t.propagate_bits(0b11, 0b11, 0b01, 0b00)
+            [3, 1, 1]
+
+        Should be overridden in subclasses.
+        '''
+        raise NotImplementedError
+
     def _propagate_current(self):
         # Automatically called propagate_current using currents from pct
         # Regular propagate current, but it also updates pct
-        cl = self.propagate_current(*map(component.pct.get, self.ps))
-        for p, c in zip(self.ps, cl):
-            component.pct[p] = c
+        pct = self.circuit.pct.buffer
+        cl = self.propagate_current(*[pct[i] for i in self.ids])
+        for i, c in zip(self.ids, cl):
+            pct[i] = c
 
-    @classmethod
-    def get_component(klass, sid):       # TODO: change classmethod to staticmethod
-        '''Looks up a component in the register based on the given ID. Example:
+    @staticmethod
+    def get_component(sid):
+        '''Looks up a component in the register of the current circuit based on the given ID.
+        Example:
 
             >>> w = wire(0, 1)
             >>> c = component.get_component(1)
             >>> c is w
             True
         '''
-        return klass.register[sid]
+        return Circuit.current().get_component(sid)
     
-    @classmethod
-    def get_sources(klass):
-        '''Gets the pin locations of all positive terminals. Example:
+    @staticmethod
+    def get_sources():
+        '''Gets the pin locations of all positive terminals in the current circuit. Example:
 
             >>> t = terminal(0, voltage=5)
             >>> w = wire(0, 2)
             >>> list(component.get_sources())
             [0]
         '''
-        for v in klass.register.values():
-            if type(v) is terminal and v.voltage > 0:
-                yield v.p1
+        return Circuit.current().get_sources()
     
     @classmethod
     def reset_class(klass):
-        '''Resets all class attributes'''
+        '''Replaces the default circuit with an empty one. The class attributes register, pcd
+        and pct (and lamp.lamp_register) are the tables of the default circuit.'''
         assert klass is component
-        klass.sid = 1
-        klass.register = {}
-        klass.pcd = defaultdict(lambda: set())    # Pin component dictionary
-        klass.pct = defaultdict(lambda: 0)        # Pin current table
-        lamp.lamp_sid = 1
+        Circuit.default = c = Circuit()
+        klass.register = c.register
+        klass.pcd = c.pcd
+        klass.pct = c.pct
+        lamp.lamp_register = c.lamp_register
     
     @staticmethod
     def get_terminal_voltage(node):
@@ -133,15 +443,13 @@ class component:
             >>> v
             5
         '''
-
-        try:
-            return next(filter(lambda c: type(c) is terminal, component.pcd[node])).voltage
-        except StopIteration:
-            return None
+        return Circuit.current().get_terminal_voltage(node)
 
 class terminal(component):     # voltage
     '''Class for both positive terminals and ground.'''
-    resistance = 0
+    __slots__ = ()
+    resistance = _default(0)
+    delay = _default(0)
         
     def get_connected_pins(self, p):
         #if p == 'start':
@@ -151,29 +459,44 @@ class terminal(component):     # voltage
     def propagate_current(self, i):
         return [1]
 
+    def propagate_bits(self, mask, i):
+        return [mask]
+
 class wire(component):
     '''Class for wires, which allow current to flow from one point to another.'''
-    resistance = 0
+    __slots__ = ()
+    resistance = _default(0)
+    delay = _default(0)
 
     def get_connected_pins(self, p):
-        if p == self.p1: return [self.p2]
-        else: return [self.p1]
+        p1, p2 = self.ps
+        if p == p1: return [p2]
+        else: return [p1]
     
     def propagate_current(self, i1, i2):
         if i1 == 0: return [i2, i2]
         else: return [i1, i1]
 
+    def propagate_bits(self, mask, i1, i2):
+        return [i1 | i2, i1 | i2]
+
 class diode(wire):
     '''Class for diodes, which act like one-directional wires.'''
-    resistance = 0
+    __slots__ = ()
+    resistance = _default(0)
+    delay = _default(1)
 
     def get_connected_pins(self, p):
-        if p == self.p1: return [self.p2]
+        p1, p2 = self.ps
+        if p == p1: return [p2]
         else: return []
     
     def propagate_current(self, i1, i2):
         return [i1, i1]
 
+    def propagate_bits(self, mask, i1, i2):
+        return [i1, i1]
+
 class transistor(component):
     '''Class for transistors, which allow current to flow from the collector to the emitter 
     and from the base to the emitter if the base is in contact with positive current.
@@ -182,10 +505,12 @@ class transistor(component):
     
     1 is the collector, 2 is the base, 3 is the emitter.
     '''
-    resistance = 0
+    __slots__ = ()
+    resistance = _default(0)
+    delay = _default(2)
 
     def get_connected_pins(self, p):
-        if RUNNING:
+        if self.circuit.running:
             match p:
                 case self.p1:
                     return [self.p3] if self.v2 else []
@@ -201,13 +526,23 @@ class transistor(component):
             return [i1, i2, i1]
         return [i1, i2, i3]
 
+    def propagate_bits(self, mask, i1, i2, i3):
+        return [i1, i2, (i2 & i1) | (~i2 & i3)]
+
 class button(wire):      # TODO TODO get_connected_pins conditional on button press
     '''Class for buttons, which behave like wires when pressed but do not let current flow through
     otherwise.'''
-    resistance = 0
-    def __init__(self, *ps, **kwargs):
+    __slots__ = ()
+    resistance = _default(0)
+    delay = _default(0)
+    def __init__(self, *ps, on=False, **kwargs):
         super().__init__(*ps, **kwargs)
-        self.on = False
+        self.on = on
+
+    def record(self):
+        # A pressed button is written with on=True, so it is pressed again when read back
+        name, ps, attrs = super().record()
+        return name, ps, {**attrs, 'on': True} if self.on else attrs
 
     def get_connected_pins(self, p):
         if self.on:
@@ -215,29 +550,183 @@ class button(wire):      # TODO TODO get_connected_pins conditional on button pr
         return []
 
 class lamp(wire):      # FIXME: source and dest are same pin? Fix issue.
-    lamp_sid = 1
-    resistance = 1
-    lamp_register = {}
     '''Class for lamps, which behave like resistors but also emit light when current flows through.'''
-    def __init__(self, *ps, **kwargs):
-        super().__init__(*ps, **kwargs)
-        self.lamp_sid = lamp.lamp_sid
-        lamp.lamp_sid += 1
-        self.on = False
-        lamp.lamp_register[self.lamp_sid] = self
+    __slots__ = ('lamp_sid', 'on_bits')
+    resistance = _default(1)
+    delay = _default(1)
+    lamp_register = {}
+
+    def __init__(self, *ps, circuit=None, **kwargs):
+        circuit = _resolve(circuit)
+        self.lamp_sid = circuit.lamp_sid
+        circuit.lamp_sid += 1
+        circuit.lamp_states.append(0)
+        super().__init__(*ps, circuit=circuit, **kwargs)
+        self.on_bits = 0        # Lamp state per input vector, see propagate_bits
+        circuit.lamp_register[self.lamp_sid] = self
+
+    @property
+    def on(self):
+        # Kept in the circuit's lamp_states, so the states of all lamps are one byte string
+        return bool(self.circuit.lamp_states[self.lamp_sid - 1])
+
+    @on.setter
+    def on(self, on):
+        self.circuit.lamp_states[self.lamp_sid - 1] = 1 if on else 0
+
     def propagate_current(self, i1, i2):
         r = super().propagate_current(i1, i2)
-        if r[0]:
-            # print(f'light {self.lamp_sid} on')
-            self.on = True
-        else:
-            # print(f'light {self.lamp_sid} off')
-            self.on = False
+        self.on = bool(r[0])
+        return r
+
+    def propagate_bits(self, mask, i1, i2):
+        r = super().propagate_bits(mask, i1, i2)
+        self.on_bits = (r[0] & mask) | (self.on_bits & ~mask)
+        return r
+
+class BlockDefinition:
+    '''A subcircuit that block components are instances of. description is a circuit description
+    (see Circuit.describe) without terminals, and ports are the pins of it that the pins of a
+    block connect to, in order. Example:
+
+        >>> d = define_block('two_lamps', [('lamp', ('a', 'm'), {}), ('lamp', ('m', 'b'), {})], ('a', 'b'))
+        >>> t1 = terminal(0, voltage=1)
+        >>> b = block(0, 1, name='two_lamps')
+        >>> t2 = terminal(1, voltage=0)
+        >>> settle(get_all_paths_from_positive()).status.value, b.on, b.lit
+        ('converged', True, b'\\x01\\x01')
+
+    The inside of a block runs on the path graph from each of its ports to the others, as if
+    current could go in at any port and out at any other, with the currents at its ports as
+    inputs. Parts inside that lead nowhere but back to one port stay off. All the instances of a
+    definition share its inner circuit, which only one thread runs at a time, and results are
+    memoized by the currents at the ports, so instances with the same inputs are only simulated
+    once. A block's resistance is 0 if two of its ports are joined by components with no
+    resistance, and 1 otherwise.
+    '''
+    def __init__(self, name, description, ports):
+        self.name = name
+        self.description = [(n, tuple(ps), dict(attrs)) for n, ps, attrs in description]
+        self.ports = tuple(ports)
+        self.circuit = Circuit.from_description(self.description)
+        cs = list(self.circuit.register.values())
+        if any(type(c) is terminal for c in cs):
+            raise ValueError(f'block {name!r} contains a terminal, its ports are its connections')
+        missing = [p for p in self.ports if p not in self.circuit.pin_ids]
+        if missing:
+            raise ValueError(f'ports {missing} of block {name!r} are not pins of it')
+        self.port_ids = [self.circuit.pin_ids[p] for p in self.ports]
+        es = {(p, q): c for c in cs for p in c.ps for q in c.get_connected_pins(p) if q != p}
+        paths = set()
+        for p in dict.fromkeys(self.ports):     # Current goes in at one port and out at another
+            others = set(self.ports) - {p}
+            if not others: continue
+            forward, backward = _live_sets(self.circuit, {p}, others)
+            paths |= _path_edges(forward, backward, self.circuit, {p}, others)
+        self.paths = DirectedGraph.from_edges(paths)
+        self.connections = [self._reachable(p, es) for p in self.ports]
+        free = {e: c for e, c in es.items() if not c.resistance}
+        self.resistance = 0 if any(self._reachable(p, free) != [] for p in self.ports) else 1
+        self.inner = [c for c in cs if type(c) is block]
+        self.memo = {}          # Currents at the ports -> evaluate's result
+        self.lock = threading.Lock()        # Held while the inner circuit runs
+
+    def _reachable(self, p, es):
+        # Indices of the other ports p reaches along es
+        succ = defaultdict(list)
+        for a, b in es: succ[a].append(b)
+        seen, todo = {p}, [p]
+        while todo:
+            for q in succ[todo.pop()]:
+                if q not in seen:
+                    seen.add(q)
+                    todo.append(q)
+        return [j for j, q in enumerate(self.ports) if q in seen and q != p]
+
+    def evaluate(self, Is):
+        '''The currents at the ports, the states of the inner lamps and whether anything inside is
+        lit, after running the inside with the currents Is at the ports.'''
+        key = tuple(Is)
+        r = self.memo.get(key)
+        if r is not None:
+            return r
+        with self.lock:
+            r = self.memo.get(key)      # Another thread may have run it while this one waited
+            if r is None:
+                c = self.circuit
+                c.pct.clear()
+                c.lamp_states[:] = bytes(len(c.lamp_states))
+                for i, v in zip(self.port_ids, Is):
+                    if v: c.pct.buffer[i] = v
+                settle(self.paths, circuit=c)
+                lit = bytes(c.lamp_states)
+                r = self.memo[key] = (tuple([c.pct.buffer[i] for i in self.port_ids]), lit,
+                                      any(lit) or any(b.on for b in self.inner))
         return r
 
+blocks = {}             # Name -> BlockDefinition, where block components find their definition
+
+def define_block(name, description, ports):
+    '''Adds a BlockDefinition to blocks and returns it. A name can only be defined again with
+    the same description and ports, which returns the existing definition.'''
+    d = BlockDefinition(name, description, ports)
+    old = blocks.get(name)
+    if old is None:
+        blocks[name] = d
+        return d
+    if (old.description, old.ports) != (d.description, d.ports):
+        raise ValueError(f'block {name!r} is already defined differently')
+    return old
+
+class block(component):
+    '''A subcircuit placed as one component, e.g. block(1, 2, name='two_lamps') for the
+    definition of that name in blocks. Its pins connect to the definition's ports in order. on is
+    whether any lamp inside it (or inside the blocks in it) is lit, and lit holds the states of
+    the lamps directly inside.'''
+    __slots__ = ('lit', 'on_bits')
+    delay = _default(1)
+
+    def __init__(self, *ps, name, **kwargs):
+        d = blocks[name]
+        if len(ps) != len(d.ports):
+            raise TypeError(f'block {name!r} has {len(d.ports)} pins, got {len(ps)}')
+        super().__init__(*ps, name=name, **kwargs)
+        self.lit = bytes(len(d.circuit.lamp_states))
+        self.on_bits = 0        # Like lamp.on_bits, whether the block is on per input vector
+
+    @property
+    def definition(self):
+        return blocks[self.attrs['name']]
+
+    @property
+    def resistance(self):
+        return self.definition.resistance
+
+    def get_connected_pins(self, p):
+        ps, connections = self.ps, self.definition.connections
+        return [ps[j] for i, q in enumerate(ps) if q == p for j in connections[i]]
+
+    def propagate_current(self, *Is):
+        r, self.lit, self.on = self.definition.evaluate(Is)
+        return list(r)
+
+    def propagate_bits(self, mask, *Is):
+        # The inside only runs on single currents, so each vector in mask is run on its own
+        d, outs, on = self.definition, [0] * len(Is), 0
+        for i in range(mask.bit_length()):
+            if not mask >> i & 1: continue
+            r, lit, o = d.evaluate([v >> i & 1 for v in Is])
+            for k, v in enumerate(r):
+                outs[k] |= v << i
+            on |= o << i
+        self.on_bits = (on & mask) | (self.on_bits & ~mask)
+        return outs
+
 component.reset_class()
 
-def _get_all_paths(pin, history=[]):
+component_types = {k.__name__: k for k in (terminal, wire, diode, transistor, button, lamp, block)}
+
+def _get_all_paths(pin, history=[], circuit=None):
     '''Returns lists of all paths that positive current could travel through, going from a positive 
     terminal to the ground. Example:
 
@@ -249,70 +738,1025 @@ def _get_all_paths(pin, history=[]):
         [[0, 2, 3]]
 
     '''
+    circuit = _resolve(circuit)
     new_history = history + [pin]
-    if component.get_terminal_voltage(pin) == 0 or component in history[:-1]:
+    if circuit.get_terminal_voltage(pin) == 0 or component in history[:-1]:
         return [new_history]
-    return cfi(_get_all_paths(p, new_history) for p in cfi(c.get_connected_pins(pin) for c in component.pcd[pin]) if p not in new_history)
+    return cfi(_get_all_paths(p, new_history, circuit) for p in cfi(c.get_connected_pins(pin) for c in circuit.pcd[pin]) if p not in new_history)
+
+def get_all_paths(pin, circuit=None):
+    return DirectedGraph.from_list_of_lists(_get_all_paths(pin, circuit=circuit))
+
+def _get_all_paths_from_positive(circuit=None):
+    # Old enumerator, kept as the reference for build_path_graph
+    circuit = _resolve(circuit)
+    return DirectedGraph.union(*(get_all_paths(s, circuit) for s in circuit.get_sources()))
+
+def _pin_edges(circuit, sources, grounds):
+    # Every step current can take between two pins. Paths stop at ground and never run back
+    # into a positive terminal, so those edges are left out.
+    es = set()
+    for p, cs in circuit.pcd.items():
+        if p in grounds: continue
+        for c in cs:
+            es.update((p, q) for q in c.get_connected_pins(p) if q != p and q not in sources)
+    return es
+
+def _component_edges(c, sources, grounds):
+    # The edges of _pin_edges that come from c
+    return {(p, q) for p in c.ps if p not in grounds
+            for q in c.get_connected_pins(p) if q != p and q not in sources}
+
+def _connected_pins(c, p, masks, full):
+    # c.get_connected_pins(p), each pin paired with the bitmask of the vectors the connection
+    # exists in, masks giving the vectors each button is pressed in
+    if c in masks:
+        return [(q, masks[c]) for q in wire.get_connected_pins(c, p)]
+    return [(q, full) for q in c.get_connected_pins(p)]
+
+def _edge_masks(circuit, masks, full, sources, grounds):
+    # The edges of _pin_edges, each with the vectors it exists in (see _connected_pins)
+    es = defaultdict(int)
+    for p, cs in circuit.pcd.items():
+        if p in grounds: continue
+        for c in cs:
+            for q, m in _connected_pins(c, p, masks, full):
+                if q != p and q not in sources:
+                    es[p, q] |= m
+    return es
+
+def _live_edges(starts, adj):
+    # Marks every edge (a, b) that can be reached from a start pin by a walk that never turns
+    # straight back around, walking the graph the way adj describes (adj[b] are the pins b
+    # leads on to). Each pin remembers the first pin it was entered from; once it has been
+    # entered from two different pins every onward edge is live, so each pin is handled at
+    # most twice and the whole pass is O(V+E).
+    live = set()
+    first = {}
+    todo = deque((s, b) for s in starts for b in adj[s])
+    for s in starts: first[s] = None          # Start pins behave as if entered from nowhere
+    while todo:
+        a, b = e = todo.popleft()
+        if e in live: continue
+        live.add(e)
+        if b not in first:
+            first[b] = a
+            todo.extend((b, c) for c in adj[b] if c != a)
+        elif first[b] is not None and first[b] != a:
+            if first[b] in adj[b]: todo.append((b, first[b]))
+            first[b] = None
+    return live
+
+def _biconnected(adj, root):
+    # Tarjan's algorithm over the undirected adjacency adj from root. Returns the biconnected
+    # components found, each as a set of edges (frozensets of their two pins), and the pins
+    # reached with their discovery order.
+    index, low, found, blocks = {root: 0}, {root: 0}, [], []
+    work = [(root, None, iter(adj[root]))]
+    while work:
+        v, parent, ws = work[-1]
+        for w in ws:
+            if w == parent: continue
+            if w not in index:
+                index[w] = low[w] = len(index)
+                found.append((v, w))
+                work.append((w, v, iter(adj[w])))
+                break
+            if index[w] < index[v]:
+                found.append((v, w))
+                low[v] = min(low[v], index[w])
+        else:
+            work.pop()
+            if not work: continue
+            u = work[-1][0]
+            low[u] = min(low[u], low[v])
+            if low[v] >= index[u]:      # u cuts off everything found since (u, v)
+                es = set()
+                while True:
+                    e = found.pop()
+                    es.add(frozenset(e))
+                    if e == (u, v): break
+                blocks.append(es)
+    return blocks, index
 
-def get_all_paths(pin):
-    return DirectedGraph.from_list_of_lists(_get_all_paths(pin))
+def _simple_path_edges(edges, sources, grounds):
+    # The edges that lie on a simple path from a source to a ground when every edge can be
+    # taken both ways. With one pin S joined to the sources and one pin T to the grounds, those
+    # are the edges of the biconnected components on the way from S to T in the block-cut tree.
+    # Tarjan's algorithm finds the components in O(V+E).
+    S, T = object(), object()
+    adj = defaultdict(set)
+    for a, b in it.chain(edges, ((S, s) for s in sources), ((g, T) for g in grounds)):
+        if a != b:
+            adj[a].add(b)
+            adj[b].add(a)
+    blocks, index = _biconnected(adj, S)
+    if T not in index:
+        return set()
+    pins = [{p for e in es for p in e} for es in blocks]
+    block_of = {e: k for k, es in enumerate(blocks) for e in es}
+    blocks_at = defaultdict(list)
+    for k, ps in enumerate(pins):
+        for p in ps: blocks_at[p].append(k)
+    came, via = {S: None}, {}        # Breadth-first through the block-cut tree from S to T
+    todo = deque([S])
+    while T not in came:
+        p = todo.popleft()
+        for k in blocks_at[p]:
+            if k in via: continue
+            via[k] = p
+            for q in pins[k]:
+                if q not in came:
+                    came[q] = k
+                    todo.append(q)
+    on_way, p = set(), T
+    while p is not S:
+        on_way.add(came[p])
+        p = via[came[p]]
+    return {e for e in edges if block_of.get(frozenset(e)) in on_way}
 
-def get_all_paths_from_positive():
-    return reduce(DirectedGraph.union, map(get_all_paths, component.get_sources()))
+def _can_dangle(edges, sources, grounds):
+    # Whether the forward and backward passes could keep an edge no simple path takes, for the
+    # edges or any subset of them. Without a cycle a walk that never turns straight back is a
+    # simple path, so the passes alone are exact.
+    ds, ends = DisjointSet(), (object(), object())
+    for a, b in it.chain(((ends[0], s) for s in sources), ((g, ends[1]) for g in grounds),
+                         {frozenset(e) for e in edges if e[0] != e[1]}):
+        if ds.find(a) == ds.find(b): return True
+        ds.union(a, b)
+    return False
 
-def crbap(p1, p2):      # Calculate resistance between adjacent pins
-    cs = [c for c in component.pcd[p1] if c in component.pcd[p2]]
+def _hanging_removed(es, sources, grounds):
+    # es less the edges that only walks through a loop hanging off the rest of the circuit use
+    if not _can_dangle(es, sources, grounds):
+        return set(es)
+    return _simple_path_edges(es, sources, grounds)
+
+class _HangingMasks:
+    # _simple_path_edges for many subsets of one set of undirected edges at once, each edge
+    # carrying a bitmask of the subsets it's in. Chains and parallel edges are folded into single
+    # edges once, up front: an edge of a chain is on a simple path from S to T where the whole
+    # chain is, an edge parallel to others where any of them is, and the edge of a pin with no
+    # other edges never. That usually leaves one edge from S to T. Whatever else is left goes
+    # through _simple_path_edges once per distinct subset of it.
+    def __init__(self, pairs, sources, grounds):
+        S, T = self.S, self.T = object(), object()
+        self.size = len(pairs)
+        self.ends = ends = [*pairs, *((S, s) for s in sources), *((g, T) for g in grounds)]
+        self.folds = []         # (edge, op, edge), the folded edge getting the next id
+        at = defaultdict(dict)  # Pin -> {edge: pin at its other end}
+        for k, (a, b) in enumerate(ends):
+            at[a][k] = b
+            at[b][k] = a
+        def fold(j, op, k, a, b):
+            for e in j, k:
+                x, y = ends[e]
+                del at[x][e], at[y][e]
+            n = len(ends)
+            ends.append((a, b))
+            at[a][n], at[b][n] = b, a
+            self.folds.append((j, op, k))
+            return n
+        todo = list(at)
+        while todo:
+            x = todo.pop()
+            if x is S or x is T or x not in at: continue
+            es, to = at[x], {}
+            for k, y in list(es.items()):
+                if y in to:
+                    to[y] = fold(to[y], '|', k, x, y)
+                    todo.append(y)
+                else:
+                    to[y] = k
+            if len(es) == 1:
+                (k, y), = es.items()
+                del at[y][k]
+                todo.append(y)
+            elif len(es) == 2:
+                (j, a), (k, b) = es.items()
+                fold(j, '&', k, a, b)
+                todo += [a, b]
+            if len(es) < 3: del at[x]
+        to = {}
+        for k in sorted({k for es in at.values() for k in es}):
+            e = frozenset(ends[k])
+            to[e] = fold(to[e], '|', k, *ends[k]) if e in to else k
+        self.core = list(to.values())
+        self.memo = {}
+
+    def kept(self, masks, full):
+        '''The masks of the edges after the subsets' hanging loops are taken out, given the masks
+        they come with.'''
+        m = [*masks, *it.repeat(full, len(self.ends) - self.size - len(self.folds))]
+        for j, op, k in self.folds:
+            m.append(m[j] | m[k] if op == '|' else m[j] & m[k])
+        kept = [0] * len(m)
+        groups = [full]         # The subsets, as masks, that are the same on every core edge
+        for k in self.core:
+            groups = [h for g in groups for h in (g & m[k], g & ~m[k]) if h]
+        for g in groups:
+            for k in self.core_kept(tuple(k for k in self.core if m[k] & g)):
+                kept[k] |= g
+        base = len(m) - len(self.folds)
+        for n, (j, op, k) in reversed(list(enumerate(self.folds, base))):
+            kept[j] = kept[n] & m[j]
+            kept[k] = kept[n] & m[k]
+        return kept[:self.size]
+
+    def core_kept(self, present):
+        '''The edges among the core edges present that are on a simple path from S to T.'''
+        if present not in self.memo:
+            es = {self.ends[k]: k for k in present}
+            self.memo[present] = [es[e] for e in _simple_path_edges(es, {self.S}, {self.T})]
+        return self.memo[present]
+
+def _path_edges(forward, backward, circuit, sources=None, grounds=None):
+    # The path graph's edges out of the live sets of _live_sets
+    if sources is None: sources = set(circuit.get_sources())
+    if grounds is None: grounds = {p for p in circuit.pcd if circuit.get_terminal_voltage(p) == 0}
+    return _hanging_removed(forward & backward, sources, grounds)
+
+def build_path_graph(circuit=None, graph=DirectedGraph):
+    '''Builds the graph of every edge positive current could take from a positive terminal to
+    the ground in O(V+E), without listing the paths. Drop-in for get_all_paths_from_positive.
+    Example:
+
+        >>> t1 = terminal(0, voltage=5)
+        >>> w = wire(0, 2)
+        >>> l = lamp(2, 3)
+        >>> t2 = terminal(3, voltage=0)
+        >>> sorted(build_path_graph().edges())
+        [connection(from_=0, to=2), connection(from_=2, to=3)]
+
+    An edge is kept if a forward pass from the sources and a backward pass from the grounds
+    both reach it without doubling back, and if it lies in a biconnected component between the
+    sources and the grounds. The second check drops loops hanging off the circuit by a single
+    pin, which the passes reach but no simple path uses. The graph holds every edge the old path
+    enumerator finds, but the walk to an edge and the walk on from it may share a pin, so inside
+    a loop between the sources and the grounds it can also hold an edge no simple path takes in
+    that direction. In a circuit of wires, buttons and lamps such an edge is always the reverse
+    of one a simple path takes; with diodes and transistors no simple path may take it either way.
+
+    graph is the graph class to build, e.g. graph.CSRGraph for large circuits that are only read.
+    '''
+    circuit = _resolve(circuit)
+    forward, backward = _live_sets(circuit)
+    with _phase(circuit, 'paths'):
+        paths = graph.from_edges(_path_edges(forward, backward, circuit))
+    if circuit.stats is not None:
+        circuit.stats.record_paths(paths)
+    return paths
+
+def _live_sets(circuit, sources=None, grounds=None):
+    # The edges live in the forward pass from the sources and in the backward pass from the
+    # grounds (the circuit's terminals by default). The path graph is the edges in both.
+    if sources is None: sources = set(circuit.get_sources())
+    if not sources:
+        raise TypeError('circuit has no positive terminals')
+    with _phase(circuit, 'paths'):
+        if grounds is None:
+            grounds = {p for p in circuit.pcd if circuit.get_terminal_voltage(p) == 0}
+        es = _pin_edges(circuit, sources, grounds)
+        succ, pred = defaultdict(set), defaultdict(set)
+        for a, b in es:
+            succ[a].add(b)
+            pred[b].add(a)
+        forward = _live_edges(sources, succ)
+        backward = {(a, b) for b, a in _live_edges(grounds, pred)}
+    return forward, backward
+
+def get_all_paths_from_positive(circuit=None):
+    return build_path_graph(circuit)
+
+def crbap(p1, p2, circuit=None):      # Calculate resistance between adjacent pins
+    pcd = _resolve(circuit).pcd
+    cs = [c for c in pcd[p1] if c in pcd[p2]]
     if all(c.resistance for c in cs):
         return 1
     return 0
 
-def calculate_resistance(p: list[int]):
-    return any(crbap(p1, p2) for p1, p2 in zip(p, p[1:]))
+def calculate_resistance(p: list[int], circuit=None):
+    return any(crbap(p1, p2, circuit) for p1, p2 in zip(p, p[1:]))
+
+short = namedtuple('short', 'source ground components')
 
-def greatest_prefix(path1, path2):       # FIXME: make faster
-    for p1 in path1[::-1]:
-        for p2 in path2[::-1]:
-            if p1 == p2:
-                return p1
+def detect_shorts(dg=None, s=None, circuit=None):
+    '''Finds positive terminals that reach ground through components with no resistance.
+    Returns a short for every ground pin reached, with the source pin it was reached from and the
+    ids of the components along the way. Example:
+
+        >>> t1 = terminal(0, voltage=1)
+        >>> w1 = wire(0, 1)
+        >>> w2 = wire(1, 2)
+        >>> t2 = terminal(2, voltage=0)
+        >>> detect_shorts()
+        [short(source=0, ground=2, components=[2, 3])]
+
+    Only the source s is checked if it is given, and only edges of the path graph dg are followed
+    if dg is given. One breadth-first pass over the pins, so O(V+E).
+    '''
+    circuit = _resolve(circuit)
+    with _phase(circuit, 'shorts'):
+        return _detect_shorts(dg, s, circuit)
 
-def detect_shorts(dg, s):     # TODO: use component.get_source to run on each source
-    d = defaultdict(lambda: [[]])     # TODO TODO TODO
-    layer = [s]                       # TODO TODO TODO
-    while layer:                      # TODO TODO TODO
+def _detect_shorts(dg, s, circuit):
+    sources = list(circuit.get_sources()) if s is None else [s]
+    prev = dict.fromkeys(sources)      # Pin -> (previous pin, component) on the way from a source
+    layer = list(prev)
+    shorts = []
+    while layer:
         new_layer = []
         for p in layer:
-            for px in dg.get_conns(p):
-                if px not in cfi(d[p]):
-                    temp_paths = [l + [px] for l in d[p]]
-                    if px in d:
-                        for path1 in d[px]:
-                            for path2 in temp_paths:
-                                cp = greatest_prefix(path1, path2)
-                    d[px] = [l + [px] for l in d[p]]
-                    print("d[px]", d[px])
-            new_layer.extend(x for x in dg.get_conns(p) if x not in cfi(d[p]))
-        print("new layer", new_layer)
+            if p not in sources and circuit.get_terminal_voltage(p) == 0:
+                cs, q = [], p
+                while prev[q] is not None:
+                    q, c = prev[q]
+                    cs.append(c.sid)
+                shorts.append(short(q, p, cs[::-1]))
+                continue
+            for c in circuit.pcd[p]:
+                if c.resistance or type(c) is terminal: continue
+                for q in c.get_connected_pins(p):
+                    if q not in prev and (dg is None or q in dg.get_conns(p)):
+                        prev[q] = (p, c)
+                        new_layer.append(q)
         layer = new_layer
-    print(d)
+    return shorts
 
-def propagate_current_at_pin(pin, paths):
-    cl = component.pcd[pin]
+def _propagates_at(c, pin, paths):
+    # Whether the sweep runs c when it visits pin
+    return type(c) is terminal or set(c.get_connected_pins(pin)).issubset(paths.get_conns(pin))
+
+def _sweep_runs(circuit, paths):
+    # Every component the sweep runs, in the order it runs them and once for every pin it runs
+    # at. Walks pcd's rows directly and looks up the connections of each pin only once.
+    pcd = circuit.pcd
+    if pcd.offsets is None: pcd._build()
+    comps, offsets, runs = pcd.comps, pcd.offsets, []
+    for i, p in enumerate(circuit.pins):
+        conns = paths.get_conns(p)
+        if not isinstance(conns, (set, frozenset)): conns = set(conns)
+        for k in range(offsets[i], offsets[i + 1]):
+            c = comps[k]
+            if type(c) is terminal or conns.issuperset(c.get_connected_pins(p)):
+                runs.append(c)
+    return runs
+
+def _propagate_at_pin(pin, cl, paths):
+    # Returns how many components ran
+    n = 0
     for c in cl:
-        pl = c.get_connected_pins(pin)
-        # print(pin, pl , paths.get_conns(pin))
-        if set(pl).issubset(paths.get_conns(pin)) or type(c) is terminal:
+        if _propagates_at(c, pin, paths):
+            c._propagate_current()
+            n += 1
+    return n
+
+def propagate_current_at_pin(pin, paths, circuit=None):
+    _propagate_at_pin(pin, _resolve(circuit).pcd[pin], paths)
+
+def propagate_current_step(paths: DirectedGraph, circuit=None):
+    circuit = _resolve(circuit)
+    if circuit.stats is None:
+        for p, cl in circuit.pcd.items():
+            _propagate_at_pin(p, cl, paths)
+    else:
+        with circuit.stats.phase('step'):
+            pins = calls = 0
+            for p, cl in circuit.pcd.items():
+                pins += 1
+                calls += _propagate_at_pin(p, cl, paths)
+        circuit.stats.record_step(pins, calls)
+    if circuit.trace is not None:
+        circuit.trace.record()
+
+class EventPropagator:
+    '''Event-driven replacement for propagate_current_step. Only components on pins whose
+    current changed are run again, so a circuit that has stopped changing costs nothing per
+    step. Example:
+
+        >>> t1 = terminal(0, voltage=1)
+        >>> l = lamp(0, 1)
+        >>> t2 = terminal(1, voltage=0)
+        >>> e = EventPropagator(get_all_paths_from_positive())
+        >>> while e.step(): pass
+        >>> l.on, e.step()
+        (True, 0)
+
+    Every pin starts out dirty, so the first step runs every component the sweep would.
+    Components run at the pins and in the order the sweep runs them, and a component is only
+    left out where one of its pins hasn't changed since it last ran, which is where the sweep
+    would run it without changing anything. Components that fight over a pin therefore end up
+    the same way, and every step leaves the circuit as propagate_current_step would.
+
+    Components can also undo each other within a step, as when a reversed diode takes the
+    current off a pin and a lamp after it puts it back, so the sweep keeps running them for good.
+    Once a step leaves every pin current and lamp as it found them, which is when settle calls
+    the circuit converged, steps run nothing until something is scheduled again.
+    '''
+    def __init__(self, paths: DirectedGraph, circuit=None):
+        self.paths = paths
+        self.circuit = _resolve(circuit)
+        # Positions of every component in the sweep, as (position, pin) for each pin it's on
+        self.positions, n = defaultdict(list), 0
+        for p, cl in self.circuit.pcd.items():
+            for c in cl:
+                self.positions[c].append((n, p))
+                n += 1
+        self.active = {}        # Component -> positions the sweep runs it at
+        for c in self.circuit.register.values():
+            self._check(c)
+        self.dirty = deque()
+        self.queued = set()
+        self.woken = set()
+        self.resting = False        # Whether the last step changed nothing in the end
+        self.schedule(*self.circuit.pcd)
+
+    def _check(self, c):
+        # Works out where the sweep runs c, which is nowhere if it isn't active
+        at = [n for n, p in self.positions[c] if _propagates_at(c, p, self.paths)]
+        if at: self.active[c] = at
+        else: self.active.pop(c, None)
+
+    def schedule(self, *pins):
+        '''Marks pins as changed so their components run in the next step.'''
+        self.resting = False
+        for p in pins:
+            if p not in self.queued:
+                self.queued.add(p)
+                self.dirty.append(p)
+
+    def wake(self, *components):
+        '''Marks components to run in the next step without running the rest of their pins.'''
+        self.resting = False
+        self.woken.update(components)
+
+    def notify(self, c):
+        '''Re-checks a component whose own state changed, e.g. a button that was pressed.'''
+        self._check(c)
+        self.schedule(*c.ps)
+
+    def set_paths(self, paths: DirectedGraph):
+        '''Swaps in a new path graph, only scheduling components that started or stopped
+        propagating because of it.'''
+        self.paths = paths
+        self.resting = False
+        was_active = set(self.active)
+        self.active = {}
+        for c in self.circuit.register.values():
+            self._check(c)
+        for c in self.active.keys() ^ was_active:
+            self.schedule(*c.ps)
+
+    def step(self):
+        '''Runs every active component on a dirty pin once and returns how many ran.'''
+        stats, trace = self.circuit.stats, self.circuit.trace
+        visited = list(self.dirty) if trace is not None else None
+        if stats is None:
+            calls, changed = self._step()[1:]
+        else:
+            with stats.phase('step'):
+                pins, calls, changed = self._step()
+            stats.record_step(pins, calls)
+        if trace is not None:
+            # Only the pins visited and those the step changed
+            trace.record(it.chain(visited, changed))
+        return calls
+
+    def _step(self):
+        # Returns the number of pins visited, of components run and the pins that changed
+        if self.resting:
+            return 0, 0, ()
+        pcd, pct, active = self.circuit.pcd, self.circuit.pct.buffer, self.active
+        stale, todo = set(), []     # todo is a heap of (position, component)
+        changed, lit = {}, {}       # Pin -> its id and current, lamp -> whether it was on
+        pins = len(self.dirty)
+        while self.dirty:
+            for c in pcd[self.dirty.popleft()]:
+                if c in active and c not in stale:
+                    stale.add(c)
+                    heappush(todo, (active[c][0], c))
+        for c in self.woken:
+            if c in active and c not in stale:
+                stale.add(c)
+                heappush(todo, (active[c][0], c))
+        self.queued.clear()
+        self.woken.clear()
+        calls = 0
+        while todo:
+            n, c = heappop(todo)
+            stale.discard(c)
+            before = [pct[i] for i in c.ids]
+            if isinstance(c, lamp) and c not in lit: lit[c] = c.on
             c._propagate_current()
+            calls += 1
+            for p, i, b in zip(c.ps, c.ids, before):
+                if pct[i] == b: continue
+                if p not in changed: changed[p] = i, b
+                # Everything on p runs again where the sweep next gets to it, in this step if
+                # that is after n and in the next step otherwise
+                for x in pcd[p]:
+                    at = active.get(x)
+                    if at is not None and x not in stale:
+                        stale.add(x)
+                        k = bisect_right(at, n)
+                        if k < len(at): heappush(todo, (at[k], x))
+                        else: self.schedule(p)
+        self.resting = (all(pct[i] == b for i, b in changed.values())
+                        and all(c.on == on for c, on in lit.items()))
+        return pins, calls, changed
+
+class settle_status(Enum):
+    CONVERGED = 'converged'
+    OSCILLATING = 'oscillating'
+    STEP_LIMIT = 'step limit'
+
+settle_result = namedtuple('settle_result', 'steps status')
+
+def _circuit_state(circuit):
+    # Everything a step can change: pin currents and lamp states
+    return (circuit.pct.buffer.tobytes(), bytes(circuit.lamp_states))
+
+def settle(paths: DirectedGraph, max_steps=1000, circuit=None):
+    '''Steps the circuit until a step changes nothing, a state repeats or max_steps steps
+    have been taken (never, if max_steps is None). Example:
+
+        >>> t1 = terminal(0, voltage=1)
+        >>> l = lamp(0, 1)
+        >>> t2 = terminal(1, voltage=0)
+        >>> settle(get_all_paths_from_positive())
+        settle_result(steps=2, status=<settle_status.CONVERGED: 'converged'>)
+        >>> l.on
+        True
+    '''
+    circuit = _resolve(circuit)
+    state = _circuit_state(circuit)
+    seen = {hash(state)}
+    for n in it.count(1) if max_steps is None else range(1, max_steps + 1):
+        propagate_current_step(paths, circuit)
+        new_state = _circuit_state(circuit)
+        if new_state == state:
+            return settle_result(n, settle_status.CONVERGED)
+        h = hash(new_state)
+        if h in seen:
+            return settle_result(n, settle_status.OSCILLATING)
+        seen.add(h)
+        state = new_state
+    return settle_result(max_steps, settle_status.STEP_LIMIT)
+
+def propagate_current(paths: DirectedGraph, circuit=None):
+    return settle(paths, max_steps=None, circuit=circuit)
+
+class CollapsedCircuit:
+    '''A copy of a circuit with every plain wire removed and the pins it joined merged into one
+    net. Buttons, diodes and transistors are kept since they don't always conduct.
+
+        >>> t1 = terminal(0, voltage=1)
+        >>> w1 = wire(0, 1)
+        >>> w2 = wire(1, 2)
+        >>> l = lamp(2, 3)
+        >>> t2 = terminal(3, voltage=0)
+        >>> cc = CollapsedCircuit()
+        >>> cc.circuit.describe()
+        [('terminal', (0,), {'voltage': 1}), ('lamp', (0, 3), {}), ('terminal', (3,), {'voltage': 0})]
+
+    nets maps every original pin to the pin of its net in the new circuit, and components maps
+    new component ids to original ones. settle_collapsed lights the lamps settle lights, except
+    those on no path from a positive terminal to a ground terminal that enters each net at most
+    once, where lamps and pressed buttons conduct either way, diodes from p1 to p2 and
+    transistors from p1 and p2 to p3. A lamp with both pins on one net is on no such path. The
+    unreduced engine can still light these by carrying current out of a net and back in. This
+    is exact unless a diode or transistor takes current off a pin while settling, since which
+    component wins then depends on sweep order.
+    '''
+    def __init__(self, circuit=None):
+        self.original = _resolve(circuit)
+        ds = DisjointSet()
+        for c in self.original.register.values():
+            if type(c) is wire: ds.union(c.p1, c.p2)
+        self.circuit = Circuit()
+        self.components = {}
+        for c in self.original.register.values():
+            if type(c) is wire: continue
+            r = type(c)(*map(ds.find, c.ps), circuit=self.circuit, **c.attrs)
+            r.on = c.on
+            self.components[r.sid] = c.sid
+        self.nets = {p: ds.find(p) for p in self.original.pcd}
+
+    def write_back(self):
+        '''Copies pin currents and lamp states of the collapsed circuit to the original.'''
+        pct = self.circuit.pct
+        for p, n in self.nets.items():
+            self.original.pct[p] = pct[n]
+        for sid, osid in self.components.items():
+            c = self.circuit.register[sid]
+            if isinstance(c, lamp):
+                self.original.register[osid].on = c.on
+
+def settle_collapsed(max_steps=1000, circuit=None):
+    '''Like settle, but runs on the circuit with its wires collapsed into nets and then writes the
+    results back. Builds the path graph itself.'''
+    cc = CollapsedCircuit(circuit)
+    r = settle(get_all_paths_from_positive(cc.circuit), max_steps, cc.circuit)
+    cc.write_back()
+    return r
+
+def _held_pins(circuit):
+    # Terminal pins that nothing but terminals, wires, buttons and lamps writes to, diodes and
+    # transistors only reading them. All of those only ever add current, so once its terminal
+    # has run such a pin has current for good.
+    def writes(c, p):
+        if type(c) is diode: return p == c.p2
+        if type(c) is transistor: return p == c.p3
+        return type(c) not in (terminal, wire, button, lamp)
+    return {p for p, cs in circuit.pcd.items()
+            if any(type(c) is terminal for c in cs) and not any(writes(c, p) for c in cs)}
+
+def _edge_cone(seeds, starts, succ):
+    # Every edge whose liveness (see _live_edges) can depend on the seed edges
+    cone = set()
+    todo = deque(seeds)
+    while todo:
+        e = a, b = todo.popleft()
+        if e in cone: continue
+        cone.add(e)
+        if b not in starts:
+            todo.extend((b, c) for c in succ[b] if c != a)
+    return cone
+
+def _relive(live, cone, starts, succ, pred):
+    # Redoes _live_edges for the edges in cone, given that edges outside it are already right
+    live -= cone
+    todo = deque((a, b) for a, b in cone if b in succ[a] and
+                 (a in starts or any((t, a) in live for t in pred[a] if t != b)))
+    while todo:
+        e = a, b = todo.popleft()
+        if e in live: continue
+        live.add(e)
+        if b not in starts:
+            todo.extend((b, c) for c in succ[b] if c != a and (b, c) in cone)
+
+class _BlockTree:
+    # The block-cut tree of _simple_path_edges for a set of live edges, kept up to date as edges
+    # come and go so that a change only costs the blocks it touches. The tree hangs from S: every
+    # block has the pin above it in up_block and every other pin the block above it in up_pin.
+    # Blocks that merge are joined in a DisjointSet; a block that loses edges is split again by
+    # running Tarjan's algorithm over its own edges. exit holds the blocks on the way from S to T
+    # and the pin the way leaves each by, and kept the live edges in them. Where edges only go,
+    # a block on the way can also stand for several blocks in a row on the way, which keep the
+    # same edges. Anything the tree can't follow locally, like a change cutting the circuit in
+    # two, builds it again from scratch.
+    def __init__(self, live, sources, grounds):
+        self.live, self.sources, self.grounds = live, sources, grounds
+        self.kept = set()
+        self._build()
+
+    def _build(self):
+        S, T = self.S, self.T = object(), object()
+        self.adj = adj = defaultdict(set)
+        for a, b in it.chain(self.live, ((S, s) for s in self.sources),
+                             ((g, T) for g in self.grounds)):
+            if a != b:
+                adj[a].add(b)
+                adj[b].add(a)
+        self.ids, self.ds = it.count(), DisjointSet()
+        self.edges_of, self.label, self.blocks_at = {}, {}, defaultdict(set)
+        self.up_block, self.up_pin, self.exit = {}, {}, {}
+        self.kept.clear()
+        blocks, index = _biconnected(adj, S)
+        self.ok = T in index        # Otherwise no edge is kept and every change starts over
+        if not self.ok: return
+        self._hang(S, {self._new_block(es) for es in blocks})
+        p = T
+        while p is not S:
+            k = self.up_pin[p]
+            self.exit[k] = p
+            self.kept.update(self._directed(self.edges_of[k]))
+            p = self.up_block[k]
+
+    def _new_block(self, es):
+        k = next(self.ids)
+        self.edges_of[k] = es
+        for e in es:
+            self.label[e] = k
+            for p in e: self.blocks_at[p].add(k)
+        return k
+
+    def _hang(self, p, ks):
+        # Hangs the blocks ks, and the pins in them, from pin p
+        seen, todo = {p}, deque([p])
+        while todo:
+            p = todo.popleft()
+            for k in self.blocks_at[p]:
+                if k not in ks or k in self.up_block: continue
+                self.up_block[k] = p
+                for q in {q for e in self.edges_of[k] for q in e} - seen:
+                    seen.add(q)
+                    self.up_pin[q] = k
+                    todo.append(q)
+
+    def _directed(self, es):
+        # The live edges among the undirected edges es
+        for e in es:
+            a, b = e
+            if (a, b) in self.live: yield a, b
+            if (b, a) in self.live: yield b, a
+
+    def _has(self, p):
+        return p is self.S or p in self.up_pin
+
+    def _drop(self, p):
+        # Takes a pin left without edges out of the tree
+        self.up_pin.pop(p, None)
+        self.blocks_at.pop(p, None)
+        self.adj.pop(p, None)
+
+    def update(self, added, removed):
+        '''Follows edges that became live or stopped being live, which self.live already shows.
+        Returns the edges that may have been kept or dropped.'''
+        touched = set(added) | set(removed)
+        if not self.ok:
+            return self._rebuild(touched)
+        self.kept.difference_update(removed)
+        gone, new = defaultdict(set), set()
+        for e in {frozenset(e) for e in removed if e[::-1] not in self.live and e[0] != e[1]}:
+            if e not in self.label:         # Not connected to S
+                return self._rebuild(touched)
+            a, b = e
+            self.adj[a].discard(b)
+            self.adj[b].discard(a)
+            gone[self.ds.find(self.label.pop(e))].add(e)
+        for a, b in added:
+            if a == b: continue
+            e = frozenset((a, b))
+            if e not in self.label: new.add(e)
+            elif self.ds.find(self.label[e]) in self.exit: self.kept.add((a, b))
+        for k, es in gone.items():
+            if not self._split(k, es, touched):
+                return self._rebuild(touched)
+        while new:          # Each edge once one of its pins is in the tree
+            joining = {e for e in new if any(map(self._has, e))}
+            if not joining or not all(self._join(e, touched) for e in joining):
+                return self._rebuild(touched)
+            new -= joining
+        return touched
+
+    def _rebuild(self, touched):
+        old = set(self.kept)
+        self._build()
+        return touched | (old ^ self.kept)
+
+    def _split(self, k, gone, touched):
+        # Takes the edges gone out of block k and splits what is left into blocks
+        es = self.edges_of[k]
+        es -= gone
+        u, v = self.up_block[k], self.exit.get(k)
+        ends = {p for e in gone for p in e}
+        lost = {p for p in ends if not self.adj[p]}
+        if u in lost or v in lost or any(set(map(self.ds.find, self.blocks_at[p])) != {k}
+                                           for p in lost):
+            return False
+        if v is not None and ends - lost <= {u, v} and all(
+                any(self.ds.find(self.label[frozenset((p, q))]) == k for q in self.adj[p])
+                for p in (u, v)):
+            # Only loops between the pins the way enters and leaves k by went, which leaves
+            # every edge left in k on the way
+            for p in lost: self._drop(p)
+            return True
+        sub = defaultdict(set)
+        for a, b in es:
+            sub[a].add(b)
+            sub[b].add(a)
+        blocks, index = _biconnected(sub, u) if u in sub else ([], {u: 0})
+        pins = {p for e in it.chain(es, gone) for p in e}
+        if any(p not in index and p not in lost for p in pins) or (v is not None and v not in index):
+            return False        # Something is cut off from S
+        del self.edges_of[k], self.up_block[k]
+        self.exit.pop(k, None)
+        for p in lost: self._drop(p)
+        ks = {self._new_block(b) for b in blocks}
+        for p in index:
+            self.blocks_at[p] = {j for j in map(self.ds.find, self.blocks_at[p]) if j != k}
+        self._hang(u, ks)
+        if v is not None:
+            p = v
+            while p != u:
+                j = self.up_pin[p]
+                self.exit[j] = p
+                p = self.up_block[j]
+            for j in ks - self.exit.keys():
+                for e in self._directed(self.edges_of[j]):
+                    self.kept.discard(e)
+                    touched.add(e)
+        return True
+
+    def _path(self, a, b):
+        # The blocks on the tree's path between pins a and b and the pin above them all, climbing
+        # from both ends at once until one reaches where the other has been. Nodes are (0, pin)
+        # and (1, block).
+        def up(node):
+            kind, x = node
+            if kind: return 0, self.up_block[x]
+            return None if x is self.S else (1, self.ds.find(self.up_pin[x]))
+        trails, seen = ([(0, a)], [(0, b)]), ({(0, a)}, {(0, b)})
+        while True:
+            meet = next((t[-1] for t, s in zip(trails, seen[::-1]) if t[-1] in s), None)
+            if meet is not None: break
+            moved = False
+            for t, s in zip(trails, seen):
+                node = up(t[-1])
+                if node is not None:
+                    t.append(node)
+                    s.add(node)
+                    moved = True
+            if not moved: return None
+        ks = [x for t in trails for kind, x in t[:t.index(meet)] if kind]
+        kind, x = meet
+        if kind: ks.append(x)
+        return ks, self.up_block[x] if kind else x
+
+    def _join(self, e, touched):
+        # Adds edge e, merging the blocks on the tree's path between its pins
+        a, b = e
+        self.adj[a].add(b)
+        self.adj[b].add(a)
+        if not self._has(a): a, b = b, a
+        if not self._has(b):            # b hangs off a by e alone
+            if len(self.adj[b]) > 1: return False
+            k = self._new_block({e})
+            self.up_block[k], self.up_pin[b] = a, k
+            return True
+        path = self._path(a, b)
+        if path is None: return False
+        ks, top = path
+        on = [k for k in ks if k in self.exit]
+        if on:      # The merged block is on the way, from top to where the last one left it
+            ups = {self.up_block[k] for k in on}
+            last = next(self.exit[k] for k in on if self.exit[k] not in ups)
+            for k in ks:
+                if k not in self.exit:
+                    for d in self._directed(self.edges_of[k]):
+                        self.kept.add(d)
+                        touched.add(d)
+        ks.sort(key=lambda k: len(self.edges_of[k]), reverse=True)
+        es = self.edges_of.pop(ks[0])
+        r = ks[0]
+        for k in ks[1:]:
+            es |= self.edges_of.pop(k)
+            r = self.ds.union(r, k)
+        for k in ks:
+            del self.up_block[k]
+            self.exit.pop(k, None)
+        es.add(e)
+        self.edges_of[r], self.up_block[r], self.label[e] = es, top, r
+        self.blocks_at[a].add(r)
+        self.blocks_at[b].add(r)
+        if on:
+            self.exit[r] = last
+            self.kept.update(self._directed([e]))
+        return True
+
+class IncrementalSimulator:
+    '''Runs a circuit with an EventPropagator and keeps its path graph up to date as buttons are
+    pressed, redoing only the part of the circuit a press can affect. Example:
+
+        >>> t1 = terminal(0, voltage=1)
+        >>> b = button(0, 1)
+        >>> l = lamp(1, 2)
+        >>> t2 = terminal(2, voltage=0)
+        >>> sim = IncrementalSimulator()
+        >>> sim.toggle(b)
+        >>> while sim.step(): pass
+        >>> l.on
+        True
+
+    After a press, only edges whose liveness depends on the button's edges are redone, in both
+    the forward and the backward pass, and loops hanging off the circuit (see build_path_graph)
+    are only looked for again in the blocks of the block-cut tree that the changed edges are in.
+    Then only the pins connected to a component that started or stopped propagating, through
+    components that propagate before or after the press, are cleared and stepped again. That
+    stops at terminal pins nothing but wires, buttons and lamps shares with the terminal, which
+    have current either way, so a button next to thousands of rungs on the same source and
+    ground pins only runs its own rung. The result is the same as building the circuit again
+    from scratch with the new button states.
+
+    If cache (a cache.SimulationCache) is given, the forward and backward passes are taken from
+    it when the circuit was seen before with the same button states.
+    '''
+    def __init__(self, circuit=None, cache=None):
+        self.circuit = circuit = _resolve(circuit)
+        self.sources = set(circuit.get_sources())
+        if not self.sources:
+            raise TypeError('circuit has no positive terminals')
+        self.grounds = {p for p in circuit.pcd if circuit.get_terminal_voltage(p) == 0}
+        self.edges = {}         # Component -> its edges
+        self.count = defaultdict(int)       # Edge -> number of components giving it
+        self.succ, self.pred = defaultdict(set), defaultdict(set)
+        for c in circuit.register.values():
+            self._add_edges(c, _component_edges(c, self.sources, self.grounds))
+        def live():
+            with _phase(circuit, 'paths'):
+                return (_live_edges(self.sources, self.succ),
+                        {(a, b) for b, a in _live_edges(self.grounds, self.pred)})
+        self.forward, backward = live() if cache is None else cache.live(circuit, live)
+        with _phase(circuit, 'paths'):
+            self.backward = {(b, a) for a, b in backward}   # The way the backward pass walks them
+            self.live = self.forward & backward
+            self.blocks = _BlockTree(self.live, self.sources, self.grounds)
+            self.kept = self.blocks.kept
+            self.paths = DirectedGraph.from_edges(self.kept)
+        self.held = _held_pins(circuit)
+        if circuit.stats is not None:
+            circuit.stats.record_paths(self.paths)
+        self.engine = EventPropagator(self.paths, circuit)
+
+    def _add_edges(self, c, es):
+        self.edges[c] = es
+        for e in es:
+            self.count[e] += 1
+            if self.count[e] == 1:
+                self.succ[e[0]].add(e[1])
+                self.pred[e[1]].add(e[0])
+
+    def step(self):
+        return self.engine.step()
+
+    def toggle(self, b):
+        '''Presses or releases a button.'''
+        b.on = not b.on
+        self.update(b)
+
+    def update(self, c):
+        '''Brings everything up to date after the pins c connects changed.'''
+        with _phase(self.circuit, 'update'):
+            self._update(c)
+        if self.circuit.stats is not None:
+            self.circuit.stats.record_paths(self.paths)
+
+    def _update(self, c):
+        old, new = self.edges[c], _component_edges(c, self.sources, self.grounds)
+        changed = set()
+        for e in old - new:
+            self.count[e] -= 1
+            if not self.count[e]:
+                del self.count[e]
+                self.succ[e[0]].discard(e[1])
+                self.pred[e[1]].discard(e[0])
+                changed.add(e)
+        self._add_edges(c, new)
+        changed.update(e for e in new - old if self.count[e] == 1)
 
-def propagate_current_step(paths: DirectedGraph):
-    for p in component.pcd.keys():
-        propagate_current_at_pin(p, paths)
+        forward = _edge_cone(changed, self.sources, self.succ)
+        _relive(self.forward, forward, self.sources, self.succ, self.pred)
+        backward = _edge_cone({(b, a) for a, b in changed}, self.grounds, self.pred)
+        _relive(self.backward, backward, self.grounds, self.pred, self.succ)
+        added, removed = [], []
+        for e in forward | {(b, a) for a, b in backward}:
+            live = e in self.forward and e[::-1] in self.backward
+            if live == (e in self.live): continue
+            if live:
+                self.live.add(e)
+                added.append(e)
+            else:
+                self.live.discard(e)
+                removed.append(e)
+        touched = self.blocks.update(added, removed)
+        for e in touched:
+            a, b = e
+            conns = self.paths.cd[a]
+            if e in self.kept: conns.add(b)
+            else: conns.discard(b)
 
-def propagate_current(paths: DirectedGraph):
-    while True:
-        propagate_current_step(paths)
+        # Components on both pins of an edge that came or went, which are the only ones whose
+        # activity can change, and the pins they share current with
+        engine, pcd = self.engine, self.circuit.pcd
+        check = {c}
+        for a, b in touched:
+            if len(pcd[a]) > len(pcd[b]): a, b = b, a
+            check.update(x for x in pcd[a] if b in x.ps)
+        flipped = set()
+        for x in check:
+            before = engine.active.get(x)
+            engine._check(x)
+            after = engine.active.get(x)
+            if x is c or after != before: engine.wake(x)
+            if (after is None) != (before is None): flipped.add(x)
+        # Held pins have the same current either way, so nothing gets past them
+        region = set()
+        todo = [p for x in flipped for p in x.ps]
+        while todo:
+            p = todo.pop()
+            if p in region or p in self.held: continue
+            region.add(p)
+            for x in pcd[p]:
+                if x in engine.active or x in flipped:
+                    todo.extend(x.ps)
+        for p in region:
+            self.circuit.pct[p] = 0
+            for x in pcd[p]:
+                if isinstance(x, lamp): x.on = False
+        engine.schedule(*region)
 
 def main():
-    global RUNNING
     terminal(0, voltage=1)
     wire(0, 2)
     wire(0, 1)
@@ -323,11 +1767,11 @@ def main():
     print('start')
     p = get_all_paths_from_positive()
     print('checking shorts')
-    for s in component.get_sources():
-        detect_shorts(p, s)
+    for sh in detect_shorts(p):
+        print(sh)
     print('running')
-    RUNNING = True
-    propagate_current(p)
+    Circuit.current().running = True
+    print(propagate_current(p))
     print('end')
 
 if __name__ == '__main__':
@@ -1,11 +1,12 @@
 import pygame # TODO: add icon
-import math
 import itertools as it
 from enum import Enum
 from collections import namedtuple
 from operator import attrgetter
 from dataclasses import dataclass
 from draw_utils import (
+    cursor_rect,
+    render_text,
     draw_cursor,
     draw_help_screen,
     draw_credits_screen,
@@ -14,19 +15,28 @@ from draw_utils import (
     draw_lamp,
     draw_positive,
     draw_negative,
-    draw_button
+    draw_button,
+    draw_block
 )
 import draw_utils
+import netlist
+from spatial import SpatialIndex
+from worker import SimulationWorker
+from cache import SimulationCache
 
 from graph import DirectedGraph
 from electric import (
+    Circuit,
     component as backend_component,
-    get_all_paths_from_positive,
-    propagate_current_step,
+    enable_stats,
+    disable_stats,
     terminal,
     lamp,
     wire,
-    button
+    button,
+    block,
+    blocks,
+    define_block
 )
 
 mode = namedtuple('mode', 'name char nw binding constructor')
@@ -38,12 +48,22 @@ modes = {
     'negative': mode('negative', 'g', 1, draw_negative, lambda p: terminal(p, voltage=0)),
     'transistor': mode('transistor', 't', 3, None, None)      # FIXME
 }
+block_modes = {}        # Block name -> mode placing that block, cycled through with [k]
+
+def block_mode(name):
+    if name not in block_modes:
+        block_modes[name] = mode(name, 'k', len(blocks[name].ports), draw_block,
+                                 lambda *ps: block(*ps, name=name))
+    return block_modes[name]
+
+netlist_path = 'circuit.xnl'       # Where ctrl+s saves and ctrl+o loads the drawing
 
 @dataclass
 class component:
     type: mode
     pins: list[tuple[int,int]]
     bec: backend_component = None
+    on: bool = False        # State of the lamp or button as last published by the worker
     box: pygame.Rect = None
 
 pygame.init()
@@ -54,10 +74,13 @@ screen = pygame.display.set_mode((500, 500), pygame.RESIZABLE)
 draw_utils.screen = screen
 clock = pygame.time.Clock()
 running = True
-runner = None
+worker = None           # SimulationWorker while running
+cache = SimulationCache()       # Path analyses and settled states of earlier runs
+circuit = None
 run_error = False
 current_mode = modes['wire']
 help_mode = False
+show_stats = False      # Simulation stats overlay, toggled with [i]
 is_cursor_locked = False
 pos = (0, 0)
 
@@ -69,52 +92,169 @@ tp = []         # Temporary points
 def get_sp():   # Significiant points
     return it.chain(it.chain.from_iterable(map(attrgetter('pins'), lc)), tp)
 
+index = SpatialIndex(10)        # Every point of get_sp, kept up to date as points come and go
+
 def get_pos():
     global is_cursor_locked
-    _pos = pygame.mouse.get_pos()
-    pos = _pos
-    sp = list(get_sp())
-    for p in sp:    # snap to points
-        if math.sqrt((pos[0] - p[0])**2 + (pos[1] - p[1])**2) < 10:
-            pos = p
-            break
+    guides.clear()
+    pos = pygame.mouse.get_pos()
+    pos = index.nearest(pos, 10) or pos     # snap to points
     pos = list(pos)     # For mutability
-    for p in sp:    # snap to directions
-        if abs(p[0] - pos[0]) < 10:
-            pos[0] = p[0]
-        elif abs(p[1] - pos[1]) < 10:
-            pos[1] = p[1]
-        else:
-            continue
-        pygame.draw.line(screen, 'forestgreen', pos, p)
+    px, py = index.aligned(pos, 10)         # snap to directions
+    for i, p in enumerate((px, py)):
+        if p is None: continue
+        pos[i] = p[i]
+        guides.append((tuple(pos), p))
         is_cursor_locked = True
     pos = tuple(pos)
     return pos
 
-def setup_run():
-    backend_component.reset_class()
+# Components are drawn once onto static, which is copied to the screen. Each frame only the
+# parts of the screen drawn over in the frame before (cursor, lines, text) are restored from
+# static and drawn again, and only if something changed. Lamps and buttons that change state
+# are redrawn on static in one pass, clipped to the union of their rects.
+static = None           # Surface with every component drawn on black
+static_dirty = True     # Whether static needs to be drawn again from scratch
+overlay = []            # Rects of the screen drawn over static in the last frame
+last_frame = None       # What the overlay showed in the last frame
+guides = []             # Lines from the cursor to the points it is aligned with
+
+def component_rect(c, margin=22):      # Every binding stays within margin of its pins
+    xs, ys = [p[0] for p in c.pins], [p[1] for p in c.pins]
+    return pygame.Rect(min(xs) - margin, min(ys) - margin,
+                       max(xs) - min(xs) + 2 * margin, max(ys) - min(ys) + 2 * margin)
+
+def draw_static(rect=None):
+    # Draws the components onto static, only inside rect if one is given
+    draw_utils.screen = static
+    static.set_clip(rect)
+    static.fill('black')
+    for c in lc:
+        if rect is None or rect.colliderect(component_rect(c)):
+            c.type.binding(*c.pins, component=c)
+    static.set_clip(None)
+    draw_utils.screen = screen
+
+def update_static():
+    # Returns the rects of static that changed, or None if all of it did
+    global static, static_dirty
+    if static is None or static.get_size() != screen.get_size():
+        static = pygame.Surface(screen.get_size())
+        static_dirty = True
+    if static_dirty:
+        draw_static()
+        static_dirty = False
+        return None
+    if worker is None:      # Lamps and buttons only change state while running
+        return []
+    on, rects = worker.state.on, []
     for c in lc:
-        c.bec = c.type.constructor(*map(hash, c.pins))      # bec = back end component
+        if c.bec is not None and on.get(c.bec.sid, c.on) != c.on:
+            c.on = on[c.bec.sid]
+            rects.append(component_rect(c))
+    if rects:
+        draw_static(rects[0].unionall(rects[1:]))
+    return rects
+
+def frame_texts():
+    # (text, color, position) of every line of text shown outside the help screens
+    ht = render_text(font, "Press [h] for help, [c] for credits, [l] for license")
+    texts = [("Press [h] for help, [c] for credits, [l] for license", 'yellow',
+              (screen.get_width() - ht.get_width() - 10, screen.get_height() - ht.get_height() - 10))]
+    if help_mode:
+        return texts
+    texts.append((f"Mode: {current_mode.name}", 'yellow', (0, 0)))
+    if worker is not None:
+        texts.append(("RUNNING (settled)" if worker.state.settled else "RUNNING", 'lightblue', (0, 12)))
+    elif run_error:
+        texts.append((run_error, 'red', (0, 12)))
+    if show_stats and worker is not None and worker.state.stats:
+        texts.extend((line, 'lightgreen', (0, 36 + 12 * i)) for i, line in enumerate(worker.state.stats))
+    return texts
+
+def draw_overlay(pos, texts):
+    # Draws everything that isn't a component and returns the rects drawn over
+    rects = [pygame.draw.line(screen, 'forestgreen', a, b) for a, b in guides]
+    rects.extend(pygame.draw.line(screen, 'yellow', p, pos) for p in tp)
+    draw_cursor(pos, color='green' if is_cursor_locked else 'yellow')
+    rects.append(cursor_rect(pos))
+    rects.extend(screen.blit(render_text(font, text, color), p) for text, color, p in texts)
+    if help_mode == 'help':
+        rects.append(draw_help_screen((0, 0), font))
+    elif help_mode == 'license':
+        rects.append(draw_license_screen((0, 0), font))
+    elif help_mode == 'credits':
+        rects.append(draw_credits_screen((0, 0), font))
+    return rects
+
+def to_record(c):
+    if c.type.binding is draw_block:
+        return 'block', tuple(c.pins), {'name': c.type.name}
+    match c.type.name:
+        case 'positive': return 'terminal', tuple(c.pins), {'voltage': 1}
+        case 'negative': return 'terminal', tuple(c.pins), {'voltage': 0}
+        case name: return name, tuple(c.pins), {}
+
+def from_record(name, ps, attrs):
+    if name == 'terminal':
+        name = 'positive' if attrs.get('voltage', 0) > 0 else 'negative'
+    m = block_mode(attrs['name']) if name == 'block' else modes[name]
+    if m.binding is None:
+        raise ValueError(f"the editor can't draw a {name}")
+    if len(ps) != m.nw or not all(type(p) is tuple and len(p) == 2 and all(type(x) is int for x in p)
+                                  for p in ps):
+        raise ValueError(f'a {name} needs {m.nw} grid points as pins, got {ps!r}')
+    return component(m, list(ps))
+
+def save_lc():
+    with open(netlist_path, 'wb') as f:
+        names = dict.fromkeys(c.type.name for c in lc if c.type.binding is draw_block)
+        netlist.write(it.chain(netlist.definitions(names), map(to_record, lc)), f)
+
+def load_lc():
+    with open(netlist_path, 'rb') as f:
+        return [from_record(*r) for r in netlist.components(netlist.records(f))]
 
-def run(from_scratch=True):
-    global run_error
-    if from_scratch: setup_run()
-    for c in lamp.lamp_register.values():
+def define_lc():
+    # Turns the drawing into a new block, its terminals marking the ports, and returns its mode
+    ends = [c for c in lc if c.type.name in ('positive', 'negative')]
+    ports = list(dict.fromkeys(p for c in ends for p in c.pins))
+    if not ports:
+        raise ValueError('a block needs terminals to mark its ports')
+    name = next(f'block{i}' for i in it.count(1) if f'block{i}' not in blocks)
+    define_block(name, [to_record(c) for c in lc if c not in ends], ports)
+    return block_mode(name)
+
+def setup_run():
+    global circuit
+    circuit = Circuit()
+    if show_stats:
+        enable_stats(circuit)
+    with circuit:
+        for c in lc:
+            c.bec = c.type.constructor(*map(hash, c.pins))      # bec = back end component
+
+def start_run():
+    global worker
+    setup_run()
+    worker = SimulationWorker(circuit, cache=cache)
+    worker.start()
+
+def stop_run():
+    global worker, static_dirty
+    worker.stop()
+    worker = None
+    for c in lc:
+        c.bec = None
         c.on = False
-    try:
-        dg = get_all_paths_from_positive()
-    except TypeError as e:
-        run_error = True
-        print(e)
-        return
-    while True:
-        propagate_current_step(dg)
-        yield
-    
+    static_dirty = True
+
 while running:
-    screen.fill('black')
-    _pos = pygame.mouse.get_pos()
-    pos = get_pos() if runner is None else _pos
+    if worker is None:
+        pos = get_pos()
+    else:
+        pos = pygame.mouse.get_pos()
+        guides.clear()
     for event in pygame.event.get():
         match event.type:
             case pygame.QUIT:
@@ -122,28 +262,64 @@ while running:
             case pygame.MOUSEMOTION:
                 pass
             case pygame.MOUSEBUTTONUP:
-                if runner is None:
+                if worker is None:
                     tp.append(pos)
+                    index.add(pos)
                 else:
                     for c in lc:
                         if c.type.name == 'button' and c.box.collidepoint(pos):
-                            c.bec.on = not c.bec.on
-                            runner = run(False)
+                            worker.toggle(c.bec.sid)
 
             case pygame.KEYUP:
-                if event.key == 122 and event.mod == 64:    # ???
-                    lc.pop()
+                if event.key == 122 and event.mod == 64 and lc:    # ???
+                    for p in lc.pop().pins:
+                        index.remove(p)
+                    static_dirty = True
+                if event.key == pygame.K_s and event.mod & pygame.KMOD_CTRL:
+                    save_lc()
+                    continue
+                if event.key == pygame.K_o and event.mod & pygame.KMOD_CTRL and worker is None:
+                    try:
+                        lc = load_lc()
+                        tp = []
+                        index = SpatialIndex.from_points(get_sp())
+                        static_dirty = True
+                    except (OSError, ValueError, KeyError) as e:
+                        run_error = 'COULD NOT LOAD'
+                        print(e)
+                    continue
+                if event.key == pygame.K_b and event.mod & pygame.KMOD_CTRL and worker is None:
+                    try:
+                        current_mode = define_lc()
+                        lc, tp = [], []
+                        index = SpatialIndex(10)
+                        static_dirty = True
+                    except (ValueError, KeyError, TypeError) as e:
+                        run_error = 'COULD NOT DEFINE BLOCK'
+                        print(e)
+                    continue
                 if event.key == 27:
+                    for p in tp:
+                        index.remove(p)
                     tp = []
                 for m in modes.values():
                     if event.unicode == m.char:
                         current_mode = m
                         break
+                if event.unicode == 'k' and block_modes:
+                    ms = list(block_modes.values())
+                    current_mode = ms[(ms.index(current_mode) + 1) % len(ms)] if current_mode in ms else ms[0]
                 if event.unicode == ' ':
-                    runner = run() if runner is None else None
-                    if runner is None:
-                        for c in lc:
-                            c.bec = None
+                    if worker is None:
+                        start_run()
+                    else:
+                        stop_run()
+                if event.unicode == 'i':
+                    show_stats = not show_stats
+                    if circuit is not None and show_stats:
+                        enable_stats(circuit)
+                    elif circuit is not None:
+                        disable_stats(circuit)
                 if event.unicode == 'h':
                     help_mode = False if help_mode == 'help' else 'help'
                 elif event.unicode == 'c':
@@ -151,45 +327,37 @@ while running:
                 elif event.unicode == 'l':
                     help_mode = False if help_mode == 'license' else 'license'
 
-    ht = font.render("Press [h] for help, [c] for credits, [l] for license", False, 'yellow')
-    screen.blit(ht, (screen.get_width() - ht.get_width() - 10, screen.get_height() - ht.get_height() - 10))
-
-    if runner is not None:
-        try:
-            next(runner)
-        except StopIteration:
-            runner = None
-
-    for p in tp:
-        pygame.draw.line(screen, 'yellow', p, pos)
-
-    draw_cursor(pos, color='green' if is_cursor_locked else 'yellow')
-    is_cursor_locked = False
+    if worker is not None and worker.state.error:
+        error = worker.state.error
+        stop_run()
+        run_error = error
 
     if len(tp) == current_mode.nw:
         lc.append(component(current_mode, tp))
         run_error = False
         tp = []
+        static_dirty = True
+    if worker is not None:
+        run_error = False
 
-    for c in lc:
-        c.type.binding(*c.pins, component=c)
-
-    if not help_mode:
-        screen.blit(font.render(f"Mode: {current_mode.name}", False, 'yellow'), (0, 0))
-
-        if runner is not None:
-            run_error = False
-            screen.blit(font.render("RUNNING", False, 'lightblue'), (0, 12))
-        elif run_error:
-            screen.blit(font.render("COULD NOT RUN", False, 'red'), (0, 12))
-    elif help_mode == 'help':
-        draw_help_screen((0, 0), font)
-    elif help_mode == 'license':
-        draw_license_screen((0, 0), font)
-    elif help_mode == 'credits':
-        draw_credits_screen((0, 0), font)
+    changed = update_static()
+    texts = frame_texts()
+    frame = (pos, tuple(tp), tuple(guides), is_cursor_locked, help_mode, tuple(texts))
+    if changed is None:
+        screen.blit(static, (0, 0))
+        overlay = draw_overlay(pos, texts)
+        pygame.display.update()
+    elif changed or frame != last_frame:
+        for r in overlay:
+            screen.blit(static, r, r)
+        for r in changed:
+            screen.blit(static, r, r)
+        new_overlay = draw_overlay(pos, texts)
+        pygame.display.update(overlay + changed + new_overlay)
+        overlay = new_overlay
+    last_frame = frame
+    is_cursor_locked = False
 
-    pygame.display.flip()
     clock.tick(120)
 
 pygame.quit()
@@ -1,7 +1,17 @@
+from array import array
 from collections import namedtuple, defaultdict
+import itertools as it
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 connection = namedtuple('connection', 'from_ to')
 
+_empty = frozenset()
+
 class DirectedGraph:
     def __init__(self, cd=None):
         if cd is None:
@@ -16,16 +26,212 @@ class DirectedGraph:
         self.cd[a].add(b)
 
     def get_conns(self, a):
-        return self.cd[a]
+        return self.cd.get(a, _empty)
+
+    def edges(self):
+        for a, bs in self.cd.items():
+            for b in bs:
+                yield connection(a, b)
+
+    def nodes(self):
+        ns = dict.fromkeys(self.cd)         # Ordered set
+        for bs in self.cd.values():
+            ns.update(dict.fromkeys(bs))
+        return list(ns)
+
+    def strongly_connected_components(self):
+        # Iterative Tarjan. Returns the components in topological order, so every edge between
+        # two components goes from an earlier one to a later one.
+        index, low, stack, on_stack, sccs = {}, {}, [], set(), []
+        conns = self.get_conns
+        for root in self.nodes():
+            if root in index: continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(conns(root)))]
+            while work:
+                v, children = work[-1]
+                for w in children:
+                    if w not in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, iter(conns(w))))
+                        break
+                    if w in on_stack and index[w] < low[v]:
+                        low[v] = index[w]
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        if low[v] < low[u]: low[u] = low[v]
+                    if low[v] == index[v]:
+                        scc = []
+                        while True:
+                            w = stack.pop()
+                            on_stack.discard(w)
+                            scc.append(w)
+                            if w == v: break
+                        sccs.append(scc)
+        sccs.reverse()
+        return sccs
 
-    def union(self, other):
-        keys = set(self.cd.keys()).union(set(other.cd.keys()))
-        return DirectedGraph({k: self.cd[k].union(other.cd[k]) for k in keys})
+    def update(self, *others):
+        '''Adds the edges of every other graph to this one.'''
+        cd = self.cd
+        for other in others:
+            for k, bs in other.cd.items():
+                cd[k] |= bs
+        return self
+
+    def union(self, *others):
+        '''Returns a new graph with the edges of this graph and all the others.'''
+        return DirectedGraph({k: set(bs) for k, bs in self.cd.items()}).update(*others)
 
     @staticmethod
-    def from_list_of_lists(ll):
+    def from_edges(es):
         g = DirectedGraph()
-        for l in ll:
-            for a, b in zip(l, l[1:]):
-                g.add_conn(a, b)
+        cd = g.cd
+        for a, b in es:
+            cd[a].add(b)
         return g
+
+    @staticmethod
+    def from_list_of_lists(ll):
+        return DirectedGraph.from_edges(it.chain.from_iterable(zip(l, l[1:]) for l in ll))
+
+class CSRGraph:
+    '''Read-only directed graph with the same queries as DirectedGraph, stored as compressed
+    sparse rows. Nodes are interned to dense ids, by_id lists the nodes by id and the ids of the
+    successors of node id i are targets[offsets[i]:offsets[i + 1]]. Meant for large graphs that
+    are built once and then only read, such as path graphs. Example:
+
+        >>> g = CSRGraph.from_edges([(0, 1), (1, 2), (0, 1)])
+        >>> g.get_conns(0), g.get_conns(2), g.get_conns(5)
+        ((1,), (), ())
+
+    The rows are sorted with NumPy when it is installed. get_conns returns a tuple of the
+    successors, made for every node on the first lookup.
+        >>> list(g.union(CSRGraph.from_edges([(2, 0)])).edges())
+        [connection(from_=0, to=1), connection(from_=1, to=2), connection(from_=2, to=0)]
+    '''
+    def __init__(self, ids=None, offsets=None, targets=None):
+        self.ids = {} if ids is None else ids           # Node -> id
+        self.by_id = list(self.ids)
+        self.offsets = array('l', [0] * (len(self.ids) + 1)) if offsets is None else offsets
+        self.targets = array('l') if targets is None else targets
+        self.rows = None        # Node -> tuple of its successors, once get_conns was called
+
+    def __str__(self):
+        return f'CSRGraph({ {a: self.get_conns(a) for a in self.ids} })'
+
+    def get_conns(self, a):
+        rows = self.rows
+        if rows is None: rows = self.rows = self._rows()
+        return rows.get(a, ())
+
+    def _rows(self):
+        # Node -> tuple of its successors
+        if np is None:
+            targets = list(map(self.by_id.__getitem__, self.targets))
+        else:
+            nodes = np.fromiter(self.by_id, object, len(self.by_id))
+            targets = nodes[np.frombuffer(self.targets, 'l')].tolist()
+        offsets = self.offsets
+        return dict(zip(self.by_id, (tuple(targets[j:k]) for j, k in zip(offsets, offsets[1:]))))
+
+    def _pairs(self):
+        offsets = self.offsets
+        degrees = map(int.__sub__, offsets[1:], offsets)
+        return zip(it.chain.from_iterable(map(it.repeat, self.by_id, degrees)),
+                   map(self.by_id.__getitem__, self.targets))
+
+    def edges(self):
+        return it.starmap(connection, self._pairs())
+
+    def nodes(self):
+        return list(self.by_id)
+
+    strongly_connected_components = DirectedGraph.strongly_connected_components
+
+    def union(self, *others):
+        '''Returns a new graph with the edges of this graph and all the others, built in one
+        pass.'''
+        return CSRGraph.from_edges(it.chain(self._pairs(), *(
+            o._pairs() if isinstance(o, CSRGraph) else o.edges() for o in others)))
+
+    @staticmethod
+    def from_edges(es):
+        # Drops repeated edges, interns the nodes in the order they come up and sorts the edges
+        # into rows by source id, keeping the order edges came in within a row
+        if np is None:
+            return CSRGraph._counting_sort(es)
+        # setdefault hands every node the position its first end has among all ends, so one
+        # lookup per end interns them all, and np.unique makes those positions dense ids
+        ids = {}
+        ends = np.fromiter(map(ids.setdefault, it.chain.from_iterable(es), it.count()), 'l')
+        ends = np.unique(ends, return_inverse=True)[1].reshape(-1)
+        ids = dict(zip(ids, it.count()))
+        n = len(ids)
+        src, dst = ends[0::2], ends[1::2]
+        first = np.unique(src * n + dst, return_index=True)[1]     # Where every edge first comes
+        first.sort()
+        src, dst = src[first], dst[first]
+        offsets = np.zeros(n + 1, 'l')
+        np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+        targets = dst[np.argsort(src, kind='stable')]
+        return CSRGraph(ids, array('l', offsets.tobytes()), array('l', targets.tobytes()))
+
+    @staticmethod
+    def _counting_sort(es):
+        # from_edges without NumPy, putting every edge straight into its row
+        ids = {}
+        src, dst = array('l'), array('l')
+        for a, b in dict.fromkeys(es):
+            i = ids.get(a)
+            if i is None: i = ids[a] = len(ids)
+            j = ids.get(b)
+            if j is None: j = ids[b] = len(ids)
+            src.append(i)
+            dst.append(j)
+        counts = [0] * (len(ids) + 1)
+        for i in src:
+            counts[i + 1] += 1
+        offsets = array('l', it.accumulate(counts))
+        free = offsets[:-1]         # Next free slot in every row
+        targets = array('l', bytes(dst.itemsize * len(dst)))
+        for i, j in zip(src, dst):
+            targets[free[i]] = j
+            free[i] += 1
+        return CSRGraph(ids, offsets, targets)
+
+    @staticmethod
+    def from_list_of_lists(ll):
+        return CSRGraph.from_edges(it.chain.from_iterable(zip(l, l[1:]) for l in ll))
+
+class DisjointSet:
+    '''Union-find over arbitrary hashable items, with path halving and union by size.'''
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, a):
+        parent = self.parent
+        if a not in parent:
+            return a
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        parent, size = self.parent, self.size
+        if a not in parent: parent[a], size[a] = a, 1
+        if b not in parent: parent[b], size[b] = b, 1
+        a, b = self.find(a), self.find(b)
+        if a == b: return a
+        if self.size[a] < self.size[b]: a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
@@ -0,0 +1,314 @@
+'''Reading and writing circuits as netlists, in a text format and a compact binary one.
+
+A netlist is a sequence of records (type name, pins, attrs), the same as the entries of
+Circuit.describe. In the text format every record is one line:
+
+    # xedek netlist
+    terminal 0 voltage=1
+    wire 0 1
+    lamp 1 5,7 resistance=2
+    terminal 5,7 voltage=0
+
+The type name comes first, then the pins, then the attrs as key=value. Tokens are separated by
+whitespace. A token with commas is a tuple of ints (5,7 is the pin (5, 7) and 5, is (5,)).
+Other tokens are read as an int if they are one, then as a float, then as True or False, and
+otherwise as a string. Strings therefore can't contain whitespace, commas or = and shouldn't
+look like numbers. Blank lines and lines starting with # are skipped.
+
+The binary format starts with the magic bytes XDKN and a version byte, and then has one record
+after another, all numbers little-endian. A record is a 2-byte name id for the type name, a pin
+count byte, an attr count byte, a 4-byte pin id for every pin and then the attrs, each a 2-byte
+name id and a value. Names and pins are numbered in order of first appearance, and the first time
+an id appears its entry follows: after the record header for the type name, after the pin ids for
+the new pins, in order, and after the attr's name id for attr names. A name is a length byte and
+UTF-8 text. A value is a tag byte followed by its data: an int, an 8-byte float, a bool byte, a
+string (8-byte length and UTF-8 text) or a tuple of ints (count byte and the ints). Ints are 4
+bytes, or 8 bytes under a separate tag if they (or any int in the tuple) don't fit in 4 bytes.
+Example:
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> write([('wire', (0, (1, 2)), {}), ('terminal', (0,), {'voltage': 1})], f)
+    >>> list(records(io.BytesIO(f.getvalue())))
+    [('wire', (0, (1, 2)), {}), ('terminal', (0,), {'voltage': 1})]
+
+records and load read a netlist a chunk at a time, so it is never held in memory as a whole.
+
+Block definitions (see electric.define_block) come before the components that use them, as a
+define record with the ports as its pins and the block's name as its name attr, then the
+records of the inside and then an end record:
+
+    define a b name=two_lamps
+    lamp a m
+    lamp m b
+    end
+    block 0 1 name=two_lamps
+'''
+import functools
+import itertools as it
+import struct
+
+from electric import _resolve, block, blocks, component_types, define_block
+
+magic = b'XDKN'
+version = 1
+header = '# xedek netlist\n'
+
+_int, _float, _bool, _str, _tuple, _small_tuple, _small_int = range(7)
+_q = struct.Struct('<q')
+_i = struct.Struct('<i')
+_d = struct.Struct('<d')
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_record = struct.Struct('<HBB')     # Type name id, pin count, attr count
+_pin_ids = [struct.Struct(f'<{n}I') for n in range(256)]
+_small_tuples = [struct.Struct(f'<{n}i') for n in range(256)]
+
+@functools.cache
+def _ints(n, code='I'):
+    return struct.Struct(f'<{n}{code}')
+
+def _parse(token):
+    if ',' in token:
+        return tuple([int(x) for x in token.split(',') if x])
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        pass
+    if token in ('True', 'False'):
+        return token == 'True'
+    return token
+
+def _format(v):
+    if isinstance(v, tuple) and all(type(x) is int for x in v):
+        return ','.join(map(str, v)) + (',' if len(v) < 2 else '')
+    if type(v) in (int, float, bool):
+        return repr(v)
+    if type(v) is str and v and _parse(v) == v and not any(ch.isspace() or ch in ',=' for ch in v):
+        return v
+    raise ValueError(f'{v!r} can not be written to a netlist')
+
+def _text_records(lines):
+    for line in lines:
+        tokens = line.decode().split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        ps, attrs = [], {}
+        for t in tokens[1:]:
+            if '=' in t:
+                k, v = t.split('=', 1)
+                attrs[k] = _parse(v)
+            else:
+                ps.append(_parse(t))
+        yield tokens[0], tuple(ps), attrs
+
+def _write_text(records, f):
+    f.write(header.encode())
+    for name, ps, attrs in records:
+        f.write((' '.join(it.chain([name], map(_format, ps),
+                                   (f'{k}={_format(v)}' for k, v in attrs.items()))) + '\n').encode())
+
+def _read_exactly(f, n):
+    b = f.read(n)
+    if len(b) != n:
+        raise ValueError('netlist ends in the middle of a record')
+    return b
+
+def _decode_name(buf, pos):
+    n = _u8.unpack_from(buf, pos)[0]
+    b = buf[pos + 1:pos + 1 + n]
+    if len(b) != n:
+        raise struct.error('name runs past the buffer')
+    return b.decode(), pos + 1 + n
+
+def _decode_value(buf, pos):
+    # The value at pos in buf and the offset after it
+    tag = _u8.unpack_from(buf, pos)[0]
+    if tag == _small_tuple or tag == _tuple:
+        s = _ints(_u8.unpack_from(buf, pos + 1)[0], 'i' if tag == _small_tuple else 'q')
+        return s.unpack_from(buf, pos + 2), pos + 2 + s.size
+    if tag == _small_int: return _i.unpack_from(buf, pos + 1)[0], pos + 5
+    if tag == _int: return _q.unpack_from(buf, pos + 1)[0], pos + 9
+    if tag == _float: return _d.unpack_from(buf, pos + 1)[0], pos + 9
+    if tag == _bool: return bool(_u8.unpack_from(buf, pos + 1)[0]), pos + 2
+    if tag == _str:
+        n = _q.unpack_from(buf, pos + 1)[0]
+        b = buf[pos + 9:pos + 9 + n]
+        if len(b) != n:
+            raise struct.error('string runs past the buffer')
+        return b.decode(), pos + 9 + n
+    raise ValueError(f'unknown value tag {tag}')
+
+def _binary_records(f, chunk=1 << 16):
+    # Decodes straight from a buffer read at least chunk bytes ahead of the records. A record
+    # that runs past the end of the buffer is decoded again once the buffer is twice as big.
+    names, pins = [], []
+    buf, pos, window, eof = b'', 0, chunk, False
+    while True:
+        if len(buf) - pos < window and not eof:
+            more = f.read(window)
+            eof = len(more) < window
+            buf, pos = buf[pos:] + more, 0
+        if pos == len(buf):
+            return
+        n_names, n_pins = len(names), len(pins)
+        try:
+            name_id, n, m = _record.unpack_from(buf, pos)
+            p = pos + _record.size
+            # Ids one past the end of a table are followed by the new entry
+            if name_id == len(names):
+                name, p = _decode_name(buf, p)
+                names.append(name)
+            ids = _pin_ids[n].unpack_from(buf, p)
+            p += 4 * n
+            if n and max(ids) >= len(pins):
+                for i in ids:
+                    if i != len(pins): continue
+                    tag = buf[p]
+                    if tag == _small_tuple:     # Pins are mostly these and ints
+                        k = buf[p + 1]
+                        pins.append(_small_tuples[k].unpack_from(buf, p + 2))
+                        p += 2 + 4 * k
+                    elif tag == _small_int:
+                        pins.append(_i.unpack_from(buf, p + 1)[0])
+                        p += 5
+                    else:
+                        v, p = _decode_value(buf, p)
+                        pins.append(v)
+            attrs = {}
+            for j in range(m):
+                k = _u16.unpack_from(buf, p)[0]
+                p += 2
+                if k == len(names):
+                    key, p = _decode_name(buf, p)
+                    names.append(key)
+                attrs[names[k]], p = _decode_value(buf, p)
+            name = names[name_id]
+        except (struct.error, IndexError):
+            if eof:
+                raise ValueError('netlist ends in the middle of a record') from None
+            del names[n_names:], pins[n_pins:]
+            window *= 2
+            continue
+        pos = p
+        yield name, tuple([pins[i] for i in ids]), attrs
+
+def _name(s):
+    b = s.encode()
+    if len(b) > 255:
+        raise ValueError(f'{s!r} is too long for a netlist')
+    return bytes([len(b)]) + b
+
+def _value(v):
+    if type(v) is bool: return bytes([_bool, v])
+    if type(v) is int:
+        if -1 << 31 <= v < 1 << 31: return bytes([_small_int]) + _i.pack(v)
+        return bytes([_int]) + _q.pack(v)
+    if type(v) is float: return bytes([_float]) + _d.pack(v)
+    if type(v) is str:
+        b = v.encode()
+        return bytes([_str]) + _q.pack(len(b)) + b
+    if isinstance(v, tuple) and len(v) < 256 and all(type(x) is int for x in v):
+        if all(-1 << 31 <= x < 1 << 31 for x in v):
+            return bytes([_small_tuple, len(v)]) + _ints(len(v), 'i').pack(*v)
+        return bytes([_tuple, len(v)]) + _ints(len(v), 'q').pack(*v)
+    raise ValueError(f'{v!r} can not be written to a netlist')
+
+def _write_binary(records, f):
+    f.write(magic + bytes([version]))
+    names, pins = {}, {}
+    def intern(table, x, encode, out):
+        # The id of x in table, adding x to out if it is new
+        i = table.get(x)
+        if i is None:
+            i = table[x] = len(table)
+            out.append(encode(x))
+        return i
+    for name, ps, attrs in records:
+        head, new_pins, tail = [], [], []
+        name_id = intern(names, name, _name, head)
+        ids = [intern(pins, p, _value, new_pins) for p in ps]
+        for k, v in attrs.items():
+            new_name = []
+            tail.append(_u16.pack(intern(names, k, _name, new_name)))
+            tail.extend(new_name)
+            tail.append(_value(v))
+        if len(names) > 0xffff or len(pins) > 0xffffffff or len(ps) > 255 or len(attrs) > 255:
+            raise ValueError('netlist is too large for the binary format')
+        f.write(b''.join([_record.pack(name_id, len(ps), len(attrs)), *head,
+                          _ints(len(ps)).pack(*ids), *new_pins, *tail]))
+
+def records(f):
+    '''Reads the records of a netlist from a binary file object, in either format.'''
+    start = f.read(len(magic))
+    if start == magic:
+        if _read_exactly(f, 1)[0] != version:
+            raise ValueError('unsupported netlist version')
+        yield from _binary_records(f)
+    else:
+        yield from _text_records(it.chain((start + f.readline()).splitlines(), f))
+
+def write(records, f, binary=False):
+    '''Writes records to a binary file object, in the binary format if binary is true and as
+    text otherwise.'''
+    if binary:
+        _write_binary(records, f)
+    else:
+        _write_text(records, f)
+
+def definitions(names):
+    '''The define ... end records of the named blocks and of the blocks they use, each after
+    the blocks it uses.'''
+    done = {}
+    def visit(name):
+        if name in done: return
+        for n, ps, attrs in blocks[name].description:
+            if n == 'block': visit(attrs['name'])
+        done[name] = None
+    for name in names:
+        visit(name)
+    for name in done:
+        d = blocks[name]
+        yield 'define', d.ports, {'name': name}
+        yield from d.description
+        yield 'end', (), {}
+
+def components(records):
+    '''Defines the blocks of the define ... end records in records and yields the others.'''
+    inside = None
+    for r in records:
+        if r[0] == 'define':
+            if inside is not None:
+                raise ValueError('define inside a block definition')
+            inside, ports, name = [], r[1], r[2]['name']
+        elif r[0] == 'end':
+            if inside is None:
+                raise ValueError('end outside a block definition')
+            define_block(name, inside, ports)
+            inside = None
+        elif inside is not None:
+            inside.append(r)
+        else:
+            yield r
+    if inside is not None:
+        raise ValueError(f'definition of block {name!r} has no end')
+
+def load(path, circuit=None):
+    '''Adds every component of the netlist at path to the circuit and returns the circuit.'''
+    circuit = _resolve(circuit)
+    with open(path, 'rb') as f:
+        for name, ps, attrs in components(records(f)):
+            component_types[name](*ps, circuit=circuit, **attrs)
+    return circuit
+
+def save(path, circuit=None, binary=False):
+    '''Writes the circuit to path as a netlist, with the definitions of its blocks.'''
+    circuit = _resolve(circuit)
+    names = {c.attrs['name']: None for c in circuit.register.values() if type(c) is block}
+    with open(path, 'wb') as f:
+        write(it.chain(definitions(names),
+                       (c.record() for c in circuit.register.values())), f, binary)
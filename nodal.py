@@ -0,0 +1,189 @@
+'''Modified nodal analysis: actual node voltages and branch currents instead of 0/1 flags.
+
+Every pin is a node. Pins with a ground terminal are held at 0V, and each positive terminal is an
+ideal voltage source between its pin and ground. Lamps and other parts with a resistance are
+conductances of 1/resistance, and zero-resistance parts (wires, pressed buttons) are very large
+conductances. Diodes and transistors are piecewise linear. Each one is either conducting or
+blocking, the circuit is solved, and any whose state disagrees with the result is flipped and the
+circuit solved again. The first guess is that those on the path graph (see
+electric.build_path_graph) conduct, which is right for most circuits, so they usually take one or
+two solves. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=6)
+    ...     l1 = lamp(0, 1)
+    ...     l2 = lamp(1, 2, resistance=2)
+    ...     t2 = terminal(2, voltage=0)
+    >>> s = solve(c)
+    >>> round(s.voltages[1], 6), round(s.currents[l1.sid], 6), round(s.lamp_power[1], 6)
+    (4.0, 2.0, 4.0)
+    >>> s.status
+    <settle_status.CONVERGED: 'converged'>
+
+If the diodes and transistors keep flipping, solve stops after max_iterations solves and the
+status says so (OSCILLATING if they went back to states tried before, STEP_LIMIT otherwise). The
+solution is then the last one worked out, from states the result disagrees with.
+
+The system is solved with SciPy's sparse solver when SciPy is installed. Otherwise a dense NumPy
+solve is used, which is only suitable for small circuits.
+'''
+from collections import namedtuple
+
+import numpy as np
+try:
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.linalg import spsolve
+except ImportError:
+    coo_matrix = None
+
+from electric import (_resolve, block, blocks, build_path_graph, button, diode, settle_status, terminal,
+                      transistor)
+
+short_conductance = 1e6     # Siemens, for parts with zero resistance
+open_conductance = 1e-9     # For blocking diodes and transistors
+gmin = 1e-12                # From every node to ground, so floating pins don't make the system singular
+
+nodal_solution = namedtuple('nodal_solution', 'voltages currents lamp_power iterations status')
+
+def _conductance(c):
+    return 1 / c.resistance if c.resistance else short_conductance
+
+def _expand(key, c, ps):
+    # (key, component, pins) for c, or for everything inside it if it's a block. Pins inside a
+    # block that aren't its ports become (key, pin), so every instance gets its own.
+    if type(c) is not block:
+        yield key, c, ps
+        return
+    d = c.definition
+    outer = dict(zip(d.ports, ps))
+    for x in d.circuit.register.values():
+        yield from _expand((key, x.sid), x, tuple(outer.get(p, (key, p)) for p in x.ps))
+
+def _elements(circuit):
+    # _expand for every component, keyed by component id and inside blocks by (block key, id)
+    elements = []
+    for c in circuit.register.values():
+        if type(c) is block: elements.extend(_expand(c.sid, c, c.ps))
+        else: elements.append((c.sid, c, c.ps))
+    return elements
+
+def _branches(elements, conducting):
+    # (key, component, pin a, pin b, conductance) for everything except terminals, with no key
+    # for the base of a transistor. conducting holds the keys of the diodes and transistors
+    # currently assumed to conduct.
+    for key, c, ps in elements:
+        if type(c) is terminal:
+            continue
+        if isinstance(c, transistor):
+            on = key in conducting
+            g = _conductance(c) if on else open_conductance
+            yield None, c, ps[1], ps[2], g          # Base to emitter, not reported
+            yield key, c, ps[0], ps[2], g           # Collector to emitter
+        elif isinstance(c, diode):
+            yield key, c, ps[0], ps[1], _conductance(c) if key in conducting else open_conductance
+        elif isinstance(c, button) and not c.on:
+            continue
+        else:
+            yield key, c, ps[0], ps[1], _conductance(c)
+
+def _first_guess(circuit, elements):
+    # The keys of the diodes and transistors current flows through on the path graph, or inside
+    # blocks on the block's own one
+    if not any(isinstance(c, (diode, transistor)) for key, c, ps in elements):
+        return set()        # Nothing to guess, so the path graph isn't needed
+    if next(circuit.get_sources(), None) is None:
+        return set()        # Nothing conducts
+    paths = build_path_graph(circuit)
+    inner = {d.circuit: d.paths for d in blocks.values()}
+    guess = set()
+    for key, c, ps in elements:
+        g = paths if c.circuit is circuit else inner[c.circuit]
+        if isinstance(c, transistor):
+            if c.p3 in g.get_conns(c.p2): guess.add(key)
+        elif isinstance(c, diode):
+            if c.p2 in g.get_conns(c.p1): guess.add(key)
+    return guess
+
+def _nodes(circuit, elements):
+    # The ground pins, the index of every other pin and the voltage of every pin with a positive
+    # terminal, which stay the same over solve's iterations. A pin takes the voltage of its
+    # first terminal, like get_terminal_voltage.
+    voltage = {}
+    for c in circuit.register.values():
+        if type(c) is terminal: voltage.setdefault(c.p1, c.voltage)
+    grounds = {p for p, v in voltage.items() if v == 0}
+    pins = dict.fromkeys(circuit.pcd)
+    pins.update((p, None) for key, c, ps in elements for p in ps)
+    nodes = {p: i for i, p in enumerate(p for p in pins if p not in grounds)}
+    sources = {p: v for p, v in voltage.items() if v and p in nodes}
+    return grounds, nodes, sources
+
+def _solve_linear(elements, conducting, grounds, nodes, sources):
+    n, m = len(nodes), len(sources)
+    branches = list(_branches(elements, conducting))
+    i = np.array([nodes.get(b[2], -1) for b in branches], dtype=np.intp)
+    j = np.array([nodes.get(b[3], -1) for b in branches], dtype=np.intp)
+    g = np.array([b[4] for b in branches], dtype=float)
+    # Each branch adds g at (i, i) and (j, j) and -g at (i, j) and (j, i), leaving out grounds.
+    # The entries go in branch by branch, so repeated entries add up in the same order, and to
+    # the same floats, as they would one stamp at a time.
+    both = (i >= 0) & (j >= 0)
+    keep = np.stack([i >= 0, j >= 0, both, both], 1).ravel()
+    rows = np.stack([i, j, i, j], 1).ravel()[keep]
+    cols = np.stack([i, j, j, i], 1).ravel()[keep]
+    vals = np.stack([g, g, -g, -g], 1).ravel()[keep]
+    at, extra = np.array([nodes[p] for p in sources], dtype=np.intp), np.arange(n, n + m)
+    diagonal = np.arange(n)
+    rows = np.concatenate([rows, diagonal, np.stack([at, extra], 1).ravel()])
+    cols = np.concatenate([cols, diagonal, np.stack([extra, at], 1).ravel()])
+    vals = np.concatenate([vals, np.full(n, gmin), np.ones(2 * m)])
+    rhs = np.concatenate([np.zeros(n), np.array(list(sources.values()), dtype=float)])
+
+    if coo_matrix is not None:
+        x = spsolve(coo_matrix((vals, (rows, cols)), shape=(n + m, n + m)).tocsc(), rhs)
+    else:
+        a = np.zeros((n + m, n + m))
+        np.add.at(a, (rows, cols), vals)
+        x = np.linalg.solve(a, rhs)
+    x = np.atleast_1d(x)
+    voltages = dict.fromkeys(grounds, 0.0)
+    voltages.update(zip(nodes, x[:n].tolist()))
+    return voltages, branches
+
+def solve(circuit=None, max_iterations=50):
+    '''Solves the circuit for the voltage at every pin, the current through every component (from
+    its first pin to its second, or collector to emitter for transistors) and the power drawn by
+    every lamp, keyed by pin, component id and lamp id. status is CONVERGED once the diodes and
+    transistors agree with the solution (see the module docstring).
+
+    Blocks are solved as the components inside them. Their inner pins are keyed (block id, pin)
+    and their inner components (block id, id), with the keys of the blocks around them in
+    place of the id for nested blocks. Lamps inside blocks only show up in currents.'''
+    circuit = _resolve(circuit)
+    elements = _elements(circuit)
+    conducting = _first_guess(circuit, elements)
+    system = _nodes(circuit, elements)
+    seen = {frozenset(conducting)}
+    status = settle_status.STEP_LIMIT
+    for iterations in range(1, max_iterations + 1):
+        voltages, branches = _solve_linear(elements, conducting, *system)
+        now = set()
+        for key, c, ps in elements:
+            if isinstance(c, transistor):
+                if voltages[ps[1]] > voltages[ps[2]]: now.add(key)
+            elif isinstance(c, diode):
+                if voltages[ps[0]] > voltages[ps[1]]: now.add(key)
+        if now == conducting:
+            status = settle_status.CONVERGED
+            break
+        if frozenset(now) in seen:
+            status = settle_status.OSCILLATING
+            break
+        seen.add(frozenset(now))
+        conducting = now
+    currents = {}
+    for key, c, a, b, g in branches:
+        if key is not None:
+            currents[key] = currents.get(key, 0.0) + g * (voltages[a] - voltages[b])
+    lamp_power = {k: currents[l.sid] ** 2 * l.resistance for k, l in circuit.lamp_register.items()}
+    return nodal_solution(voltages, currents, lamp_power, iterations, status)
@@ -0,0 +1,293 @@
+'''Settles one large circuit on several processes, split into strongly connected components.
+
+Every pin a component can change depends on the pins it works the new current out from: both
+pins of a wire, button or lamp on each other, a diode's second pin on its first and a
+transistor's emitter on all three of its pins. A terminal pin that only wires, buttons and lamps
+share with the terminal always ends up with current, so it depends on nothing. Any other terminal
+pin stays with the components that can take its current away. The pins are split into the
+strongly connected components of this dependency graph, and each component of the circuit goes
+to the partition of the pins it changes. Partitions only read partitions before them, so
+feedback loops stay inside one partition, and partitions whose dependencies are all done can run
+at the same time. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     for i in range(4):
+    ...         w = wire(0, (i, 1))
+    ...         d = diode((i, 1), (i, 2))
+    ...         l = lamp((i, 2), 'ground')
+    ...     t2 = terminal('ground', voltage=0)
+    >>> p = partition(get_all_paths_from_positive(c), c)
+    >>> [len(level) for level in p.levels]
+    [2, 4, 4]
+    >>> settle_parallel(get_all_paths_from_positive(c), circuit=c, processes=2, min_parallel=0)
+    parallel_result(partitions=10, levels=3, status=<settle_status.CONVERGED: 'converged'>)
+    >>> bytes(c.lamp_states)
+    b'\\x01\\x01\\x01\\x01'
+
+The terminals make up the first level, the wires the second and the diodes, each with the lamp
+after it, the third. settle_parallel runs the levels in order, handing the partitions of a level
+out to a pool of worker processes that read and write the pin currents and lamp states in shared
+memory. Each partition is swept the way settle sweeps the whole circuit, with its components at
+the same pins and in the same order, until a sweep changes nothing, so components that fight over
+a pin end up with the same winner as in settle.
+
+The lamps then match settle unless a feedback loop in the circuit can settle in more than one
+way, since settle's result then depends on how current reached the loop over earlier steps and
+a partition only sees the final current of the partitions before it.
+
+Splitting only pays off for circuits made of many parts that meet at terminals or through diodes
+and transistors: wires and lamps conduct both ways, so everything they join is one partition.
+Levels with fewer than min_parallel components run in this process, so long thin stretches of
+the circuit don't pay for a round trip to the workers.
+'''
+from array import array
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import gc
+import itertools as it
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+from graph import DirectedGraph, DisjointSet
+from electric import (Circuit, _resolve, _sweep_runs, block, blocks, button, define_block,
+                      diode, lamp, settle_status, terminal, transistor, wire)
+
+partitioning = namedtuple('partitioning', 'parts levels constant')
+parallel_result = namedtuple('parallel_result', 'partitions levels status')
+
+# For each pin of a component, the pins its new current is worked out from, or None if
+# propagate_current always hands its current back unchanged. Types not listed change every pin
+# from all of them.
+_reads = {
+    terminal: ((),),
+    diode: (None, (0,)),
+    transistor: (None, None, (0, 1, 2)),
+}
+# The same as (pin index, indices it is worked out from), leaving out the pins that don't change
+_rules = {t: [(k, js) for k, js in enumerate(rule) if js is not None] for t, rule in _reads.items()}
+
+# Types that never take current away from a pin, since they give every pin the current of
+# whichever of their pins has one
+_joining = (wire, button, lamp)
+
+def _writes(c):
+    # (pin id, ids of the pins it is worked out from) for every pin c can change
+    ids, rule = c.ids, _rules.get(type(c))
+    if rule is None:
+        return [(i, ids) for i in ids]
+    return [(ids[k], [ids[j] for j in js]) for k, js in rule]
+
+@contextmanager
+def _no_gc():
+    # Pauses the cyclic garbage collector. partition keeps a list, set or dict for nearly every
+    # pin and component, none of them in a cycle, and on a large circuit every full collection
+    # they set off walks all of the circuit's components again.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled: gc.enable()
+
+@_no_gc()
+def partition(paths, circuit=None):
+    '''Splits the components that settle would run into partitions. Returns a partitioning
+    with the components of each partition in parts, once for every pin settle's sweep runs them
+    at, and the indices into parts of every level in levels. A partition only depends on partitions of earlier levels. constant
+    holds the ids of the terminal pins nothing can take the current off.'''
+    circuit = _resolve(circuit)
+    runs = _sweep_runs(circuit, paths)
+    # Components are looked up by sid, since hashing an int is much cheaper than hashing them
+    active = list({c.sid: c for c in runs}.values())
+    # A terminal pin keeps its current if everything else that changes it only adds current.
+    # Other terminal pins go into a partition with whatever takes their current away, which
+    # then runs in settle's order, so whichever settle runs last wins there too. Wires, buttons
+    # and lamps, most of any circuit, are handled inline. _writes covers everything else and is
+    # called again below rather than kept, as a list per component is mostly work for the
+    # garbage collector on large circuits, and so are edges kept as pairs.
+    terminals, taken = set(), set()
+    for c in active:
+        if type(c) is terminal: terminals.add(c.ids[0])
+        elif type(c) not in _joining: taken.update(i for i, _ in _writes(c))
+    constant = terminals - taken
+    # Pins a component works out from each other are always in one partition, so they are
+    # joined first and only what is left goes through Tarjan's algorithm. Every component goes
+    # with the first pin it changes that isn't constant.
+    ds, edges, first = DisjointSet(), [], {}
+    for c in active:
+        if type(c) is terminal:
+            first[c.sid] = c.ids[0]
+            continue
+        if type(c) in _joining:
+            i, j = c.ids
+            if i in constant:
+                if j not in constant:
+                    edges += i, j
+                    i = j
+            elif j in constant: edges += j, i
+            elif i != j: ds.union(i, j)
+            first[c.sid] = i
+            continue
+        ws = _writes(c)
+        reads = dict(ws)
+        for i, js in ws:
+            if i in constant: continue
+            for j in js:
+                if j == i: continue
+                if i in reads.get(j, ()) and j not in constant: ds.union(i, j)
+                else: edges += j, i
+        first[c.sid] = next((i for i, _ in ws if i not in constant), ws[0][0])
+    find = ds.find
+    ends = map(find, edges)
+    graph = DirectedGraph.from_edges((a, b) for a, b in zip(ends, ends) if a != b)
+    home = {sid: find(i) for sid, i in first.items()}
+    sccs = graph.strongly_connected_components()
+    nodes = {i for scc in sccs for i in scc}
+    sccs[:0] = [(i,) for i in dict.fromkeys(home.values()) if i not in nodes]   # No edge touches
+    scc_of = {i: k for k, scc in enumerate(sccs) for i in scc}
+    level = [0] * len(sccs)
+    for k, scc in enumerate(sccs):      # In topological order, so predecessors come first
+        for i in scc:
+            for j in graph.get_conns(i):
+                if scc_of[j] != k and level[scc_of[j]] <= level[k]:
+                    level[scc_of[j]] = level[k] + 1
+    # Each partition runs its components where and in the order settle's sweep does
+    members = defaultdict(list)
+    for c in runs:
+        members[scc_of[home[c.sid]]].append(c)
+    parts, levels = [], defaultdict(list)
+    for k in sorted(members, key=level.__getitem__):
+        levels[level[k]].append(len(parts))
+        parts.append(members[k])
+    return partitioning(parts, [levels[n] for n in sorted(levels)], frozenset(constant))
+
+def _settle_part(cs, max_steps):
+    # Sweeps the partition the way settle sweeps the circuit until a sweep changes nothing
+    pct = cs[0].circuit.pct.buffer
+    pins = sorted({i for c in cs for i in c.ids})
+    lamps = list(dict.fromkeys(c for c in cs if isinstance(c, lamp)))
+    def state():
+        return tuple([pct[i] for i in pins]), tuple([l.on for l in lamps])
+    old = state()
+    seen = {hash(old)}
+    for n in range(max_steps):
+        for c in cs:
+            ids = c.ids
+            for i, v in zip(ids, c.propagate_current(*[pct[i] for i in ids])):
+                pct[i] = v
+        new = state()
+        if new == old:
+            return settle_status.CONVERGED
+        h = hash(new)
+        if h in seen:
+            return settle_status.OSCILLATING
+        seen.add(h)
+        old = new
+    return settle_status.STEP_LIMIT
+
+def _run_parts(parts, indices, max_steps):
+    # The first partition in indices that didn't converge and its status, or None
+    for k in indices:
+        status = _settle_part(parts[k], max_steps)
+        if status is not settle_status.CONVERGED:
+            return k, status
+    return None
+
+def _attach(circuit, memory, sizes):
+    # Points the circuit's pin currents and lamp states at the shared memory
+    circuit.pct.buffer = memory[0].buf[:sizes[0]].cast('b')
+    circuit.lamp_states = memory[1].buf[:sizes[1]]
+
+def _detach(circuit):
+    # Copies the pin currents and lamp states out of shared memory, so it can be closed
+    views = circuit.pct.buffer, circuit.lamp_states
+    circuit.pct.buffer, circuit.lamp_states = array('b', views[0]), bytearray(views[1])
+    for v in views:
+        v.release()
+
+_worker = None          # In a worker process: (partitions, max_steps, shared memory)
+
+def _init(circuit, memory, sizes, parts, max_steps, definitions):
+    global _worker
+    if not isinstance(circuit, Circuit):        # Spawned, so built again from its description
+        for d in definitions:
+            define_block(*d)
+        circuit = Circuit.from_description(circuit)
+    _attach(circuit, memory, sizes)
+    _worker = ([[circuit.register[sid] for sid in part] for part in parts], max_steps, memory)
+
+def _run(indices):
+    parts, max_steps, _ = _worker
+    return _run_parts(parts, indices, max_steps)
+
+def _chunks(level, parts, n):
+    # Splits a level into at most n chunks with about as many components each
+    size = sum(len(parts[k]) for k in level) / n
+    chunks, chunk, total = [], [], 0
+    for k in level:
+        chunk.append(k)
+        total += len(parts[k])
+        if total >= size:
+            chunks.append(chunk)
+            chunk, total = [], 0
+    if chunk: chunks.append(chunk)
+    return chunks
+
+def _pool(circuit, memory, sizes, p, max_steps, processes):
+    # Forked workers share the circuit as it is, spawned ones get its description
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context, payload, definitions = multiprocessing.get_context('fork'), circuit, None
+    else:
+        context, payload = multiprocessing.get_context(), circuit.describe()
+        definitions = [(name, d.description, d.ports) for name, d in blocks.items()]
+    sids = [[c.sid for c in part] for part in p.parts]
+    return ProcessPoolExecutor(processes, context, _init,
+                               (payload, memory, sizes, sids, max_steps, definitions))
+
+def settle_parallel(paths, max_steps=1000, circuit=None, processes=None, min_parallel=10000):
+    '''Settles the circuit level by level (see the module docstring), running the partitions of
+    each level with at least min_parallel components on processes worker processes (by default
+    one per CPU). Partitions that take max_steps rounds stop the run. Returns a parallel_result
+    with the number of partitions and levels and the status of the first partition that didn't
+    converge, or CONVERGED.'''
+    circuit = _resolve(circuit)
+    p = partition(paths, circuit)
+    processes = processes or os.cpu_count() or 1
+    sizes = len(circuit.pct.buffer), len(circuit.lamp_states)
+    memory = [SharedMemory(create=True, size=max(1, n)) for n in sizes]
+    pool, status = None, settle_status.CONVERGED
+    try:
+        memory[0].buf[:sizes[0]] = circuit.pct.buffer.tobytes()
+        memory[1].buf[:sizes[1]] = circuit.lamp_states
+        _attach(circuit, memory, sizes)
+        for i in p.constant:        # Before anything reads them, as settle has it after a step
+            circuit.pct.buffer[i] = 1
+        try:
+            for level in p.levels:
+                if processes > 1 and sum(len(p.parts[k]) for k in level) >= min_parallel:
+                    if pool is None:
+                        pool = _pool(circuit, memory, sizes, p, max_steps, processes)
+                    failures = pool.map(_run, _chunks(level, p.parts, processes * 4))
+                else:
+                    failures = [_run_parts(p.parts, level, max_steps)]
+                failure = next(filter(None, failures), None)
+                if failure is not None:
+                    status = failure[1]
+                    break
+        finally:
+            _detach(circuit)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for m in memory:
+            m.close()
+            m.unlink()
+    # Workers ran the blocks on their own copies, so bring lit and on up to date here
+    pct = circuit.pct.buffer
+    for c in it.chain.from_iterable(p.parts):
+        if type(c) is block:
+            c.propagate_current(*[pct[i] for i in c.ids])
+    return parallel_result(len(p.parts), len(p.levels), status)
@@ -0,0 +1,100 @@
+'''Spatial index over 2D points, for snapping the cursor to pins in the editor.
+
+Points go into a uniform grid of square cells, so finding the nearest point within a radius
+only looks at the cells around the query. For lining the cursor up with points, the points are
+also kept sorted by x and by y, so the points with an x (or y) near the cursor's are found by
+bisection. Example:
+
+    >>> index = SpatialIndex(10)
+    >>> for p in [(0, 0), (100, 4), (55, 200)]: index.add(p)
+    >>> index.nearest((3, 2), 10), index.nearest((30, 30), 10)
+    ((0, 0), None)
+    >>> index.aligned((53, 1), 10)
+    ((55, 200), (0, 0))
+
+A point can be added more than once, for instance when two components share a pin, and stays
+in the index until it is removed as often as it was added. Adding and removing cost O(log n)
+plus shifting the sorted lists. Queries cost O(log n) plus the points near the cursor.
+'''
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+import math
+
+class SpatialIndex:
+    def __init__(self, cell=10):
+        self.cell = cell
+        self.counts = Counter()             # Point -> times added
+        self.cells = defaultdict(set)       # Cell -> points in it
+        self.by_x = []                      # Sorted (x, y)
+        self.by_y = []                      # Sorted (y, x)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, p):
+        return p in self.counts
+
+    def _cell(self, p):
+        return (math.floor(p[0] / self.cell), math.floor(p[1] / self.cell))
+
+    def add(self, p):
+        p = tuple(p)
+        self.counts[p] += 1
+        if self.counts[p] == 1:
+            self.cells[self._cell(p)].add(p)
+            insort(self.by_x, p)
+            insort(self.by_y, p[::-1])
+
+    def remove(self, p):
+        p = tuple(p)
+        self.counts[p] -= 1
+        if self.counts[p] == 0:
+            del self.counts[p]
+            cell = self._cell(p)
+            self.cells[cell].discard(p)
+            if not self.cells[cell]: del self.cells[cell]
+            del self.by_x[bisect_left(self.by_x, p)]
+            del self.by_y[bisect_left(self.by_y, p[::-1])]
+
+    @staticmethod
+    def from_points(points, cell=10):
+        index = SpatialIndex(cell)
+        for p in points:
+            index.add(p)
+        return index
+
+    def nearest(self, p, r):
+        '''The point closest to p that is less than r away from it, or None.'''
+        x, y = p
+        reach = math.ceil(r / self.cell)
+        cx, cy = self._cell(p)
+        best, best_d = None, r * r
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for q in self.cells.get((i, j), ()):
+                    d = (q[0] - x) ** 2 + (q[1] - y) ** 2
+                    if d < best_d or (d == best_d and best is not None and q < best):
+                        best, best_d = q, d
+        return best
+
+    @staticmethod
+    def _closest(keys, a, b, r):
+        # keys are sorted (a, b) pairs. Finds the a value closest to a that is less than r away,
+        # and among the keys with that a value the one whose b is closest to b.
+        i = bisect_left(keys, (a,))
+        vs = [keys[k][0] for k in (i - 1, i) if 0 <= k < len(keys) and abs(keys[k][0] - a) < r]
+        if not vs:
+            return None
+        v = min(vs, key=lambda v: (abs(v - a), v))
+        j = bisect_left(keys, (v, b))
+        ks = [keys[k] for k in (j - 1, j) if 0 <= k < len(keys) and keys[k][0] == v]
+        return min(ks, key=lambda k: (abs(k[1] - b), k[1]))
+
+    def aligned(self, p, r):
+        '''Returns the point whose x is closest to p's x and the one whose y is closest to p's y,
+        as long as the difference is less than r (None otherwise). Ties go to the point closest
+        along the other axis.'''
+        x, y = p
+        px = self._closest(self.by_x, x, y, r)
+        py = self._closest(self.by_y, y, x, r)
+        return px, None if py is None else py[::-1]
@@ -0,0 +1,34 @@
+from electric import *
+from batch import simulate, simulate_batch
+from cache import SimulationCache
+import itertools as it
+
+def _description():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        button(0, 1)
+        lamp(1, 3)
+        button(0, 2)
+        lamp(2, 3)
+        terminal(3, voltage=0)
+    return c.describe()
+
+def test_simulate():
+    r = simulate(_description(), {2: True})
+    assert r.lamps == {1: True, 2: False}
+    assert r.status is settle_status.CONVERGED
+
+def test_simulate_batch_matches_serial():
+    d = _description()
+    jobs = [(d, {2: a, 4: b}) for a, b in it.product([False, True], repeat=2)] * 5
+    results = simulate_batch(jobs, max_workers=2)
+    assert results == [simulate(*job) for job in jobs]
+    assert [r.lamps for r in results[:4]] == [
+        {1: False, 2: False}, {1: False, 2: True}, {1: True, 2: False}, {1: True, 2: True}]
+
+def test_simulate_cached():
+    cache = SimulationCache()
+    d = _description()
+    for buttons in ({2: True}, {4: True}, {2: True}, {}, {4: True}):
+        assert simulate(d, buttons, cache=cache) == simulate(d, buttons)
+    assert cache.hits >= 2
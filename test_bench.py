@@ -0,0 +1,25 @@
+import bench
+import json
+
+def test_generators_settle():
+    results = bench.run(scale=0.05, repeat=1)
+    assert set(r.split('/')[0] for r in results) == set(bench.generators)
+    for r in results.values():
+        assert r['status'] == 'converged'
+        assert r['components'] > 0 and r['bytes_per_component'] > 0 and r['partition'] > 0
+    json.dumps(results)
+
+def test_generated_lamps_light():
+    c = bench.transistors(5)
+    bench.settle(bench.get_all_paths_from_positive(c), circuit=c)
+    assert all(l.on for l in c.lamp_register.values())
+    assert not bench.detect_shorts(circuit=bench.grid(4))
+
+def test_compare():
+    baseline = {'chain/10': {'paths': 1.0, 'shorts': 1.0, 'settle': 1.0, 'bytes_per_component': 100}}
+    results = {'chain/10': {'paths': 1.1, 'shorts': 2.0, 'settle': 0.5, 'partition': 9.0,
+                            'bytes_per_component': 130},
+               'grid/3': {'paths': 9.0, 'shorts': 9.0, 'settle': 9.0, 'bytes_per_component': 900}}
+    assert bench.compare(results, baseline) == [
+        bench.regression('chain/10', 'shorts', 1.0, 2.0),
+        bench.regression('chain/10', 'bytes_per_component', 100, 130)]
@@ -0,0 +1,89 @@
+from electric import *
+from cache import SimulationCache, circuit_key
+
+def _circuit():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b = button(0, 1)
+        lamp(1, 2)
+        transistor(0, 1, 3)
+        lamp(3, 2, resistance=2)
+        terminal(2, voltage=0)
+    return c, b
+
+def test_key():
+    c, b = _circuit()
+    key = circuit_key(c)
+    assert circuit_key(Circuit.from_description(c.describe())) == key
+    b.on = True
+    assert circuit_key(c) != key
+    b.on = False
+    assert circuit_key(c) == key
+    with Circuit() as other:
+        terminal(0, voltage=1)
+    assert circuit_key(other) != key
+
+def test_paths_and_settle_match():
+    cache = SimulationCache()
+    for on in (False, True, False, True):
+        c, b = _circuit()
+        b.on = on
+        fresh = Circuit.from_description(c.describe())
+        fresh.register[b.sid].on = on
+        assert sorted(cache.paths(c).edges()) == sorted(build_path_graph(fresh).edges())
+        assert cache.settle(circuit=c) == settle(build_path_graph(fresh), circuit=fresh)
+        assert c.pct.buffer == fresh.pct.buffer
+        assert [l.on for l in c.lamp_register.values()] == [l.on for l in fresh.lamp_register.values()]
+    assert cache.hits > 0
+
+def test_incremental_simulator():
+    cache = SimulationCache()
+    c, b = _circuit()
+    sim = IncrementalSimulator(c, cache)
+    sim.toggle(b)
+    while sim.step(): pass
+    cache.save_state(c)
+    again, b2 = _circuit()
+    b2.on = True
+    sim = IncrementalSimulator(again, cache)
+    assert sorted(sim.paths.edges()) == sorted(build_path_graph(again).edges())
+    assert cache.restore_state(again)
+    assert again.pct.buffer == c.pct.buffer
+    assert [l.on for l in again.lamp_register.values()] == [l.on for l in c.lamp_register.values()]
+    hits = cache.hits
+    IncrementalSimulator(_circuit()[0], cache)
+    assert cache.hits == hits + 1
+
+def test_lru():
+    cache = SimulationCache(maxsize=2)
+    (c1, b1), (c2, b2), (c3, b3) = _circuit(), _circuit(), _circuit()
+    b2.on = True
+    c3.register[1].attrs['voltage'] = 2
+    cache.paths(c1)
+    cache.paths(c2)
+    cache.paths(c1)                     # Now c2 is the least recently used
+    cache.paths(c3)
+    assert len(cache) == 2
+    misses = cache.misses
+    cache.paths(c1)
+    assert cache.misses == misses
+    cache.paths(c2)
+    assert cache.misses == misses + 1
+
+def test_settle_restores_blocks():
+    define_block('test_cache_tl', [('lamp', ('a', 'm'), {}), ('lamp', ('m', 'b'), {})], ('a', 'b'))
+    cache = SimulationCache()
+    for n in range(2):
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            b = block(0, 1, name='test_cache_tl')
+            terminal(1, voltage=0)
+        cache.settle(circuit=c)
+        assert b.on and b.lit == b'\x01\x01'
+    assert cache.hits == 1
+    b.on, b.lit = False, bytes(2)
+    cache.save_state(c)
+    cache.settle(circuit=c)
+    assert b.on and b.lit == b'\x01\x01'
+    assert cache.restore_state(c)
+    assert not b.on and b.lit == bytes(2)
@@ -0,0 +1,44 @@
+from cli import main
+import json
+import os
+import subprocess
+import sys
+
+netlist = '''# xedek netlist
+terminal 0 voltage=1
+button 0 1 on=True
+wire 0 2
+lamp 2 3
+lamp 1 3
+terminal 3 voltage=0
+'''
+
+def _run(tmp_path, capsys, text, *args):
+    path = tmp_path / 'circuit.xnl'
+    path.write_text(text)
+    status = main([str(path), *args])
+    return status, json.loads(capsys.readouterr().out)
+
+def test_settles(tmp_path, capsys):
+    status, result = _run(tmp_path, capsys, netlist)
+    assert status == 0
+    assert result['lamps'] == {'1': True, '2': True}
+    assert result['status'] == 'converged' and result['shorts'] == []
+    assert set(result['timings']) == {'import', 'load', 'paths', 'shorts', 'settle', 'total'}
+
+def test_shorts_and_errors(tmp_path, capsys):
+    status, result = _run(tmp_path, capsys, 'terminal 0 voltage=1\nwire 0 1\nterminal 1 voltage=0\n')
+    assert status == 1
+    assert result['shorts'] == [{'source': 0, 'ground': 1, 'components': [2]}]
+    status, result = _run(tmp_path, capsys, 'wire 0 1\nlamp 1 2\n')
+    assert status == 0 and result['lamps'] == {'1': False}
+    assert main([str(tmp_path / 'missing.xnl')]) == 2
+
+def test_stdin_without_pygame():
+    # A fresh interpreter, so the modules imported by the test run don't count
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = 'import sys, cli; r = cli.main(["-"]); print(sorted(m for m in sys.modules if m in ("pygame", "draw_utils", "front")))'
+    out = subprocess.run([sys.executable, '-c', code], input=netlist.encode(), cwd=here,
+                         capture_output=True, check=True).stdout.decode().splitlines()
+    assert json.loads(out[0])['lamps'] == {'1': True, '2': True}
+    assert out[1] == '[]'
@@ -0,0 +1,136 @@
+from electric import *
+from compiled import compile_circuit
+import itertools as it
+import pytest
+import random
+
+def _build():
+    terminal(0, voltage=1)
+    button(0, 1)
+    lamp(1, 9)
+    wire(1, 2)
+    wire(2, 3)
+    wire(3, 1)
+    button(3, 4)
+    diode(4, 5)
+    lamp(5, 9)
+    button(0, 6)
+    transistor(0, 6, 7)
+    lamp(7, 9)
+    wire(6, 8)
+    lamp(8, 9)
+    terminal(9, voltage=0)
+
+def _run_scalar(c, states):
+    for b, on in zip((x for x in c.register.values() if type(x) is button), states):
+        b.on = on
+    c.pct.clear()
+    for l in c.lamp_register.values():
+        l.on = False
+    settle(get_all_paths_from_positive(c), circuit=c)
+    return {k: l.on for k, l in c.lamp_register.items()}
+
+def test_compiled_matches_scalar():
+    with Circuit() as c:
+        _build()
+    f = compile_circuit(c)
+    assert f.buttons == [2, 7, 10]
+    for states in it.product([False, True], repeat=3):
+        assert f(*states) == _run_scalar(c, states)
+
+def test_compiled_cache():
+    with Circuit() as c1:
+        _build()
+    with Circuit() as c2:
+        _build()
+    assert compile_circuit(c1) is compile_circuit(c2)
+    with Circuit() as c3:
+        _build()
+        wire(5, 9)
+    assert compile_circuit(c3) is not compile_circuit(c1)
+
+def test_compiled_two_buttons_into_one_pin():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        terminal(5, voltage=0)
+        button(3, 4)
+        lamp(2, 5)
+        button(3, 4)
+        button(1, 3)
+        lamp(4, 2)
+    f = compile_circuit(c)
+    for states in it.product([False, True], repeat=3):
+        assert f(*states) == _run_scalar(c, states)
+
+def test_compiled_matches_scalar_random():
+    types = [wire, lamp, button, diode, transistor]
+    for seed in range(100):
+        rng = random.Random(seed)
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            terminal(1, voltage=0)
+            for i in range(rng.randrange(4, 14)):
+                t = rng.choice(types)
+                t(*(rng.randrange(8) for p in range(3 if t is transistor else 2)))
+        f = compile_circuit(c)
+        n = len(f.buttons)
+        for states in it.islice(it.product([False, True], repeat=n), 8):
+            try:
+                expected = _run_scalar(c, states)
+            except TypeError:       # No positive terminal left on a path
+                break
+            assert f(*states) == expected, (seed, states)
+
+def test_compiled_blocks():
+    define_block('test_compiled_cell', [('lamp', ('a', 'b'), {}), ('lamp', ('a', 'd'), {})], ('a', 'b'))
+    try:
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            b = button(0, 1)
+            block(1, 2, name='test_compiled_cell')
+            lamp(2, 3)
+            terminal(3, voltage=0)
+        f = compile_circuit(c)
+        assert f(False) == {1: False} and f(True) == {1: True}
+        b.on = True
+        settle(get_all_paths_from_positive(c), circuit=c)
+        assert [x.lit for x in c.register.values() if type(x) is block] == [b'\x01\x00']
+    finally:
+        del blocks['test_compiled_cell']
+
+def test_compiled_loops_stay_compiled(monkeypatch):
+    # Loops that fold into chains and parallel edges never call back into electric, and a
+    # bridge only once for each set of its edges
+    import electric
+    calls = []
+    spe = electric._simple_path_edges
+    def run(f, states):
+        monkeypatch.setattr(electric, '_simple_path_edges', lambda *a: calls.append(1) or spe(*a))
+        got = [f(*s) for s in states]
+        monkeypatch.setattr(electric, '_simple_path_edges', spe)
+        return got
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        button(0, 1)
+        button(0, 2)
+        lamp(1, 3)
+        lamp(2, 3)
+        wire(3, 4)
+        lamp(4, 5)
+        wire(5, 3)
+        lamp(3, 9)
+        terminal(9, voltage=0)
+    states = list(it.product([False, True], repeat=2))
+    assert run(compile_circuit(c), states) == [_run_scalar(c, s) for s in states]
+    assert not calls
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        wire(0, 1)
+        wire(0, 2)
+        lamp(1, 3)
+        lamp(2, 3)
+        button(1, 2)
+        terminal(3, voltage=0)
+    states = [(False,), (True,)] * 3
+    assert run(compile_circuit(c), states) == [_run_scalar(c, s) for s in states]
+    assert len(calls) <= 2
@@ -1,5 +1,8 @@
 from electric import *
+import electric
+import itertools as it
 import pytest
+import sys
 
 @pytest.fixture
 def linear_circuit():
@@ -18,4 +21,506 @@ def test_linear_component_init(linear_circuit):
 def test_linear_get_connected_components(linear_circuit):
     assert list(c.sid for c in component.get_component(2).get_connections()) == [1, 3]
 
-def test_
+def test_linear_get_all_paths_from_positive(linear_circuit):
+    assert sorted(get_all_paths_from_positive().edges()) == [(0, 1), (1, 2)]
+
+def _edge_set(g):
+    return set(g.edges())
+
+circuits = [
+    lambda: (terminal(0, voltage=1), wire(0, 1), wire(0, 2), lamp(1, 3), lamp(2, 3), terminal(3, voltage=0)),
+    lambda: (terminal(0, voltage=1), wire(0, 1), wire(0, 2), wire(1, 2), wire(1, 3), lamp(2, 3), terminal(3, voltage=0)),
+    lambda: (terminal(0, voltage=1), wire(0, 1), wire(1, 5), wire(5, 6), lamp(1, 2), terminal(2, voltage=0)),
+    lambda: (terminal(0, voltage=1), diode(0, 1), wire(1, 2), diode(3, 2), lamp(2, 4), terminal(4, voltage=0)),
+    lambda: (terminal(0, voltage=1), button(0, 1), wire(0, 2), lamp(1, 3), lamp(2, 3), terminal(3, voltage=0)),
+    lambda: (terminal(0, voltage=1), transistor(0, 1, 2), wire(0, 1), lamp(2, 3), terminal(3, voltage=0)),
+    lambda: (terminal(0, voltage=1), lamp(0, 1), terminal(1, voltage=0), terminal(5, voltage=1), wire(5, 6), lamp(6, 7), terminal(7, voltage=0)),
+    lambda: (terminal(0, voltage=1), wire(0, 1), lamp(1, 4), terminal(4, voltage=0), lamp(1, 2), wire(2, 3), wire(3, 1)),
+    lambda: (terminal(0, voltage=1), diode(0, 1), wire(1, 2), wire(0, 3), diode(3, 2), diode(2, 5), lamp(2, 4), terminal(4, voltage=0)),
+]
+
+@pytest.mark.parametrize('build', circuits)
+def test_path_graph_matches_enumerator(build):
+    build()
+    try:
+        assert _edge_set(build_path_graph()) == _edge_set(electric._get_all_paths_from_positive())
+    finally:
+        component.reset_class()
+
+def test_path_graph_matches_enumerator_random():
+    # Extra edges only ever run the other way round a loop, and settle lights the same lamps
+    import random
+    for seed in range(400):
+        def make():
+            rng = random.Random(seed)
+            n = rng.randint(4, 9)
+            with Circuit() as c:
+                terminal(0, voltage=1)
+                terminal(n - 1, voltage=0)
+                for i in range(rng.randint(3, 14)):
+                    x = rng.choice([wire, wire, lamp, button])(*rng.sample(range(n), 2))
+                    if type(x) is button: x.on = rng.random() < 0.5
+            return c
+        a, b = make(), make()
+        if detect_shorts(circuit=a):
+            continue
+        old, new = _edge_set(electric._get_all_paths_from_positive(a)), _edge_set(build_path_graph(a))
+        assert old <= new, seed
+        assert all((e.to, e.from_) in old for e in new - old), seed
+        settle(electric._get_all_paths_from_positive(a), circuit=a)
+        settle(build_path_graph(b), circuit=b)
+        assert a.lamp_states == b.lamp_states, seed
+
+def test_path_graph_without_sources():
+    wire(0, 1)
+    try:
+        with pytest.raises(TypeError):
+            build_path_graph()
+    finally:
+        component.reset_class()
+
+def _lamp_states():
+    return {k: l.on for k, l in lamp.lamp_register.items()}
+
+def _reset_run():
+    component.pct.clear()
+    for l in lamp.lamp_register.values():
+        l.on = False
+
+@pytest.mark.parametrize('build', circuits)
+def test_event_propagator_matches_sweep(build):
+    build()
+    try:
+        dg = get_all_paths_from_positive()
+        for _ in range(10):
+            propagate_current_step(dg)
+        expected = _lamp_states()
+        _reset_run()
+        e = EventPropagator(dg)
+        for _ in range(10):
+            e.step()
+        assert _lamp_states() == expected
+        assert e.step() == 0
+    finally:
+        component.reset_class()
+
+def test_event_propagator_matches_sweep_random():
+    # Every step, including where diodes and transistors fight over a pin
+    import random
+    for seed in range(300):
+        def make():
+            rng = random.Random(seed)
+            with Circuit() as c:
+                terminal(0, voltage=1)
+                terminal(1, voltage=0)
+                for i in range(rng.randrange(5, 30)):
+                    t = rng.choice([wire, lamp, button, diode, transistor])
+                    x = t(*(rng.randrange(10) for p in range(3 if t is transistor else 2)))
+                    if t is button: x.on = rng.random() < 0.5
+            return c
+        a, b = make(), make()
+        try:
+            paths = get_all_paths_from_positive(a)
+        except TypeError:       # No path from the positive terminal
+            continue
+        e = EventPropagator(get_all_paths_from_positive(b), b)
+        for _ in range(10):
+            propagate_current_step(paths, a)
+            e.step()
+            assert (a.pct.buffer, a.lamp_states) == (b.pct.buffer, b.lamp_states), seed
+
+def test_event_propagator_button_press():
+    terminal(0, voltage=1)
+    b = button(0, 1)
+    l1 = lamp(1, 2)
+    w = wire(0, 3)
+    l2 = lamp(3, 2)
+    terminal(2, voltage=0)
+    try:
+        e = EventPropagator(get_all_paths_from_positive())
+        while e.step(): pass
+        assert (l1.on, l2.on) == (False, True)
+        b.on = True
+        e.set_paths(get_all_paths_from_positive())
+        assert 3 not in e.queued
+        while e.step(): pass
+        assert (l1.on, l2.on) == (True, True)
+    finally:
+        component.reset_class()
+
+def test_settle_converges(linear_circuit):
+    steps, status = settle(get_all_paths_from_positive())
+    assert status is settle_status.CONVERGED
+    assert component.get_component(3).on
+    assert settle(get_all_paths_from_positive(), max_steps=5) == (1, settle_status.CONVERGED)
+
+def test_settle_step_limit(linear_circuit):
+    assert settle(get_all_paths_from_positive(), max_steps=1) == (1, settle_status.STEP_LIMIT)
+
+def test_settle_oscillating():
+    class toggle(wire):
+        def propagate_current(self, i1, i2):
+            return [i1, 0 if i2 else 1]
+    terminal(0, voltage=1)
+    toggle(0, 1)
+    diode(1, 2)
+    terminal(2, voltage=0)
+    try:
+        assert settle(get_all_paths_from_positive()).status is settle_status.OSCILLATING
+    finally:
+        component.reset_class()
+
+def test_circuits_are_independent():
+    with Circuit() as c1:
+        terminal(0, voltage=1)
+        l1 = lamp(0, 1)
+        terminal(1, voltage=0)
+    c2 = Circuit()
+    terminal(0, voltage=1, circuit=c2)
+    b = button(0, 1, circuit=c2)
+    l2 = lamp(1, 2, circuit=c2)
+    terminal(2, voltage=0, circuit=c2)
+    assert component.register == {}
+    assert l1.lamp_sid == l2.lamp_sid == 1
+    assert settle(get_all_paths_from_positive(c1), circuit=c1).status is settle_status.CONVERGED
+    assert not list(get_all_paths_from_positive(c2).edges())
+    assert settle(build_path_graph(c1), circuit=c1).steps == 1
+    assert (l1.on, l2.on) == (True, False)
+
+def test_circuits_in_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    def simulate(n):
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            for i in range(n):
+                wire(i, i + 1)
+            l = lamp(n, n + 1)
+            terminal(n + 1, voltage=0)
+        settle(get_all_paths_from_positive(c), circuit=c)
+        return len(c.register), l.on
+    with ThreadPoolExecutor(4) as ex:
+        assert list(ex.map(simulate, range(1, 9))) == [(n + 3, True) for n in range(1, 9)]
+    assert component.register == {}
+
+def test_detect_shorts_none(linear_circuit):
+    assert detect_shorts(get_all_paths_from_positive()) == []
+
+def test_detect_shorts():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        wire(0, 1)
+        lamp(1, 3)
+        b = button(1, 2)
+        wire(2, 3)
+        terminal(3, voltage=0)
+        terminal(5, voltage=1)
+        lamp(5, 3)
+    assert detect_shorts(circuit=c) == []
+    b.on = True
+    assert detect_shorts(circuit=c) == [short(0, 3, [2, 4, 5])]
+    assert detect_shorts(s=5, circuit=c) == []
+
+@pytest.mark.parametrize('build', circuits)
+def test_settle_collapsed_matches_settle(build):
+    build()
+    try:
+        settle(get_all_paths_from_positive())
+        expected = _lamp_states()
+        _reset_run()
+        for k, l in lamp.lamp_register.items():
+            expected[k] = expected[k] and _on_simple_net_path(l, Circuit.current())
+        settle_collapsed()
+        assert _lamp_states() == expected
+    finally:
+        component.reset_class()
+
+def _on_simple_net_path(l, c):
+    # Whether some positive-to-ground path through l enters each net of wired pins once
+    parent = {}
+    def net(p):
+        while parent.get(p, p) != p:
+            p = parent[p]
+        return p
+    adj = {}
+    def edge(x, a, b):
+        adj.setdefault(net(a), []).append((x, net(b)))
+    for x in c.register.values():
+        if type(x) is wire:
+            parent[net(x.p1)] = net(x.p2)
+    for x in c.register.values():
+        t = type(x)
+        if t is lamp or t is button and x.on:
+            edge(x, x.p1, x.p2)
+            edge(x, x.p2, x.p1)
+        elif t is diode:
+            edge(x, x.p1, x.p2)
+        elif t is transistor:
+            edge(x, x.p1, x.p3)
+            edge(x, x.p2, x.p3)
+    grounds = {net(x.p1) for x in c.register.values() if type(x) is terminal and x.voltage == 0}
+    def walk(n, seen, used):
+        if used and n in grounds:
+            return True
+        return any(walk(m, seen | {m}, used or x is l)
+                   for x, m in adj.get(n, ()) if m not in seen)
+    return any(walk(net(p), {net(p)}, False) for p in c.get_sources())
+
+def test_settle_collapsed_lamp_rule(monkeypatch):
+    # Lamps differ from settle exactly where CollapsedCircuit says, unless a diode or
+    # transistor takes current off a pin
+    import random
+    took = []
+    def watch(propagate, takes):
+        def f(self, *currents):
+            if takes(*currents):
+                took.append(self)
+            return propagate(self, *currents)
+        return f
+    monkeypatch.setattr(diode, 'propagate_current',
+                        watch(diode.propagate_current, lambda i1, i2: i2 and not i1))
+    monkeypatch.setattr(transistor, 'propagate_current',
+                        watch(transistor.propagate_current, lambda i1, i2, i3: i2 and i3 and not i1))
+    checked = 0
+    for seed in range(1000):
+        def make():
+            rng = random.Random(seed)
+            n = rng.randint(4, 9)
+            with Circuit() as c:
+                terminal(0, voltage=1)
+                terminal(n - 1, voltage=0)
+                for i in range(rng.randint(3, 14)):
+                    t = rng.choice([wire, wire, wire, lamp, lamp, button, diode, transistor])
+                    x = t(*rng.sample(range(n), 3 if t is transistor else 2))
+                    if t is button: x.on = rng.random() < 0.5
+            return c
+        a, b = make(), make()
+        if detect_shorts(circuit=a):
+            continue
+        del took[:]
+        settle(get_all_paths_from_positive(a), circuit=a)
+        settle_collapsed(circuit=b)
+        if took:
+            continue
+        checked += 1
+        for k, l in a.lamp_register.items():
+            assert b.lamp_register[k].on == (l.on and _on_simple_net_path(l, a)), seed
+    assert checked > 250
+
+def test_collapsed_circuit_size():
+    terminal(0, voltage=1)
+    for i in range(100):
+        wire(i, i + 1)
+        wire(i, i + 1)
+    button(100, 101)
+    lamp(101, 102)
+    terminal(102, voltage=0)
+    try:
+        cc = CollapsedCircuit()
+        assert len(cc.circuit.register) == 4
+        assert len(cc.circuit.pcd) == 3
+        assert cc.nets[50] == cc.nets[0]
+    finally:
+        component.reset_class()
+
+def test_incremental_simulator_matches_rebuild():
+    import random
+    rng = random.Random(4)
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        for i in range(12):
+            a, b = rng.randrange(10), rng.randrange(10)
+            rng.choice([wire, lamp, button, button, diode])(a, b)
+        transistor(3, 4, 5)
+        lamp(5, 10)
+        lamp(9, 10)
+        button(8, 10)
+        terminal(10, voltage=0)
+    buttons = [x for x in c.register.values() if type(x) is button]
+    sim = IncrementalSimulator(c)
+    for _ in range(40):
+        sim.toggle(rng.choice(buttons))
+        while sim.step(): pass
+        assert set(sim.paths.edges()) == set(build_path_graph(c).edges())
+        fresh = Circuit.from_description(c.describe())
+        for x in buttons:
+            fresh.register[x.sid].on = x.on
+        e = EventPropagator(build_path_graph(fresh), fresh)
+        while e.step(): pass
+        assert {k: l.on for k, l in c.lamp_register.items()} == {k: l.on for k, l in fresh.lamp_register.items()}
+        assert {p: i for p, i in c.pct.items() if i} == {p: i for p, i in fresh.pct.items() if i}
+
+def test_incremental_toggle_stays_local(monkeypatch):
+    # A button on a branch of its own next to thousands of rungs that share its source and
+    # ground pins: a press only runs the branch and looks at no block again
+    with Circuit() as c:
+        terminal('s', voltage=1)
+        for i in range(2000):
+            wire('s', i)
+            lamp(i, 'g')
+        b = button('s', 'x')
+        l = lamp('x', 'g')
+        terminal('g', voltage=0)
+    sim = IncrementalSimulator(c)
+    while sim.step(): pass
+    calls, tarjan = [], []
+    run = component._propagate_current
+    monkeypatch.setattr(component, '_propagate_current', lambda self: calls.append(self) or run(self))
+    walk = electric._biconnected
+    monkeypatch.setattr(electric, '_biconnected', lambda adj, root: tarjan.append(len(adj)) or walk(adj, root))
+    for on in (True, False, True):
+        calls.clear()
+        sim.toggle(b)
+        while sim.step(): pass
+        assert l.on == on and sum(c.lamp_states) == 2000 + on
+        assert len(calls) <= 4 and not tarjan
+    assert set(sim.paths.edges()) == set(build_path_graph(c).edges())
+
+def test_block_tree_matches_simple_path_edges():
+    import random
+    rng = random.Random(2)
+    for _ in range(150):
+        n = rng.randint(3, 10)
+        sources, grounds = {0}, {n - 1}
+        pairs = [(a, b) for a in range(n - 1) for b in range(1, n) if a != b]
+        live = set(rng.sample(pairs, rng.randint(0, min(2 * n, len(pairs)))))
+        tree = electric._BlockTree(live, sources, grounds)
+        for _ in range(20):
+            if live and rng.random() < 0.5:
+                removed, added = set(rng.sample(sorted(live), rng.randint(1, min(3, len(live))))), set()
+            else:
+                removed, added = set(), set(rng.sample(pairs, rng.randint(1, 3))) - live
+            live -= removed
+            live |= added
+            before = set(tree.kept)
+            touched = tree.update(added, removed)
+            assert tree.kept == electric._simple_path_edges(live, sources, grounds)
+            assert before ^ tree.kept <= touched
+
+def test_hanging_masks_match_simple_path_edges():
+    import random
+    rng = random.Random(3)
+    for _ in range(300):
+        n = rng.randint(2, 9)
+        pairs = [tuple(e) for e in {frozenset(rng.sample(range(n), 2)) for _ in range(3 * n)}]
+        masks = [rng.getrandbits(16) for _ in pairs]
+        sources, grounds = {0}, {n - 1}
+        kept = electric._HangingMasks(pairs, sources, grounds).kept(masks, (1 << 16) - 1)
+        for i in range(16):
+            es = electric._simple_path_edges([e for e, m in zip(pairs, masks) if m >> i & 1],
+                                             sources, grounds)
+            assert [e for e, m in zip(pairs, kept) if m >> i & 1] == [e for e in pairs if e in es]
+
+def test_compact_storage():
+    with Circuit() as c:
+        t = terminal('a', voltage=1)
+        l = lamp('a', (1, 2), resistance=2)
+        w = wire((1, 2), 'a')
+    assert not hasattr(l, '__dict__')
+    assert c.pins == ['a', (1, 2)] and l.ids == (0, 1)
+    assert (l.p1, l.p2, l.resistance, lamp.resistance, t.voltage) == ('a', (1, 2), 2, 1, 1)
+    assert c.pcd['a'] == [t, l, w] and c.pcd['missing'] == []
+    c.pct[(1, 2)] = 1
+    assert (l.v1, l.v2, c.pct['missing'], c.pct[(1, 2)]) == (0, 1, 0, 1)
+    c.pct.clear()
+    assert dict(c.pct) == {'a': 0, (1, 2): 0}
+    with pytest.raises(AttributeError):
+        l.p3
+
+def test_stats():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b = button(0, 1)
+        lamp(1, 2)
+        terminal(2, voltage=0)
+    settle(build_path_graph(c), circuit=c)
+    assert c.stats is None
+    stats = enable_stats(c)
+    sim = IncrementalSimulator(c)
+    sim.toggle(b)
+    while sim.step(): pass
+    detect_shorts(sim.paths, circuit=c)
+    assert set(stats.times) == {'paths', 'update', 'step', 'shorts'}
+    assert (stats.path_nodes, stats.path_edges) == (3, 2) and stats.steps >= 2 and stats.propagate_calls > 0
+    assert stats.pins_visited >= stats.last_step_pins
+    assert len(stats.summary()) == 7
+    disable_stats(c)
+    assert c.stats is None
+
+@pytest.fixture
+def clean_blocks():
+    # Takes the blocks a test defines out of blocks again
+    before = set(blocks)
+    yield
+    for name in set(blocks) - before:
+        del blocks[name]
+
+def test_blocks_match_flattened(clean_blocks):
+    cell = [('lamp', ('a', 'm'), {}), ('lamp', ('m', 'b'), {}), ('wire', ('a', 'n'), {}),
+            ('lamp', ('n', 'b'), {})]
+    d = define_block('test_cell', cell, ('a', 'b'))
+    define_block('test_pair', [('block', ('x', 'y'), {'name': 'test_cell'}),
+                               ('block', ('y', 'z'), {'name': 'test_cell'})], ('x', 'z'))
+    n = 50
+    with Circuit() as blocked:
+        terminal(0, voltage=1)
+        bs = [block(2 * i, 2 * i + 2, name='test_pair') for i in range(n)]
+        terminal(2 * n, voltage=0)
+    with Circuit() as flat:
+        terminal(0, voltage=1)
+        for i in range(2 * n):
+            for name, ps, attrs in cell:
+                pins = {'a': i, 'b': i + 1}
+                component_types[name](*(pins.get(p, (i, p)) for p in ps), **attrs)
+        terminal(2 * n, voltage=0)
+    settle(get_all_paths_from_positive(blocked), circuit=blocked)
+    settle(get_all_paths_from_positive(flat), circuit=flat)
+    assert [blocked.pct[2 * i] for i in range(n + 1)] == [flat.pct[2 * i] for i in range(n + 1)]
+    assert all(b.on and b.lit == b'' for b in bs)
+    assert all(l.on for l in flat.lamp_register.values())
+    assert len(blocked.register) == n + 2
+    assert len(d.memo) <= 4                 # One run per distinct input, not per instance
+    assert d.resistance == 1 and blocks['test_pair'].connections == [[1], [0]]
+
+def test_block_in_threads(clean_blocks):
+    from concurrent.futures import ThreadPoolExecutor
+    d = define_block('test_threads', [('diode', ('a', 'm'), {}), ('lamp', ('m', 'b'), {}),
+                                      ('lamp', ('b', 'c'), {})], ('a', 'b', 'c'))
+    inputs = list(it.product((0, 1), repeat=3))
+    expected = [d.evaluate(Is) for Is in inputs]
+    def run(k):
+        results = []
+        for n in range(300):
+            d.memo.clear()              # So the inner circuit runs every time
+            Is = inputs[(n + k) % len(inputs)]
+            results.append(d.evaluate(Is) == expected[inputs.index(Is)])
+        return all(results)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(4) as ex:
+            assert all(ex.map(run, range(4)))
+    finally:
+        sys.setswitchinterval(interval)
+
+def test_block_dead_ends(clean_blocks):
+    define_block('test_dead_end', [('lamp', ('a', 'b'), {}), ('lamp', ('a', 'd'), {})], ('a', 'b'))
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b = block(0, 1, name='test_dead_end')
+        terminal(1, voltage=0)
+    settle(get_all_paths_from_positive(c), circuit=c)
+    assert b.on and b.lit == b'\x01\x00'
+
+def test_block_errors(clean_blocks):
+    define_block('test_short', [('wire', ('a', 'b'), {})], ('a', 'b'))
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        block(0, 1, name='test_short')
+        terminal(1, voltage=0)
+    assert detect_shorts(circuit=c)
+    with pytest.raises(ValueError):
+        define_block('test_short', [('lamp', ('a', 'b'), {})], ('a', 'b'))
+    with pytest.raises(ValueError):
+        define_block('test_power', [('terminal', ('a',), {'voltage': 1})], ('a',))
+    with pytest.raises(TypeError):
+        block(0, 1, 2, name='test_short', circuit=c)
@@ -0,0 +1,55 @@
+from graph import CSRGraph, DirectedGraph
+from electric import *
+import graph
+import random
+
+def _random_edges(seed, n=300):
+    rng = random.Random(seed)
+    return [(rng.randrange(50), rng.randrange(50)) for _ in range(n)]
+
+def test_csr_graph_matches_directed_graph():
+    es = _random_edges(1)
+    d, c = DirectedGraph.from_edges(es), CSRGraph.from_edges(es)
+    assert set(d.edges()) == set(c.edges())
+    assert set(d.nodes()) == set(c.nodes())
+    for n in range(60):
+        assert set(d.get_conns(n)) == set(c.get_conns(n))
+    assert sorted(map(sorted, d.strongly_connected_components())) == \
+        sorted(map(sorted, c.strongly_connected_components()))
+
+def test_csr_graph_without_numpy(monkeypatch):
+    es = _random_edges(2) + [((n, 'x'), n) for n in range(20)]
+    with_numpy = CSRGraph.from_edges(es)
+    monkeypatch.setattr(graph, 'np', None)
+    without = CSRGraph.from_edges(es)
+    assert without.ids == with_numpy.ids
+    assert without.offsets == with_numpy.offsets and without.targets == with_numpy.targets
+    assert all(without.get_conns(n) == with_numpy.get_conns(n) for n in with_numpy.ids)
+    assert with_numpy.get_conns(0) is with_numpy.get_conns(0)     # Rows are only made once
+
+def test_get_conns_does_not_insert():
+    d = DirectedGraph.from_edges([(0, 1)])
+    assert not d.get_conns(5)
+    assert d.nodes() == [0, 1]
+
+def test_multi_way_union():
+    gs = [_random_edges(seed, 50) for seed in range(4)]
+    expected = set().union(*gs)
+    assert set(DirectedGraph.union(*map(DirectedGraph.from_edges, gs)).edges()) == expected
+    assert set(CSRGraph.from_edges(gs[0]).union(*map(CSRGraph.from_edges, gs[1:])).edges()) == expected
+    d = DirectedGraph.from_edges(gs[0])
+    assert d.update(DirectedGraph.from_edges(gs[1])) is d
+    assert set(d.edges()) == set(gs[0]) | set(gs[1])
+
+def test_csr_path_graph():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        wire(0, 1)
+        lamp(1, 2)
+        diode(1, 3)
+        lamp(3, 2)
+        terminal(2, voltage=0)
+    paths = build_path_graph(c, graph=CSRGraph)
+    assert set(paths.edges()) == set(build_path_graph(c).edges())
+    settle(paths, circuit=c)
+    assert all(l.on for l in c.lamp_register.values())
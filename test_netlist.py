@@ -0,0 +1,85 @@
+from electric import *
+import netlist
+import io
+import pytest
+
+def _roundtrip(records, binary):
+    f = io.BytesIO()
+    netlist.write(records, f, binary)
+    return list(netlist.records(io.BytesIO(f.getvalue())))
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_roundtrip_records(binary):
+    records = [
+        ('terminal', ((10, 20),), {'voltage': 5}),
+        ('lamp', ((10, 20), 3), {'resistance': 2.5}),
+        ('button', (3, 'out'), {}),
+        ('transistor', (3, 'out', (1,)), {'label': 'q1', 'flag': True}),
+        ('diode', (-4, (1 << 40, 2)), {}),
+        ('wire', ((), 1 << 35), {}),
+    ]
+    assert _roundtrip(records, binary) == records
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_save_and_load(tmp_path, binary):
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b = button(0, (1, 1))
+        lamp((1, 1), 2, resistance=3)
+        transistor(0, (1, 1), 4)
+        lamp(4, 2)
+        terminal(2, voltage=0)
+    b.on = True
+    path = tmp_path / 'circuit.xnl'
+    netlist.save(path, c, binary=binary)
+    d = netlist.load(path, Circuit())
+    assert d.describe() == c.describe()
+    assert d.register[b.sid].on             # Written as on=True
+    settle(get_all_paths_from_positive(d), circuit=d)
+    assert all(l.on for l in d.lamp_register.values())
+
+def test_binary_chunks():
+    # Records cut off by the end of the buffer are decoded again with a bigger one
+    records = [('wire', ((i, 1), i + 1), {'label': 'x' * (i * 7 % 40)}) for i in range(200)]
+    f = io.BytesIO()
+    netlist.write(records, f, binary=True)
+    data = f.getvalue()[len(netlist.magic) + 1:]
+    for chunk in (1, 5, 64, 1 << 16):
+        assert list(netlist._binary_records(io.BytesIO(data), chunk)) == records
+    with pytest.raises(ValueError):
+        list(netlist._binary_records(io.BytesIO(data[:-3]), 64))
+
+def test_text_format():
+    f = io.BytesIO(b'terminal 0 voltage=1\n\n# comment\nlamp 0 5,7 resistance=2\n')
+    assert list(netlist.records(f)) == [('terminal', (0,), {'voltage': 1}),
+                                        ('lamp', (0, (5, 7)), {'resistance': 2})]
+
+def test_unwritable_value():
+    with pytest.raises(ValueError):
+        netlist.write([('wire', ('a b', 1), {})], io.BytesIO())
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_blocks(tmp_path, binary):
+    try:
+        define_block('netlist_cell', [('lamp', ('a', 'm'), {}), ('lamp', ('m', 'b'), {})], ('a', 'b'))
+        define_block('netlist_pair', [('block', ('x', 'y'), {'name': 'netlist_cell'}),
+                                      ('block', ('y', 'z'), {'name': 'netlist_cell'})], ('x', 'z'))
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            block(0, 1, name='netlist_pair')
+            block(1, 2, name='netlist_cell')
+            terminal(2, voltage=0)
+        path = tmp_path / 'blocks.xnl'
+        netlist.save(path, c, binary)
+        with open(path, 'rb') as f:
+            rs = list(netlist.records(f))
+        assert [r[0] for r in rs[:4]] == ['define', 'lamp', 'lamp', 'end']
+        assert rs[4] == ('define', ('x', 'z'), {'name': 'netlist_pair'})
+        del blocks['netlist_cell'], blocks['netlist_pair']
+        assert netlist.load(path, Circuit()).describe() == c.describe()
+        assert 'netlist_pair' in blocks
+    finally:
+        blocks.pop('netlist_cell', None)
+        blocks.pop('netlist_pair', None)
+    with pytest.raises(ValueError):
+        list(netlist.components([('define', ('a',), {'name': 'x'}), ('wire', ('a', 'b'), {})]))
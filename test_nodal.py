@@ -0,0 +1,122 @@
+import pytest
+np = pytest.importorskip('numpy')
+from electric import *
+import nodal
+from nodal import solve
+
+def test_series_lamps():
+    with Circuit() as c:
+        terminal(0, voltage=6)
+        l1 = lamp(0, 1)
+        l2 = lamp(1, 2, resistance=2)
+        terminal(2, voltage=0)
+    s = solve(c)
+    assert s.voltages[1] == pytest.approx(4)
+    assert s.currents[l1.sid] == pytest.approx(2)
+    assert s.lamp_power == pytest.approx({1: 4, 2: 8})
+
+def test_parallel_sources_and_buttons():
+    with Circuit() as c:
+        terminal(0, voltage=10)
+        terminal(5, voltage=5)
+        wire(0, 1)
+        lamp(1, 9)
+        b = button(5, 6)
+        lamp(6, 9)
+        terminal(9, voltage=0)
+    assert solve(c).lamp_power == pytest.approx({1: 100, 2: 0}, rel=1e-4, abs=1e-6)
+    b.on = True
+    assert solve(c).lamp_power == pytest.approx({1: 100, 2: 25}, rel=1e-4)
+
+def test_diode_and_transistor():
+    with Circuit() as c:
+        terminal(0, voltage=5)
+        d1 = diode(0, 1)
+        lamp(1, 9)
+        d2 = diode(2, 0)
+        lamp(2, 9)
+        transistor(0, 3, 4)
+        lamp(4, 9)
+        b = button(0, 3)
+        terminal(9, voltage=0)
+    s = solve(c)
+    assert s.lamp_power[1] == pytest.approx(25, rel=1e-4)
+    assert s.lamp_power[2] == pytest.approx(0, abs=1e-6)
+    assert s.lamp_power[3] == pytest.approx(0, abs=1e-6)
+    b.on = True
+    assert solve(c).lamp_power[3] == pytest.approx(25, rel=1e-4)
+
+def test_long_diode_chain():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        for i in range(3000):
+            diode(i, i + 1)
+            lamp(i + 1, 'ground', resistance=1e4)
+        terminal('ground', voltage=0)
+    s = solve(c)
+    assert s.status is settle_status.CONVERGED and s.iterations <= 2
+    assert min(s.lamp_power.values()) > 0
+
+def test_ladder_without_path_graph(monkeypatch):
+    # Nothing to guess without diodes and transistors, so the path graph isn't built
+    monkeypatch.setattr(nodal, 'build_path_graph', None)
+    with Circuit() as c:
+        terminal(('top', 0), voltage=1)
+        for i in range(2000):
+            wire(('top', i), ('top', i + 1))
+            wire(('bottom', i), ('bottom', i + 1))
+            lamp(('top', i + 1), ('bottom', i))
+        terminal(('bottom', 2000), voltage=0)
+    s = solve(c)
+    assert s.status is settle_status.CONVERGED and s.iterations == 1
+    assert min(s.lamp_power.values()) > 0
+
+def test_dense_matches_sparse(monkeypatch):
+    pytest.importorskip('scipy')
+    with Circuit() as c:
+        terminal(0, voltage=5)
+        diode(0, 1)
+        lamp(1, 2, resistance=3)
+        transistor(0, 1, 3)
+        lamp(3, 2)
+        wire(3, 4)
+        lamp(4, 2)
+        terminal(2, voltage=0)
+    sparse = solve(c)
+    monkeypatch.setattr(nodal, 'coo_matrix', None)
+    dense = solve(c)
+    assert dense.voltages == pytest.approx(sparse.voltages)
+    assert dense.currents == pytest.approx(sparse.currents)
+
+def test_status():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        d = diode(0, 1)         # On the path graph, but the other source reverses it
+        lamp(1, 9)
+        terminal(5, voltage=10)
+        wire(5, 1)
+        terminal(9, voltage=0)
+    s = solve(c, max_iterations=1)
+    assert s.status is settle_status.STEP_LIMIT
+    s = solve(c)
+    assert s.status is settle_status.CONVERGED and s.iterations == 2
+    assert s.currents[d.sid] == pytest.approx(0, abs=1e-6)
+
+def test_blocks():
+    define_block('test_nodal_cell', [('lamp', ('a', 'm'), {}), ('diode', ('m', 'b'), {}),
+                                     ('lamp', ('a', 'b'), {'resistance': 2})], ('a', 'b'))
+    try:
+        with Circuit() as c:
+            terminal(0, voltage=6)
+            b = block(0, 1, name='test_nodal_cell')
+            l = lamp(1, 2)
+            terminal(2, voltage=0)
+        s = solve(c)
+    finally:
+        del blocks['test_nodal_cell']
+    assert s.status is settle_status.CONVERGED
+    # 1 ohm in parallel with 2 ohms, in series with the outer lamp's 1 ohm
+    assert s.voltages[1] == pytest.approx(6 * 1 / (1 + 2 / 3), rel=1e-4)
+    assert s.currents[l.sid] == pytest.approx(3.6, rel=1e-4)
+    assert s.currents[b.sid, 1] == pytest.approx(2.4, rel=1e-4)
+    assert s.voltages[b.sid, 'm'] == pytest.approx(s.voltages[1], rel=1e-4)
@@ -0,0 +1,106 @@
+from electric import *
+from parallel import partition, settle_parallel
+import bench
+import pytest
+import random
+
+def _both(make, **kwargs):
+    a, b = make(), make()
+    r = settle_parallel(get_all_paths_from_positive(a), circuit=a, **kwargs)
+    settle(get_all_paths_from_positive(b), circuit=b)
+    return r, a, b
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_matches_settle(processes):
+    for name, f in bench.generators.items():
+        r, a, b = _both(lambda: f(5), processes=processes, min_parallel=0)
+        assert r.status is settle_status.CONVERGED, name
+        assert a.pct.buffer == b.pct.buffer and a.lamp_states == b.lamp_states, name
+
+def test_matches_settle_random():
+    checked = 0
+    for seed in range(300):
+        def make():
+            rng = random.Random(seed)
+            with Circuit() as c:
+                terminal(0, voltage=1)
+                terminal(1, voltage=0)
+                for i in range(rng.randrange(5, 30)):
+                    t = rng.choice([wire, lamp, button, diode, transistor])
+                    x = t(*(rng.randrange(10) for p in range(3 if t is transistor else 2)))
+                    if t is button: x.on = rng.random() < 0.5
+            return c
+        c = make()
+        try:
+            paths = get_all_paths_from_positive(c)
+        except TypeError:       # No path from the positive terminal
+            continue
+        if detect_shorts(paths, circuit=c): continue
+        r, a, b = _both(make)
+        assert r.status is settle_status.CONVERGED, seed
+        assert a.lamp_states == b.lamp_states, seed
+        checked += 1
+    assert checked > 100
+
+def test_partitions():
+    with Circuit() as c:
+        terminal('power', voltage=1)
+        for i in range(3):
+            diode('power', (i, 0))
+            for j in range(4):      # A ring of diodes, which has to stay in one partition
+                diode((i, j), (i, (j + 1) % 4))
+            lamp((i, 0), 'ground')
+        terminal('ground', voltage=0)
+    p = partition(get_all_paths_from_positive(c), c)
+    assert sorted(len(set(part)) for part in p.parts) == [1, 1, 6, 6, 6]
+    # Every partition only reads pins changed in its own level or before
+    level_of = {k: n for n, level in enumerate(p.levels) for k in level}
+    written = {}
+    for k, part in enumerate(p.parts):
+        for x in part:
+            for i in x.ids[-1:] if type(x) is diode else x.ids:
+                written.setdefault(i, level_of[k])
+    for k, part in enumerate(p.parts):
+        assert all(written.get(i, 0) <= level_of[k] for x in part for i in x.ids)
+
+def test_blocks_and_limits():
+    define_block('diode_lamp', [('diode', ('a', 'm'), {}), ('lamp', ('m', 'b'), {})], ('a', 'b'))
+    def make():
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            for i in range(4):
+                block(0, (i, 1), name='diode_lamp')
+                diode((i, 1), 'ground')
+            terminal('ground', voltage=0)
+        return c
+    try:
+        r, a, b = _both(make, processes=2, min_parallel=0)
+    finally:
+        del blocks['diode_lamp']
+    assert r.status is settle_status.CONVERGED
+    assert a.pct.buffer == b.pct.buffer
+    assert [x.on for x in a.register.values()] == [x.on for x in b.register.values()]
+    c = bench.grid(3)
+    assert settle_parallel(get_all_paths_from_positive(c), 1, c).status is settle_status.STEP_LIMIT
+
+def test_fewer_evaluations(monkeypatch):
+    # Pins added against the way current flows make settle take a step for every diode, while
+    # every partition only needs to be swept twice
+    def make():
+        with Circuit() as c:
+            for i in reversed(range(100)):
+                diode(i, i + 1)
+                lamp(i + 1, 'ground')
+            terminal(0, voltage=1)
+            terminal('ground', voltage=0)
+        return c
+    calls = []
+    propagate = diode.propagate_current
+    monkeypatch.setattr(diode, 'propagate_current', lambda self, *i: calls.append(1) or propagate(self, *i))
+    a, b = make(), make()
+    assert settle(get_all_paths_from_positive(b), circuit=b).steps == 101
+    settle_calls, calls[:] = len(calls), []
+    r = settle_parallel(get_all_paths_from_positive(a), circuit=a, processes=1)
+    assert r.status is settle_status.CONVERGED and a.lamp_states == b.lamp_states
+    assert sum(a.lamp_states) == 100
+    assert len(calls) * 20 < settle_calls
@@ -0,0 +1,35 @@
+from spatial import SpatialIndex
+import random
+
+def _brute_nearest(points, p, r):
+    near = [q for q in points if (q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2 < r * r]
+    return min(near, key=lambda q: ((q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2, q), default=None)
+
+def _brute_aligned(points, p, r, axis):
+    near = [q for q in points if abs(q[axis] - p[axis]) < r]
+    return min(near, key=lambda q: (abs(q[axis] - p[axis]), q[axis], abs(q[1 - axis] - p[1 - axis]), q[1 - axis]),
+               default=None)
+
+def test_matches_brute_force():
+    rng = random.Random(2)
+    index, points = SpatialIndex(10), []
+    for n in range(600):
+        if points and rng.random() < 0.3:
+            p = points.pop(rng.randrange(len(points)))
+            index.remove(p)
+        else:
+            p = (rng.randrange(-200, 200), rng.randrange(-200, 200))
+            points.append(p)
+            index.add(p)
+        q = (rng.randrange(-220, 220), rng.randrange(-220, 220))
+        assert index.nearest(q, 10) == _brute_nearest(points, q, 10)
+        assert index.aligned(q, 10) == (_brute_aligned(points, q, 10, 0), _brute_aligned(points, q, 10, 1))
+    assert len(index) == len(set(points))
+
+def test_shared_points():
+    index = SpatialIndex.from_points([(5, 5), (5, 5)])
+    index.remove((5, 5))
+    assert (5, 5) in index
+    index.remove((5, 5))
+    assert (5, 5) not in index and index.nearest((5, 5), 10) is None
+    assert not index.cells and not index.by_x and not index.by_y
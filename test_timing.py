@@ -0,0 +1,85 @@
+from electric import *
+from timing import TimingSimulator
+from waveform import lamp_signal
+import bench
+import pytest
+import random
+
+def _lamp_times(c, sim):
+    # Lamp pins -> time the lamp lit
+    lamps = {lamp_signal(l): l.ps for l in c.lamp_register.values()}
+    return {lamps[s]: t for t, s, v in sim.history if s < 0 and v}
+
+def test_delays():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        for i in range(5):
+            lamp(i, i + 1, delay=i + 1)
+        diode(5, 6)
+        terminal(6, voltage=0)
+    sim = TimingSimulator(get_all_paths_from_positive(c), c)
+    r = sim.run()
+    assert r.status is settle_status.CONVERGED
+    # Current reaches pin i + 1 after the delays of the lamps before it
+    arrivals = {c.pins[i]: t for t, i, v in sim.history if i >= 0 and v}
+    assert [arrivals[i] for i in range(6)] == [0, 1, 3, 6, 10, 15]
+    assert r.time == 15 == max(_lamp_times(c, sim).values())
+
+def test_matches_settle():
+    for name, f in bench.generators.items():
+        a, b = f(5), f(5)
+        TimingSimulator(get_all_paths_from_positive(a), a).run()
+        settle(get_all_paths_from_positive(b), circuit=b)
+        assert a.pct.buffer == b.pct.buffer and a.lamp_states == b.lamp_states, name
+
+def test_order_independent():
+    description = bench.transistors(6).describe()
+    times = []
+    for seed in range(3):
+        d = list(description)
+        random.Random(seed).shuffle(d)
+        c = Circuit.from_description(d)
+        sim = TimingSimulator(get_all_paths_from_positive(c), c)
+        sim.run()
+        times.append(_lamp_times(c, sim))
+    assert times[0] == times[1] == times[2]
+
+def test_limits_and_sparse_updates():
+    c = bench.button_tree(5)
+    sim = TimingSimulator(get_all_paths_from_positive(c), c)
+    assert sim.run(until=0).status is settle_status.STEP_LIMIT
+    assert sim.run(max_events=sim.events + 1).events == sim.events
+    r = sim.run()
+    assert r.status is settle_status.CONVERGED
+    # Nothing changed, so nothing runs, however long the circuit sits
+    assert sim.run(until=10 ** 9) == r
+    with pytest.raises(TypeError):
+        sim.step()
+
+def test_default_bound():
+    class toggle(wire):
+        def propagate_current(self, i1, i2):
+            return [i1, 0 if i2 else 1]
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        toggle(0, 1)
+        diode(1, 2)
+        terminal(2, voltage=0)
+    sim = TimingSimulator(get_all_paths_from_positive(c), c)
+    assert sim.run().status is settle_status.STEP_LIMIT
+    assert sim.run(max_rounds=10).status is settle_status.STEP_LIMIT
+
+def test_block_delay():
+    define_block('timing_lamp', [('lamp', ('a', 'b'), {})], ('a', 'b'))
+    try:
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            b = block(0, 1, name='timing_lamp', delay=4)
+            terminal(1, voltage=0)
+        sim = TimingSimulator(get_all_paths_from_positive(c), c)
+        sim.run(until=3)
+        assert (b.on, b.lit) == (False, b'\x00')
+        assert sim.run().status is settle_status.CONVERGED
+        assert (b.on, b.lit) == (True, b'\x01') and sim.last_change == 4
+    finally:
+        del blocks['timing_lamp']
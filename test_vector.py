@@ -0,0 +1,91 @@
+from electric import *
+from vector import simulate_vectors, truth_table
+import itertools as it
+import pytest
+
+@pytest.fixture
+def gated_circuit():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b1 = button(0, 1)
+        lamp(1, 9)
+        b2 = button(1, 2)
+        diode(2, 3)
+        lamp(3, 9)
+        b3 = button(0, 4)
+        transistor(0, 4, 5)
+        lamp(5, 9)
+        wire(4, 6)
+        lamp(6, 9)
+        terminal(9, voltage=0)
+    return c, [b1, b2, b3]
+
+def _run_scalar(c, buttons, states):
+    for b, on in zip(buttons, states):
+        b.on = on
+    c.pct.clear()
+    for l in c.lamp_register.values():
+        l.on = False
+    settle(get_all_paths_from_positive(c), circuit=c)
+    return {k: l.on for k, l in c.lamp_register.items()}
+
+def test_truth_table_matches_scalar(gated_circuit):
+    c, buttons = gated_circuit
+    table = truth_table(circuit=c)
+    assert table.buttons == [b.sid for b in buttons]
+    assert table.status is settle_status.CONVERGED
+    for i, states in enumerate(it.product([False, True], repeat=3)):
+        states = states[::-1]       # Bit j of i is button j
+        expected = _run_scalar(c, buttons, states)
+        assert {k: bool(m >> i & 1) for k, m in table.lamps.items()} == expected
+
+def test_simulate_vectors(gated_circuit):
+    c, (b1, b2, b3) = gated_circuit
+    vectors = [{b1.sid: True}, {b1.sid: True, b2.sid: True}, {b3.sid: True}]
+    lamps = simulate_vectors(vectors, circuit=c).lamps
+    assert lamps == {1: 0b011, 2: 0b010, 3: 0b111, 4: 0b100}
+
+def test_blocks():
+    define_block('test_vector_gate', [('diode', ('a', 'm'), {}), ('lamp', ('m', 'b'), {})], ('a', 'b'))
+    try:
+        with Circuit() as c:
+            terminal(0, voltage=1)
+            b1 = button(0, 1)
+            g = block(1, 2, name='test_vector_gate')
+            lamp(2, 3)
+            b2 = button(3, 9)
+            terminal(9, voltage=0)
+        table = truth_table(circuit=c)
+        on_bits = g.on_bits
+        for i, states in enumerate(it.product([False, True], repeat=2)):
+            expected = _run_scalar(c, [b1, b2], states[::-1])
+            assert {k: bool(m >> i & 1) for k, m in table.lamps.items()} == expected
+            assert bool(on_bits >> i & 1) == g.on
+    finally:
+        del blocks['test_vector_gate']
+
+def test_many_buttons_with_loops():
+    # Sixteen buttons in parallel, a bridge with a button across it and a loop hanging off
+    # the end: every vector's loops are taken out without going through them one by one
+    import random
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        buttons = [button(0, j) for j in range(1, 17)]
+        for j in range(1, 17):
+            lamp(j, 20)
+        wire(20, 21)
+        wire(20, 22)
+        lamp(21, 23)
+        lamp(22, 23)
+        buttons.append(button(21, 22))
+        wire(23, 24)
+        lamp(24, 25)
+        wire(25, 23)
+        lamp(23, 30)
+        terminal(30, voltage=0)
+    table = truth_table(buttons, circuit=c)
+    assert table.status is settle_status.CONVERGED
+    rng = random.Random(1)
+    for i in [0, (1 << 17) - 1, *rng.sample(range(1 << 17), 20)]:
+        expected = _run_scalar(c, buttons, [bool(i >> j & 1) for j in range(17)])
+        assert {k: bool(m >> i & 1) for k, m in table.lamps.items()} == expected
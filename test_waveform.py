@@ -0,0 +1,72 @@
+from electric import *
+from waveform import TraceReader, lamp_signal, start_trace, stop_trace
+import waveform
+import bench
+import pytest
+
+def _run(path, keyframe_interval):
+    c = bench.button_tree(4)
+    buttons = [b for b in c.register.values() if type(b) is button]
+    sim = IncrementalSimulator(c)
+    start_trace(path, c, keyframe_interval)
+    states = [(c.pct.buffer.tobytes(), bytes(c.lamp_states))]
+    for b in buttons[::3]:
+        sim.toggle(b)
+        while True:
+            calls = sim.step()
+            states.append((c.pct.buffer.tobytes(), bytes(c.lamp_states)))
+            if not calls: break
+    stop_trace(c)
+    return c, states
+
+@pytest.mark.parametrize('keyframe_interval', [1, 3, 1024])
+def test_replay_matches_run(tmp_path, keyframe_interval):
+    path = tmp_path / 'run.xdw'
+    c, states = _run(path, keyframe_interval)
+    with TraceReader(path) as r:
+        assert r.steps == len(states) - 1
+        for step, (currents, lamps) in enumerate(states):
+            s = r.state(step)
+            assert s.currents.tobytes() == currents
+            assert bytes(s.lamps[sid] for sid in sorted(s.lamps)) == lamps
+        for l in c.lamp_register.values():
+            h = r.history(lamp_signal(l))
+            values = [bool(lamps[l.lamp_sid - 1]) for _, lamps in states]
+            assert h == [(k, v) for k, v in enumerate(values) if k == 0 or v != values[k - 1]]
+        with pytest.raises(IndexError):
+            r.state(r.steps + 1)
+
+def test_only_changes_are_stored(tmp_path):
+    path = tmp_path / 'run.xdw'
+    c, states = _run(path, 1 << 20)
+    changed = sum(a != b for x, y in zip(states, states[1:])
+                  for a, b in zip(x[0] + x[1], y[0] + y[1]))
+    with TraceReader(path) as r:
+        assert len(r) == len(states[0][0]) + len(states[0][1]) + changed
+
+def test_file_grows(tmp_path):
+    path = tmp_path / 'chain.xdw'
+    c = bench.chain(3000)
+    start_trace(path, c, keyframe_interval=1)
+    steps = settle(get_all_paths_from_positive(c), circuit=c).steps
+    stop_trace(c)
+    with TraceReader(path) as r:
+        assert r.steps == steps
+        assert len(r) == (steps + 1) * (len(c.pins) + len(c.lamp_register))
+        assert r.state(steps).currents == c.pct.buffer
+
+def test_event_steps_only_look_at_their_pins(tmp_path, monkeypatch):
+    path = tmp_path / 'ladder.xdw'
+    c = bench.ladder(200)
+    sim = IncrementalSimulator(c)
+    start_trace(path, c)
+    def whole_state(*args):
+        raise AssertionError('compared the whole state')
+    monkeypatch.setattr(waveform, '_diff', whole_state)
+    steps = 0
+    while sim.step(): steps += 1
+    stop_trace(c)
+    with TraceReader(path) as r:
+        assert r.steps == steps + 1
+        assert r.state(r.steps).currents == c.pct.buffer
+        assert bytes(r.state(r.steps).lamps.values()) == bytes(c.lamp_states)
@@ -0,0 +1,66 @@
+from electric import *
+from worker import SimulationWorker
+from cache import SimulationCache
+
+def _circuit():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        b = button(0, 1)
+        l1 = lamp(1, 2)
+        transistor(0, 1, 3)
+        l2 = lamp(3, 2)
+        terminal(2, voltage=0)
+    return c, b, l1, l2
+
+def _expected(c, b, on):
+    fresh = Circuit.from_description(c.describe())
+    fresh.register[b.sid].on = on
+    settle(build_path_graph(fresh), circuit=fresh)
+    return {x.sid: x.on for x in fresh.register.values() if isinstance(x, (button, lamp))}
+
+def test_worker_follows_toggles():
+    c, b, l1, l2 = _circuit()
+    w = SimulationWorker(c)
+    w.start()
+    try:
+        s = w.wait(lambda s: s.settled, timeout=10)
+        assert s.on == _expected(c, b, False)
+        for on in (True, False, True):
+            w.toggle(b.sid)
+            s = w.wait(lambda s: s.settled and s.on[b.sid] == on, timeout=10)
+            assert s.error is None
+            assert s.on == _expected(c, b, on)
+    finally:
+        w.stop(timeout=10)
+    assert not w.thread.is_alive()
+
+def test_worker_reports_errors():
+    with Circuit() as c:
+        terminal(0, voltage=1)
+        wire(0, 1)
+        terminal(1, voltage=0)
+    w = SimulationWorker(c)
+    w.start()
+    assert w.wait(lambda s: s.error, timeout=10).error == 'SHORT CIRCUIT'
+    w.stop(timeout=10)
+    w = SimulationWorker(Circuit())
+    w.start()
+    assert w.wait(lambda s: s.error, timeout=10).error == 'COULD NOT RUN'
+    w.stop(timeout=10)
+
+def test_worker_starts_from_cached_state():
+    cache = SimulationCache()
+    c, b, l1, l2 = _circuit()
+    w = SimulationWorker(c, cache=cache)
+    w.start()
+    w.toggle(b.sid)
+    first = w.wait(lambda s: s.settled and s.on[b.sid], timeout=10)
+    w.stop(timeout=10)
+    c, b, l1, l2 = _circuit()
+    b.on = True
+    w = SimulationWorker(c, cache=cache)
+    w.start()
+    s = w.wait(lambda s: s.settled, timeout=10)
+    w.stop(timeout=10)
+    assert s.on == first.on == _expected(c, b, True)
+    assert s.steps <= 2 < first.steps
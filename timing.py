@@ -0,0 +1,125 @@
+'''Timing simulation: every component takes its delay to respond, and events run in time order.
+
+When the current at a pin changes, the components on it are evaluated with the currents at that
+moment, and whatever they change (pin currents, and whether a lamp or block is lit) takes effect
+delay time units later. Events come off a heap in time order, so a quiet circuit costs nothing no
+matter how much time passes, and only the components on changed pins are evaluated. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     l1 = lamp(0, 1)
+    ...     l2 = lamp(1, 2, delay=3)
+    ...     t2 = terminal(2, voltage=0)
+    >>> sim = TimingSimulator(get_all_paths_from_positive(c), c)
+    >>> sim.run()
+    timing_result(time=3, events=5, status=<settle_status.CONVERGED: 'converged'>)
+    >>> [(t, value) for t, signal, value in sim.history if signal in (1, lamp_signal(l2))]
+    [(1, 1), (3, True)]
+
+Pin 1 gets current at time 1, after l1's delay, and l2 lights at time 3, its own delay after
+its pins changed at time 0.
+
+Delays come from each component's delay, which attrs override (lamp(1, 2, delay=3)) and whose
+defaults can be changed per type (transistor.delay = 5). Terminals, wires and buttons default to
+0, so current crosses them within the same time, diodes and lamps to 1 and transistors to 2.
+
+Everything that happens at one time is done in rounds: first every change due then is applied,
+then every component on a changed pin is evaluated against the same state, in id order. So unlike
+propagate_current_step, the result doesn't depend on the order components were added in.
+Changes from delay 0 components make another round at the same time. Like settle, run stops after
+max_rounds rounds, 1000 by default, so it returns even on circuits that never settle.
+
+history lists every change as (time, signal, value), with signals numbered as in waveform: pin
+ids for pin currents and lamp_signal(l) for lamp l.
+'''
+from collections import namedtuple
+from heapq import heappop, heappush
+import itertools as it
+
+from electric import EventPropagator, block, lamp, settle_status
+from waveform import lamp_signal
+
+timing_result = namedtuple('timing_result', 'time events status')
+
+def _shown(c):
+    # What propagate_current changes about a lamp or block besides its pins
+    return (c.lit, c.on) if isinstance(c, block) else c.on
+
+def _show(c, shown):
+    if isinstance(c, block): c.lit, c.on = shown
+    else: c.on = shown
+
+class TimingSimulator(EventPropagator):
+    '''EventPropagator whose steps are replaced by run. Pins passed to schedule and components
+    passed to notify are evaluated at the current time when run is next called.'''
+    def __init__(self, paths, circuit=None):
+        self.now = 0
+        self.queue = []         # Heap of (time, seq, component, [(pin id, current)], shown)
+        self.seq = it.count()
+        self.events = 0
+        self.last_change = 0
+        self.history = []
+        super().__init__(paths, circuit)
+
+    def step(self):
+        raise TypeError('TimingSimulator runs in time, use run')
+
+    def _evaluate(self, c):
+        pct = self.circuit.pct.buffer
+        before = [pct[i] for i in c.ids]
+        shown = None
+        if isinstance(c, (lamp, block)):       # propagate_current lights them now, so undo that
+            old = _shown(c)
+            after = c.propagate_current(*before)
+            shown = _shown(c)
+            _show(c, old)
+        else:
+            after = c.propagate_current(*before)
+        changes = [(i, v) for i, b, v in zip(c.ids, before, after) if v != b]
+        if changes or (shown is not None and shown != _shown(c)):
+            heappush(self.queue, (self.now + c.delay, next(self.seq), c, changes, shown))
+
+    def _apply(self, c, changes, shown):
+        pct, pins = self.circuit.pct.buffer, self.circuit.pins
+        for i, v in changes:
+            if pct[i] != v:
+                pct[i] = v
+                self.history.append((self.now, i, v))
+                self.schedule(pins[i])
+                self.last_change = self.now
+        if shown is not None and shown != _shown(c):
+            _show(c, shown)
+            if isinstance(c, lamp):
+                self.history.append((self.now, lamp_signal(c), shown))
+            self.last_change = self.now
+
+    def run(self, until=None, max_events=None, max_rounds=1000):
+        '''Runs events in time order until there are none left (CONVERGED), the next one is
+        after until, max_events events have run in all or max_rounds rounds have run in this call
+        (STEP_LIMIT). None means no limit. Returns a timing_result with the time of the last
+        change and the number of events run so far.'''
+        pcd = self.circuit.pcd
+        rounds = 0
+        while True:
+            if self.dirty:
+                cs = {c for p in self.dirty for c in pcd[p] if c in self.active}
+                self.dirty.clear()
+                self.queued.clear()
+                for c in sorted(cs, key=lambda c: c.sid):
+                    self._evaluate(c)
+            if not self.queue:
+                return timing_result(self.last_change, self.events, settle_status.CONVERGED)
+            t = self.queue[0][0]
+            if until is not None and t > until:
+                self.now = until
+                return timing_result(self.last_change, self.events, settle_status.STEP_LIMIT)
+            if max_events is not None and self.events >= max_events:
+                return timing_result(self.last_change, self.events, settle_status.STEP_LIMIT)
+            if max_rounds is not None and rounds >= max_rounds:
+                return timing_result(self.last_change, self.events, settle_status.STEP_LIMIT)
+            rounds += 1
+            self.now = t
+            while self.queue and self.queue[0][0] == t:
+                _, _, c, changes, lit = heappop(self.queue)
+                self.events += 1
+                self._apply(c, changes, lit)
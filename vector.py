@@ -0,0 +1,148 @@
+'''Bit-parallel simulation: runs a circuit for many button settings at once.
+
+Every pin current and lamp state is a Python int used as a bitmask, with bit i belonging to
+input vector i. Each component's propagate_bits applies its propagate_current rule to all the
+vectors at once with bitwise operations, so one settle pass covers every vector. The path graph
+and the sweep order are the same as in electric, so each bit follows exactly the steps a normal
+run with that vector's buttons would take. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     b1 = button(0, 1)
+    ...     b2 = button(1, 2)
+    ...     l = lamp(2, 3)
+    ...     t2 = terminal(3, voltage=0)
+    >>> truth_table(circuit=c).lamps
+    {1: 8}
+
+Only vector 3, where both buttons are pressed, lights the lamp.
+'''
+from collections import defaultdict, deque, namedtuple
+import itertools as it
+
+from electric import (_can_dangle, _connected_pins, _edge_masks, _HangingMasks, _resolve, button,
+                      terminal, settle_status)
+
+vector_result = namedtuple('vector_result', 'lamps steps status')
+truth_table_result = namedtuple('truth_table_result', 'buttons lamps steps status')
+
+def _live_masks(starts, adj, es, full, reverse=False):
+    # electric._live_edges for every vector at once. An edge is live in the vectors where it
+    # exists and where some other live edge leads into it (or it leaves a start pin).
+    live = defaultdict(int)
+    todo = deque()
+    def push(a, b, bits):
+        new = bits & es[(b, a) if reverse else (a, b)] & ~live[a, b]
+        if new:
+            live[a, b] |= new
+            todo.append((a, b, new))
+    for s in starts:
+        for b in adj[s]: push(s, b, full)
+    while todo:
+        a, b, new = todo.popleft()
+        if b in starts: continue
+        for c in adj[b]:
+            if c != a: push(b, c, new)
+    return live
+
+def _path_masks(circuit, masks, full):
+    # electric.build_path_graph as {(a, b): vectors the edge is in the path graph in}
+    sources = set(circuit.get_sources())
+    grounds = {p for p in circuit.pcd if circuit.get_terminal_voltage(p) == 0}
+    es = _edge_masks(circuit, masks, full, sources, grounds)
+    succ, pred = defaultdict(set), defaultdict(set)
+    for a, b in es:
+        succ[a].add(b)
+        pred[b].add(a)
+    forward = _live_masks(sources, succ, es, full)
+    backward = _live_masks(grounds, pred, es, full, reverse=True)
+    paths = {(a, b): m & backward[b, a] for (a, b), m in forward.items() if m & backward[b, a]}
+    if _can_dangle(paths, sources, grounds):
+        # Loops hanging off the circuit, for every vector at once
+        pairs = defaultdict(int)
+        for (a, b), m in paths.items():
+            if a != b: pairs[frozenset((a, b))] |= m
+        kept = _HangingMasks([tuple(e) for e in pairs], sources, grounds).kept(pairs.values(), full)
+        kept = dict(zip(pairs, kept))
+        paths = {e: m & kept.get(frozenset(e), 0) for e, m in paths.items()}
+        paths = {e: m for e, m in paths.items() if m}
+    return paths
+
+def _active_masks(circuit, paths, masks, full):
+    # For every pin, the components the sweep runs there and the vectors it runs them in
+    at = {}
+    for p, cs in circuit.pcd.items():
+        l = []
+        for c in cs:
+            m = full
+            if type(c) is not terminal:
+                for q, e in _connected_pins(c, p, masks, full):
+                    m &= ~e | paths.get((p, q), 0)
+            if m: l.append((c, m))
+        at[p] = l
+    return at
+
+def _step(at, pct):
+    for p, l in at.items():
+        for c, m in l:
+            out = c.propagate_bits(m, *[pct[q] for q in c.ps])
+            for q, v in zip(c.ps, out):
+                pct[q] = (v & m) | (pct[q] & ~m)
+
+def _simulate(circuit, masks, full, max_steps):
+    at = _active_masks(circuit, _path_masks(circuit, masks, full), masks, full)
+    pct = {p: full if circuit.pct.get(p) else 0 for p in circuit.pcd}
+    lamps = circuit.lamp_register
+    for l in lamps.values():
+        l.on_bits = full if l.on else 0
+    state = (tuple(pct.values()), tuple(l.on_bits for l in lamps.values()))
+    seen = {hash(state)}
+    status = settle_status.STEP_LIMIT
+    for n in it.count(1) if max_steps is None else range(1, max_steps + 1):
+        _step(at, pct)
+        new_state = (tuple(pct.values()), tuple(l.on_bits for l in lamps.values()))
+        if new_state == state:
+            status = settle_status.CONVERGED
+            break
+        if hash(new_state) in seen:
+            status = settle_status.OSCILLATING
+            break
+        seen.add(hash(new_state))
+        state = new_state
+    return {k: l.on_bits for k, l in lamps.items()}, n, status
+
+def simulate_vectors(vectors, circuit=None, max_steps=1000):
+    '''Runs the circuit once for every vector, where a vector maps the component ids of buttons
+    to their on state (buttons left out keep their current state). Returns the lamp states as
+    bitmasks by lamp id, bit i being the lamp's state for vectors[i].
+
+    Like settle, every vector starts from the circuit's current pin currents and lamp states.
+    '''
+    circuit = _resolve(circuit)
+    full = (1 << len(vectors)) - 1
+    masks = {}
+    for sid in set(it.chain.from_iterable(vectors)):
+        b = circuit.get_component(sid)
+        masks[b] = sum(1 << i for i, v in enumerate(vectors) if v.get(sid, b.on))
+    return vector_result(*_simulate(circuit, masks, full, max_steps))
+
+def truth_table(buttons=None, circuit=None, max_steps=1000):
+    '''Runs the circuit for every combination of the given buttons (all buttons by default, in
+    id order). In vector i button j is pressed if bit j of i is set, and bit i of each lamp's
+    bitmask is that lamp's state in vector i.
+    '''
+    circuit = _resolve(circuit)
+    if buttons is None:
+        buttons = [c for c in circuit.register.values() if type(c) is button]
+    n = 1 << len(buttons)
+    full = (1 << n) - 1
+    masks = {}
+    for j, b in enumerate(buttons):
+        # Runs of 2**j unpressed then 2**j pressed vectors, doubled up to n vectors
+        m, width = ((1 << (1 << j)) - 1) << (1 << j), 2 << j
+        while width < n:
+            m |= m << width
+            width *= 2
+        masks[b] = m
+    lamps, steps, status = _simulate(circuit, masks, full, max_steps)
+    return truth_table_result([b.sid for b in buttons], lamps, steps, status)
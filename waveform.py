@@ -0,0 +1,211 @@
+'''Records how pin currents and lamps change over the steps of a simulation, into a file.
+
+Once start_trace is called, every step (propagate_current_step, EventPropagator.step and so
+everything built on them) appends the signals that changed to the trace file. EventPropagator
+tells the trace which pins it visited and changed, so recording its steps costs time in
+proportion to the changes rather than to the size of the circuit. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     l = lamp(0, 1)
+    ...     t2 = terminal(1, voltage=0)
+    >>> trace = start_trace('example.xdw', c)
+    >>> settle(get_all_paths_from_positive(c), circuit=c).steps
+    2
+    >>> stop_trace(c)
+    >>> with TraceReader('example.xdw') as r:
+    ...     r.steps, r.history(lamp_signal(l)), r.state(1).currents
+    (2, [(0, 0), (1, 1)], array('b', [1, 1]))
+
+A signal is a pin id (see Circuit.pin_ids) for the current at that pin, or lamp_signal(l) for
+the on state of lamp l. Step 0 is the state when the trace started.
+
+The file is a header followed by fixed-width records (step, signal, value), sorted by step and
+written through a memory map. Every keyframe_interval steps the record holds every signal
+instead of only those that changed, so the reader can find the state at any step by binary
+search and replay at most keyframe_interval steps. Extracting a signal's history scans the
+records in chunks, so neither needs the whole file in memory.
+
+Header, all little-endian: the magic bytes XDKT, a version byte, the keyframe interval, the
+number of pins, the last step and the number of records. Records are a 4-byte step, a 4-byte
+signed signal and a signed value byte.
+'''
+from array import array
+from collections import namedtuple
+import mmap
+import struct
+
+from electric import _resolve, lamp
+
+magic = b'XDKT'
+version = 1
+_header = struct.Struct('<4sBIIIQ')     # Magic, version, keyframe interval, pins, steps, records
+_record = struct.Struct('<Iib')         # Step, signal, value
+_chunk = 1 << 14                        # Records read at a time when scanning
+
+trace_state = namedtuple('trace_state', 'step currents lamps')
+
+def lamp_signal(l):
+    '''The signal of a lamp's on state.'''
+    return -l.lamp_sid
+
+def _diff(old, new, lo=0, hi=None):
+    # Indices where new differs from old, which may be shorter. Halves the range until the
+    # differing parts are small, so unchanged stretches cost one comparison each.
+    hi = len(new) if hi is None else hi
+    if new[lo:hi] == old[lo:hi]:
+        return []
+    if hi - lo <= 64:
+        return [i for i in range(lo, hi) if i >= len(old) or new[i] != old[i]]
+    mid = (lo + hi) // 2
+    return _diff(old, new, lo, mid) + _diff(old, new, mid, hi)
+
+class TraceWriter:
+    def __init__(self, path, circuit=None, keyframe_interval=1024):
+        self.circuit = _resolve(circuit)
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'w+b')
+        self.capacity = 0
+        self.map = None
+        self.records = 0
+        self.step = -1
+        self._grow(1 << 12)
+        self.currents = array('b')      # What the trace says the state is
+        self.lamps = bytearray()
+        self.record()
+
+    def _grow(self, capacity):
+        if self.map is not None: self.map.close()
+        self.capacity = capacity
+        self.file.truncate(_header.size + capacity * _record.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def _write(self, changes):
+        # changes is a list of (signal, value)
+        if self.records + len(changes) > self.capacity:
+            self._grow(max(2 * self.capacity, self.records + len(changes)))
+        offset = _header.size + self.records * _record.size
+        step, pack = self.step, _record.pack_into
+        for signal, value in changes:
+            pack(self.map, offset, step, signal, value)
+            offset += _record.size
+        self.records += len(changes)
+        _header.pack_into(self.map, 0, magic, version, self.keyframe_interval,
+                          len(self.currents), step, self.records)
+
+    def record(self, pins=None):
+        '''Records the state after the next step. Called by the simulation once per step, with
+        the pins whose currents and lamps the step can have changed if it knows them, so only
+        those are compared. Otherwise the whole state is.'''
+        self.step += 1
+        circuit = self.circuit
+        currents, lamps = circuit.pct.buffer, circuit.lamp_states
+        if self.step % self.keyframe_interval == 0:
+            changes = list(enumerate(currents))
+            changes.extend((-1 - i, on) for i, on in enumerate(lamps))
+        elif pins is None or len(currents) != len(self.currents) or len(lamps) != len(self.lamps):
+            changes = [(i, currents[i]) for i in _diff(self.currents, currents)]
+            changes.extend((-1 - i, lamps[i]) for i in _diff(self.lamps, lamps))
+        else:
+            changes, old, ids, pcd, seen = [], self.currents, circuit.pin_ids, circuit.pcd, set()
+            for p in pins:
+                if p in seen: continue
+                seen.add(p)
+                i = ids[p]
+                if currents[i] != old[i]:
+                    changes.append((i, currents[i]))
+                for c in pcd[p]:
+                    if isinstance(c, lamp) and lamps[c.lamp_sid - 1] != self.lamps[c.lamp_sid - 1]:
+                        changes.append((-c.lamp_sid, lamps[c.lamp_sid - 1]))
+            changes = list(dict.fromkeys(changes))      # Lamps on two of the pins come up twice
+            for signal, v in changes:
+                if signal >= 0: old[signal] = v
+                else: self.lamps[-1 - signal] = v
+            self._write(changes)
+            return
+        self.currents, self.lamps = array('b', currents), bytearray(lamps)
+        self._write(changes)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(_header.size + self.records * _record.size)
+        self.file.close()
+
+def start_trace(path, circuit=None, keyframe_interval=1024):
+    '''Starts recording every step of the circuit to the file at path and returns the writer.'''
+    circuit = _resolve(circuit)
+    circuit.trace = TraceWriter(path, circuit, keyframe_interval)
+    return circuit.trace
+
+def stop_trace(circuit=None):
+    '''Stops recording and closes the trace file.'''
+    circuit = _resolve(circuit)
+    circuit.trace.close()
+    circuit.trace = None
+
+class TraceReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        start, v, self.keyframe_interval, self.pins, self.steps, self.records = \
+            _header.unpack_from(self.map)
+        if start != magic:
+            raise ValueError('not a trace file')
+        if v != version:
+            raise ValueError('unsupported trace version')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.records
+
+    def _step_at(self, i):
+        return _record.unpack_from(self.map, _header.size + i * _record.size)[0]
+
+    def _find(self, step):
+        # Index of the first record of step or a later one
+        lo, hi = 0, self.records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._step_at(mid) < step: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def _scan(self, start=0, stop=None):
+        # The records from index start to stop, read a chunk at a time
+        stop = self.records if stop is None else stop
+        for i in range(start, stop, _chunk):
+            j = min(i + _chunk, stop)
+            yield from _record.iter_unpack(self.map[_header.size + i * _record.size:
+                                                    _header.size + j * _record.size])
+
+    def state(self, step):
+        '''The pin currents (indexed by pin id) and lamp states (by lamp id) after step.'''
+        if not 0 <= step <= self.steps:
+            raise IndexError(f'trace has no step {step}')
+        keyframe = step - step % self.keyframe_interval
+        currents, lamps = array('b', bytes(self.pins)), {}
+        for _, signal, value in self._scan(self._find(keyframe), self._find(step + 1)):
+            if signal >= 0: currents[signal] = value
+            else: lamps[-signal] = bool(value)
+        return trace_state(step, currents, lamps)
+
+    def history(self, signal):
+        '''The steps where the signal changed, as a list of (step, value), starting at step 0.'''
+        changes, last = [], 0
+        for step, s, value in self._scan():
+            if s == signal and value != last:
+                changes.append((step, value))
+                last = value
+        if not changes or changes[0][0] != 0:
+            changes.insert(0, (0, 0))
+        return changes
@@ -0,0 +1,100 @@
+'''Runs a simulation in a background thread, so whoever shows it never waits for a step.
+
+The worker owns the circuit while it runs. Others only read its latest published state and
+send it commands, so they never touch components the worker is changing. Example:
+
+    >>> with Circuit() as c:
+    ...     t1 = terminal(0, voltage=1)
+    ...     b = button(0, 1)
+    ...     l = lamp(1, 2)
+    ...     t2 = terminal(2, voltage=0)
+    >>> w = SimulationWorker(c)
+    >>> w.start()
+    >>> w.toggle(b.sid)
+    >>> w.wait(lambda s: s.on[l.sid]).on
+    {2: True, 3: True}
+    >>> w.stop()
+
+state is replaced by a new worker_state whenever the worker publishes, and assigning an
+attribute is atomic, so reading it needs no lock. on holds the on state of every button and
+lamp by component id. The worker publishes at most every publish_interval seconds while
+stepping, and always once it settles. It then sleeps until the next command arrives.
+
+With a cache (a cache.SimulationCache), the worker saves the state of the circuit every time it
+settles, and a worker started on a circuit that was seen before starts from the saved state.
+'''
+from collections import namedtuple
+import queue
+import threading
+import time
+
+from electric import IncrementalSimulator, _resolve, block, button, detect_shorts, lamp
+
+worker_state = namedtuple('worker_state', 'on settled error steps stats')
+
+class SimulationWorker:
+    def __init__(self, circuit=None, step_delay=0, publish_interval=1 / 120, cache=None):
+        self.circuit = _resolve(circuit)
+        self.step_delay = step_delay        # Seconds to wait after each step
+        self.publish_interval = publish_interval
+        self.cache = cache
+        self.commands = queue.SimpleQueue()
+        self.shown = [c for c in self.circuit.register.values() if isinstance(c, (button, lamp, block))]
+        self.state = worker_state({c.sid: c.on for c in self.shown}, False, None, 0, None)
+        self.published = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def toggle(self, sid):
+        '''Presses or releases the button with the given component id.'''
+        self.commands.put(('toggle', sid))
+
+    def stop(self, timeout=None):
+        self.commands.put(('stop', None))
+        self.thread.join(timeout)
+
+    def wait(self, predicate, timeout=None):
+        '''Waits until predicate(state) is true and returns the state. Returns None if the
+        timeout runs out first.'''
+        with self.published:
+            if self.published.wait_for(lambda: predicate(self.state), timeout):
+                return self.state
+
+    def _publish(self, settled, error, steps):
+        stats = self.circuit.stats
+        state = worker_state({c.sid: c.on for c in self.shown}, settled, error, steps,
+                             None if stats is None else stats.summary())
+        with self.published:
+            self.state = state
+            self.published.notify_all()
+
+    def _run(self):
+        if next(self.circuit.get_sources(), None) is None:
+            return self._publish(True, 'COULD NOT RUN', 0)
+        sim = IncrementalSimulator(self.circuit, self.cache)
+        if self.cache is not None:
+            self.cache.restore_state(self.circuit)
+        steps, settled, checked, last = 0, False, False, 0
+        while True:
+            # Block for commands once settled, otherwise only take the ones already waiting
+            while settled or not self.commands.empty():
+                command, arg = self.commands.get()
+                if command == 'stop':
+                    return
+                sim.toggle(self.circuit.get_component(arg))
+                settled = checked = False
+            if not checked:         # Once per change, since a press can close a short
+                if detect_shorts(sim.paths, circuit=self.circuit):
+                    return self._publish(True, 'SHORT CIRCUIT', steps)
+                checked = True
+            settled = sim.step() == 0
+            steps += 1
+            if settled and self.cache is not None:
+                self.cache.save_state(self.circuit)
+            if settled or time.perf_counter() - last >= self.publish_interval:
+                self._publish(settled, None, steps)
+                last = time.perf_counter()
+            if self.step_delay:
+                time.sleep(self.step_delay)